@@ -0,0 +1,1058 @@
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import os
+import random
+import re
+import resource
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+import chatclient
+import commands
+import presence
+import protocol
+import registry
+
+
+# ------------------------------------------------ Initialisation ---------------------------------------------------- #
+
+HOST_NAME = '127.0.0.1'
+HEADER_LENGTH = 4
+FORMAT = 'utf-8'
+USER_NAME_GET = 'GET_USERNAME'
+MAKE_EXIT = 'END'
+BENCH_PREFIX = 'bench '
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+RELAY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cluster.py')
+# Server arguments lifting the rate limits, for benchmarks that send faster than a person could
+UNLIMITED = ['--rate-limit', 'message=0', '--rate-limit', 'chat=0', '--rate-limit', 'ingress=0']
+
+
+# ---------------------------------------------------- Helpers ------------------------------------------------------- #
+
+# Raise the soft limit on open files to the hard limit; the server subprocess inherits it.
+def raise_file_limit() -> int:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def frame(message: str) -> bytes:
+    encoded_message = message.encode(FORMAT)
+    return '{:<{}}'.format(len(encoded_message), HEADER_LENGTH).encode(FORMAT) + encoded_message
+
+
+async def read_frame(reader: asyncio.StreamReader) -> str:
+    header = await reader.readexactly(HEADER_LENGTH)
+    return (await reader.readexactly(int(header.decode(FORMAT).strip()))).decode(FORMAT)
+
+
+def percentile(samples: list, fraction: float) -> float:
+    if not samples:
+        return float('nan')
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+# Start server.py in a scratch directory (so server.log in the repository is left alone) and wait until it listens.
+def start_server(port: int, extra_arguments: list, path: str = SERVER_PATH) -> subprocess.Popen:
+    process = subprocess.Popen([sys.executable, path, str(port)] + extra_arguments,
+                               cwd=tempfile.mkdtemp(prefix='chat-bench-'), stdin=subprocess.PIPE,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST_NAME, port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('The process did not start listening on port {}.'.format(port))
+
+
+# Kill the server along with any worker processes it started (they share its process group), and wait until they have
+# all gone, so the next server to be started is not mistaken for one of them still listening.
+def stop_server(process: subprocess.Popen) -> None:
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            os.killpg(process.pid, 0)
+        except ProcessLookupError:
+            break
+        time.sleep(0.05)
+
+
+# Resident memory (kB) and thread count of a process, read from /proc.
+def process_usage(pid: int) -> tuple:
+    usage = {}
+    with open('/proc/{}/status'.format(pid)) as status:
+        for line in status:
+            key, _, value = line.partition(':')
+            usage[key] = value.strip()
+    return int(usage['VmRSS'].split()[0]), int(usage['Threads'])
+
+
+# ----------------------------------------------- Connection Benchmark ----------------------------------------------- #
+
+# A benchmark user: completes the username handshake, then drains every frame it is sent, recording the delivery
+# latency of benchmark messages (these carry their send time, which is comparable as all users share this process).
+class BenchUser:
+    def __init__(self, username: str) -> None:
+        self.username = username
+        self.reader = None
+        self.writer = None
+        self.received = 0
+        self.latencies = []
+        self.on_bench = None    # Called with the sender of each benchmark message received, if set
+
+    async def connect(self, port: int) -> None:
+        self.reader, self.writer = await asyncio.open_connection(HOST_NAME, port)
+        if await read_frame(self.reader) != USER_NAME_GET:
+            raise RuntimeError('Unexpected handshake from the server.')
+        self.writer.write(frame(self.username))
+        await read_frame(self.reader)   # Welcome message
+
+    async def drain(self) -> None:
+        try:
+            while True:
+                message = await read_frame(self.reader)
+                self.received += 1
+                sender, _, body = message.partition('> ')
+                if body.startswith(BENCH_PREFIX):
+                    self.latencies.append(time.perf_counter() - float(body[len(BENCH_PREFIX):]))
+                    if self.on_bench is not None:
+                        self.on_bench(sender)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+
+    async def chat(self, rate: float, duration: float) -> int:
+        sent = 0
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            self.writer.write(frame('{}{}'.format(BENCH_PREFIX, time.perf_counter())))
+            sent += 1
+            await asyncio.sleep(1 / rate)
+        return sent
+
+    # Send as fast as the messages are delivered: each message takes a place in the window, which is given back once
+    # the message reaches the observing user, so the server is kept saturated without its queues growing unbounded.
+    async def chat_saturated(self, window: asyncio.Semaphore, duration: float) -> int:
+        sent = 0
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            try:
+                await asyncio.wait_for(window.acquire(), max(0.0, end - time.perf_counter()))
+            except asyncio.TimeoutError:
+                break
+            self.writer.write(frame('{}{}'.format(BENCH_PREFIX, time.perf_counter())))
+            sent += 1
+            await self.writer.drain()
+        return sent
+
+
+# Connect the users and have the active ones send for the duration: at a fixed rate each, or given a window, closed-loop
+# with that many messages each in flight (to the first user, which observes them), to find the peak delivery rate.
+async def run_connections(server_pid: int, port: int, idle: int, active: int, rate: float, duration: float,
+                          concurrency: int, window: int = 0) -> dict:
+    users = [BenchUser('user{}'.format(number)) for number in range(idle + active)]
+    gate = asyncio.Semaphore(concurrency)
+    drainers = []
+
+    async def connect(user: BenchUser) -> bool:
+        async with gate:
+            try:
+                await user.connect(port)
+            except (OSError, asyncio.IncompleteReadError, RuntimeError):
+                return False
+        drainers.append(asyncio.create_task(user.drain()))
+        return True
+
+    start = time.perf_counter()
+    connected = sum(await asyncio.gather(*(connect(user) for user in users)))
+    setup_time = time.perf_counter() - start
+    await asyncio.sleep(1)      # Let the join announcements settle before measuring
+    rss, threads = process_usage(server_pid)
+    received_before = sum(user.received for user in users)
+
+    talkers = [user for user in users[idle:] if user.writer is not None]
+    start = time.perf_counter()
+    if window:
+        windows = {user.username: asyncio.Semaphore(window) for user in talkers}
+        users[0].on_bench = lambda sender: windows[sender].release() if sender in windows else None
+        sent = sum(await asyncio.gather(*(user.chat_saturated(windows[user.username], duration) for user in talkers)))
+    else:
+        sent = sum(await asyncio.gather(*(user.chat(rate, duration) for user in talkers)))
+    await asyncio.sleep(1)      # Allow the last messages to be delivered
+    elapsed = time.perf_counter() - start
+    delivered = sum(user.received for user in users) - received_before
+    latencies = [latency for user in users for latency in user.latencies]
+
+    for user in users:
+        if user.writer is not None:
+            user.writer.close()
+    for drainer in drainers:
+        drainer.cancel()
+    return {'connected': connected, 'setup_rate': connected / setup_time, 'rss': rss, 'threads': threads,
+            'sent': sent, 'delivered_per_second': delivered / elapsed, 'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99)}
+
+
+# How many idle connections one server process can hold, and how it copes when some of them are active.
+def benchmark_connections(arguments: argparse.Namespace) -> None:
+    raise_file_limit()
+    engines = ['threads', 'asyncio'] if arguments.engine == 'both' else [arguments.engine]
+    print('{:<8} {:>9} {:>10} {:>9} {:>8} {:>8} {:>12} {:>9} {:>9}'.format(
+        'engine', 'connected', 'conn/s', 'rss (MB)', 'threads', 'sent', 'delivered/s', 'p50 (ms)', 'p99 (ms)'))
+    for engine in engines:
+        server = start_server(arguments.port, ['--engine', engine])
+        try:
+            result = asyncio.run(run_connections(server.pid, arguments.port, arguments.idle, arguments.active,
+                                                 arguments.rate, arguments.duration, arguments.concurrency))
+        finally:
+            stop_server(server)
+        print('{:<8} {:>9} {:>10.0f} {:>9.1f} {:>8} {:>8} {:>12.0f} {:>9.2f} {:>9.2f}'.format(
+            engine, result['connected'], result['setup_rate'], result['rss'] / 1024, result['threads'],
+            result['sent'], result['delivered_per_second'], result['p50'] * 1000, result['p99'] * 1000))
+
+
+# ------------------------------------------------ Workers Benchmark ------------------------------------------------- #
+
+# Delivery rate and latency with the server split over different numbers of worker processes. The same users are
+# connected each time, all in the lobby, so every message is delivered by every worker. With --saturate the active
+# users send closed-loop instead of at a fixed rate, so the delivery rate is the peak each worker count sustains.
+def benchmark_workers(arguments: argparse.Namespace) -> None:
+    raise_file_limit()
+    print('{:<8} {:>8} {:>9} {:>8} {:>12} {:>9} {:>9}'.format(
+        'engine', 'workers', 'connected', 'sent', 'peak deliv/s' if arguments.saturate else 'delivered/s',
+        'p50 (ms)', 'p99 (ms)'))
+    for count in arguments.workers:
+        server = start_server(arguments.port, ['--engine', arguments.engine, '--workers', str(count), '--quiet'] +
+                              (UNLIMITED if arguments.saturate else []))
+        try:
+            result = asyncio.run(run_connections(server.pid, arguments.port, arguments.idle, arguments.active,
+                                                 arguments.rate, arguments.duration, arguments.concurrency,
+                                                 arguments.saturate))
+        finally:
+            stop_server(server)
+        print('{:<8} {:>8} {:>9} {:>8} {:>12.0f} {:>9.2f} {:>9.2f}'.format(
+            arguments.engine, count, result['connected'], result['sent'], result['delivered_per_second'],
+            result['p50'] * 1000, result['p99'] * 1000))
+
+
+# ------------------------------------------------ Cluster Benchmark ------------------------------------------------- #
+
+# A benchmark user that also counts how many times it received each benchmark message (they are tagged with their
+# sender and a sequence number), and keeps the other replies it is sent, such as the answer to /users.
+class ClusterUser(BenchUser):
+    def __init__(self, username: str) -> None:
+        super().__init__(username)
+        self.tags = collections.Counter()
+        self.replies = []
+        self.sequence = 0
+
+    async def drain(self) -> None:
+        try:
+            while True:
+                message = await read_frame(self.reader)
+                self.received += 1
+                _, _, body = message.partition('> ')
+                if body.startswith(BENCH_PREFIX):
+                    sent_time, tag = body[len(BENCH_PREFIX):].split(' ')
+                    self.latencies.append(time.perf_counter() - float(sent_time))
+                    self.tags[tag] += 1
+                else:
+                    self.replies.append(message)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+
+    async def chat(self, rate: float, duration: float) -> int:
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            self.writer.write(frame('{}{} {}:{}'.format(BENCH_PREFIX, time.perf_counter(), self.username,
+                                                        self.sequence)))
+            self.sequence += 1
+            await asyncio.sleep(1 / rate)
+        return self.sequence
+
+
+# The number of users online according to a reply to /users (0 for any other message).
+def users_listed(reply: str) -> int:
+    match = re.match(r'There (?:are (\d+) users|is only 1 user) ', reply)
+    return int(match.group(1) or 1) if match else 0
+
+
+async def run_cluster(ports: list, users_per_node: int, active: int, rate: float, duration: float,
+                      concurrency: int) -> dict:
+    users = [ClusterUser('user{}'.format(number)) for number in range(users_per_node * len(ports))]
+    gate = asyncio.Semaphore(concurrency)
+    drainers = []
+
+    async def connect(number: int, user: ClusterUser) -> bool:
+        async with gate:
+            try:
+                await user.connect(ports[number % len(ports)])      # Users are spread evenly over the nodes
+            except (OSError, asyncio.IncompleteReadError, RuntimeError):
+                return False
+        drainers.append(asyncio.create_task(user.drain()))
+        return True
+
+    connected = sum(await asyncio.gather(*(connect(number, user) for number, user in enumerate(users))))
+    await asyncio.sleep(1)      # Let the join announcements reach every node
+    users = [user for user in users if user.writer is not None]
+
+    # Every node should list every user, wherever they are connected
+    listers = users[:len(ports)]
+    for user in listers:
+        user.replies.clear()
+        user.writer.write(frame('/users'))
+    await asyncio.sleep(0.5)
+    listed = [max(map(users_listed, user.replies), default=0) for user in listers]
+
+    for user in users:
+        user.received = 0
+    talkers = users[:active]
+    start = time.perf_counter()
+    sent = sum(await asyncio.gather(*(user.chat(rate, duration) for user in talkers)))
+    await asyncio.sleep(2)      # Allow the last messages to be delivered
+    elapsed = time.perf_counter() - start
+    tags = {'{}:{}'.format(user.username, sequence) for user in talkers for sequence in range(user.sequence)}
+    exact = sum(1 for user in users for tag in tags if user.tags[tag] == 1)
+    duplicated = sum(count - 1 for user in users for count in user.tags.values() if count > 1)
+    delivered = sum(sum(user.tags.values()) for user in users)
+    latencies = [latency for user in users for latency in user.latencies]
+
+    for user in users:
+        user.writer.close()
+    for drainer in drainers:
+        drainer.cancel()
+    return {'connected': connected, 'listed': listed, 'sent': sent, 'expected': sent * len(users),
+            'exactly_once': exact, 'duplicated': duplicated, 'delivered_per_second': delivered / elapsed,
+            'p50': percentile(latencies, 0.5), 'p99': percentile(latencies, 0.99)}
+
+
+# Start a relay and several server nodes joined through it on this machine, spread users over them, and check that the
+# cluster behaves as one server: /users lists everyone from every node, and every message reaches every user once.
+def benchmark_cluster(arguments: argparse.Namespace) -> None:
+    raise_file_limit()
+    print('{:<6} {:>9} {:>10} {:>8} {:>13} {:>10} {:>12} {:>9} {:>9}'.format(
+        'nodes', 'connected', 'listed', 'sent', 'exactly once', 'repeated', 'delivered/s', 'p50 (ms)', 'p99 (ms)'))
+    for count in arguments.nodes:
+        relay = start_server(arguments.port, [], RELAY_PATH)
+        ports = [arguments.port + number for number in range(1, count + 1)]
+        nodes = []
+        try:
+            for number, port in enumerate(ports, 1):
+                nodes.append(start_server(port, ['--engine', arguments.engine, '--quiet', '--cluster',
+                                                 '{}:{}'.format(HOST_NAME, arguments.port), '--node',
+                                                 'node{}'.format(number)]))
+            result = asyncio.run(run_cluster(ports, arguments.users, arguments.active, arguments.rate,
+                                             arguments.duration, arguments.concurrency))
+        finally:
+            for process in nodes + [relay]:
+                stop_server(process)
+        print('{:<6} {:>9} {:>10} {:>8} {:>13} {:>10} {:>12.0f} {:>9.2f} {:>9.2f}'.format(
+            count, result['connected'], min(result['listed']), result['sent'],
+            '{}/{}'.format(result['exactly_once'], result['expected']), result['duplicated'],
+            result['delivered_per_second'], result['p50'] * 1000, result['p99'] * 1000))
+
+
+# ------------------------------------------------ Registry Benchmark ------------------------------------------------ #
+
+class FakeClient:
+    def __init__(self, username: str) -> None:
+        self.username = username
+
+
+# Time the target lookup made by /whisper (and /kick): the previous scan over every client against the username index.
+def benchmark_registry(arguments: argparse.Namespace) -> None:
+    users = [FakeClient('user{}'.format(number)) for number in range(arguments.users)]
+    clients = set(users)
+    usernames = {user.username for user in users}
+    index = registry.UserRegistry()
+    for user in users:
+        index.add(user)
+    targets = [user.username for user in users[::max(1, arguments.users // 100)]]
+
+    def scan() -> None:
+        for username in targets:
+            if username in usernames:
+                [client for client in clients if client.username == username][0]
+
+    def lookup() -> None:
+        for username in targets:
+            index.get(username)
+
+    print('{:<10} {:>8} {:>16}'.format('lookup', 'users', 'per whisper (us)'))
+    for name, run in (('scan', scan), ('registry', lookup)):
+        seconds = min(timeit.repeat(run, number=arguments.repeat, repeat=3)) / (arguments.repeat * len(targets))
+        print('{:<10} {:>8} {:>16.3f}'.format(name, arguments.users, seconds * 1e6))
+
+
+# ------------------------------------------------ Presence Benchmark ------------------------------------------------ #
+
+# A presence subscriber that only counts what it is sent.
+class CountingClient:
+    def __init__(self) -> None:
+        self.frames = 0
+
+    def send(self, frame: protocol.Frame) -> None:
+        self.frames += 1
+
+
+# Time /users as it was (the whole list built up with += in one message) against a page and a prefix query of the sorted
+# presence index, and the cost of keeping the index sorted as users join and leave. Then time a storm of users joining
+# with subscribers watching, pushing every change in a frame of its own against gathering them into shared frames.
+def benchmark_presence(arguments: argparse.Namespace) -> None:
+    print('{:>8} {:>15} {:>13} {:>10} {:>12} {:>16}'.format('users', 'full list (us)', 'list (bytes)', 'page (us)',
+                                                           'prefix (us)', 'join+leave (us)'))
+    for count in arguments.users:
+        chooser = random.Random(count)
+        usernames = ['user{}'.format(chooser.randrange(10 * count)) for _ in range(count)]
+        index = presence.PresenceIndex()
+        for username in usernames:
+            index.add(username)
+        directory = dict.fromkeys(usernames)
+
+        def full_list() -> str:
+            message = "There are {} users currently online: ".format(len(directory))
+            for username in list(directory):
+                message += "\n{}".format(username)
+            return message
+
+        def page() -> str:
+            return '\n'.join(index.page(index.pages() // 2))
+
+        def prefix() -> str:
+            return '\n'.join(index.starting_with('user12')[0])
+
+        def churn() -> None:
+            index.add('newcomer')
+            index.remove('newcomer')
+
+        timings = [min(timeit.repeat(run, number=arguments.repeat, repeat=3)) / arguments.repeat
+                   for run in (full_list, page, prefix, churn)]
+        print('{:>8} {:>15.1f} {:>13} {:>10.1f} {:>12.1f} {:>16.2f}'.format(
+            len(index), timings[0] * 1e6, len(full_list().encode(FORMAT)), timings[1] * 1e6, timings[2] * 1e6,
+            timings[3] * 1e6))
+
+    print()
+    print('{:>8} {:>12} {:>12} {:>20} {:>12}'.format('joins', 'subscribers', 'push', 'frames/subscriber', 'time (ms)'))
+    for push, delay in (('each', None), ('gathered', presence.FLUSH_DELAY)):
+        feed = presence.Presence(flush_delay=3600)
+        subscribers = [CountingClient() for _ in range(arguments.subscribers)]
+        for subscriber in subscribers:
+            feed.subscribe(subscriber)
+            subscriber.frames = 0
+        started = time.perf_counter()
+        for number in range(arguments.joins):
+            feed.join('storm{}'.format(number))
+            if delay is None:
+                feed.flush()
+        feed.flush()
+        elapsed = time.perf_counter() - started
+        print('{:>8} {:>12} {:>12} {:>20.1f} {:>12.1f}'.format(
+            arguments.joins, arguments.subscribers, push, subscribers[0].frames, elapsed * 1000))
+
+
+# ---------------------------------------------- Compression Benchmark ----------------------------------------------- #
+
+# Messages typical of the server, with the number of clients each is sent to: a short chat line (under the compression
+# threshold) and a long pasted message, both broadcast to a room, and the reply to /users with many users online.
+def compression_workloads(users: int, recipients: int) -> list:
+    words = ('the server sends every message to each member of the room so long messages cost bandwidth for all of '
+             'them while a short line of chat hardly matters it was 42 degrees at 3pm on Tuesday').split()
+    chooser = random.Random(1)
+    paragraph = ' '.join(chooser.choice(words) for _ in range(400))
+    listing = 'There are {} users currently online: '.format(users) + \
+              ''.join('\n{}{}'.format(chooser.choice(words), chooser.randrange(100000)) for _ in range(users))
+    return [('chat', 'user42> see you all tomorrow, same time?', recipients),
+            ('paste', 'user42> ' + paragraph, recipients), ('/users', listing, 1)]
+
+
+# What compression costs and saves for each workload: the encoded size with and without it, the server's CPU time to
+# compress (paid once per message, as the compressed encoding is shared by every recipient), each recipient's time to
+# decompress, and the bytes saved over all the recipients.
+def benchmark_compression(arguments: argparse.Namespace) -> None:
+    print('{:<8} {:>10} {:>9} {:>11} {:>7} {:>14} {:>13} {:>11} {:>18}'.format(
+        'message', 'recipients', 'bytes', 'compressed', 'ratio', 'compress (us)', 'inflate (us)', 'saved (kB)',
+        'compress/kB saved'))
+    protocol.COMPRESSION_LEVEL = arguments.level
+    for name, message, recipients in compression_workloads(arguments.users, arguments.recipients):
+        plain = protocol.Frame(message).encode(protocol.V2)
+        compressed = protocol.Frame(message).encode(protocol.V2, arguments.threshold)
+        compress = min(timeit.repeat(lambda: protocol.Frame(message).encode(protocol.V2, arguments.threshold),
+                                     number=arguments.repeat, repeat=3)) / arguments.repeat
+        compress -= min(timeit.repeat(lambda: protocol.Frame(message).encode(protocol.V2),
+                                      number=arguments.repeat, repeat=3)) / arguments.repeat
+        decoder = protocol.FrameDecoder(protocol.V2, max_frame_size=len(plain))
+
+        def inflate() -> None:
+            decoder.feed(compressed)
+            decoder.next_frame()
+
+        inflate_time = min(timeit.repeat(inflate, number=arguments.repeat, repeat=3)) / arguments.repeat
+        saved = (len(plain) - len(compressed)) * recipients
+        print('{:<8} {:>10} {:>9} {:>11} {:>7.2f} {:>14.1f} {:>13.1f} {:>11.1f} {:>15.2f} us'.format(
+            name, recipients, len(plain), len(compressed), len(plain) / len(compressed), max(compress, 0) * 1e6,
+            inflate_time * 1e6, saved / 1000, max(compress, 0) * 1e6 / (saved / 1000) if saved else float('nan')))
+
+
+# ------------------------------------------------- TLS Benchmark ---------------------------------------------------- #
+
+# Make a self-signed certificate (and its key) for 127.0.0.1 with the openssl command line tool, in a scratch
+# directory; returns the path of the PEM file holding both.
+def make_certificate(openssl: str) -> str:
+    directory = tempfile.mkdtemp(prefix='chat-bench-tls-')
+    path = os.path.join(directory, 'server.pem')
+    subprocess.run([openssl, 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+                    '-days', '1', '-subj', '/CN=localhost', '-addext', 'subjectAltName=IP:{},DNS:localhost'
+                    .format(HOST_NAME), '-keyout', path, '-out', path],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return path
+
+
+# Read one v1 frame from a blocking socket.
+def read_frame_blocking(sock: socket.socket) -> str:
+    data = b''
+    while len(data) < HEADER_LENGTH or len(data) < HEADER_LENGTH + int(data[:HEADER_LENGTH].strip()):
+        received = sock.recv(65536)
+        if not received:
+            raise ConnectionError('The server closed the connection.')
+        data += received
+    return data[HEADER_LENGTH:].decode(FORMAT)
+
+
+# Connect and complete the username handshake, with TLS if a context is given (resuming the session, if given one).
+def handshake(port: int, username: str, context: ssl.SSLContext = None, session: ssl.SSLSession = None):
+    sock = socket.create_connection((HOST_NAME, port))
+    if context is not None:
+        sock = context.wrap_socket(sock, server_hostname=HOST_NAME, session=session)
+    if read_frame_blocking(sock) != USER_NAME_GET:
+        raise RuntimeError('Unexpected handshake from the server.')
+    sock.sendall(frame(username))
+    read_frame_blocking(sock)   # Welcome message (TLS 1.3 session tickets arrive with it)
+    return sock
+
+
+# Open and close connections from several threads at once, as a crowd of clients reconnecting would; with resume, each
+# thread resumes the TLS session of its previous connection. Returns the connection rate and handshake latencies.
+def reconnect_storm(port: int, connections: int, concurrency: int, context: ssl.SSLContext, resume: bool) -> tuple:
+    def worker(number: int) -> list:
+        latencies = []
+        session = None
+        for attempt in range(number, connections, concurrency):
+            started = time.perf_counter()
+            sock = handshake(port, 'storm{}'.format(attempt), context, session)
+            latencies.append(time.perf_counter() - started)
+            if resume:
+                session = sock.session
+            sock.sendall(frame(MAKE_EXIT))
+            sock.close()
+        return latencies
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        latencies = [latency for result in pool.map(worker, range(concurrency)) for latency in result]
+    return len(latencies) / (time.perf_counter() - started), percentile(latencies, 0.5), percentile(latencies, 0.99)
+
+
+# Round trip times of chat messages (each sent to a room of one, so it comes straight back) over one connection.
+def message_latency(port: int, messages: int, context: ssl.SSLContext) -> tuple:
+    sock = handshake(port, 'pinger', context)
+    latencies = []
+    for number in range(messages):
+        started = time.perf_counter()
+        sock.sendall(frame('{}{}'.format(BENCH_PREFIX, number)))
+        while not read_frame_blocking(sock).endswith('{}{}'.format(BENCH_PREFIX, number)):
+            pass
+        latencies.append(time.perf_counter() - started)
+    sock.close()
+    return percentile(latencies, 0.5), percentile(latencies, 0.99)
+
+
+# Connection rate and message latency of the server over plain TCP against TLS, with full and resumed handshakes.
+def benchmark_tls(arguments: argparse.Namespace) -> None:
+    certificate = make_certificate(arguments.openssl)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.load_verify_locations(certificate)
+    engines = ['threads', 'asyncio'] if arguments.engine == 'both' else [arguments.engine]
+    print('{:<8} {:<12} {:>9} {:>15} {:>15} {:>14} {:>14}'.format(
+        'engine', 'transport', 'conns/s', 'connect p50 ms', 'connect p99 ms', 'message p50 ms', 'message p99 ms'))
+    for engine in engines:
+        for transport in ('plain', 'tls', 'tls-resumed'):
+            tls = transport != 'plain'
+            server = start_server(arguments.port, ['--engine', engine, '--quiet'] + UNLIMITED +
+                                  (['--tls-cert', certificate] if tls else []))
+            try:
+                rate, connect_p50, connect_p99 = reconnect_storm(arguments.port, arguments.connections,
+                                                                 arguments.concurrency, context if tls else None,
+                                                                 transport == 'tls-resumed')
+                message_p50, message_p99 = message_latency(arguments.port, arguments.messages,
+                                                           context if tls else None)
+            finally:
+                stop_server(server)
+            print('{:<8} {:<12} {:>9.0f} {:>15.2f} {:>15.2f} {:>14.3f} {:>14.3f}'.format(
+                engine, transport, rate, connect_p50 * 1000, connect_p99 * 1000, message_p50 * 1000,
+                message_p99 * 1000))
+
+
+# ------------------------------------------------ Restart Benchmark ------------------------------------------------- #
+
+# Users chat for duration seconds, while the server is hot restarted (with SIGUSR2, sent to the server's process group,
+# as the restarted server is a new process) every interval seconds. Every benchmark message is tagged, so a message
+# lost or delivered twice across a restart is counted, as is any connection the server dropped.
+async def run_restarts(server_pid: int, port: int, count: int, active: int, rate: float, duration: float,
+                       restarts: int, interval: float, concurrency: int) -> dict:
+    users = [ClusterUser('user{}'.format(number)) for number in range(count)]
+    gate = asyncio.Semaphore(concurrency)
+
+    async def connect(user: ClusterUser) -> None:
+        async with gate:
+            await user.connect(port)
+
+    await asyncio.gather(*(connect(user) for user in users))
+    drainers = [asyncio.create_task(user.drain()) for user in users]
+    await asyncio.sleep(1)
+
+    talkers = users[:active]
+    chatting = asyncio.gather(*(user.chat(rate, duration) for user in talkers))
+    for _ in range(restarts):
+        await asyncio.sleep(interval)
+        os.killpg(server_pid, signal.SIGUSR2)
+    await chatting
+    await asyncio.sleep(2)      # Allow the last messages to be delivered
+
+    expected = {'{}:{}'.format(user.username, number) for user in talkers for number in range(user.sequence)}
+    dropped = sum(drainer.done() for drainer in drainers)
+    for user in users:
+        user.writer.close()
+    for drainer in drainers:
+        drainer.cancel()
+    latencies = [latency for user in users for latency in user.latencies]
+    return {'sent': len(expected), 'dropped': dropped,
+            'lost': sum(len(expected - set(user.tags)) for user in users),
+            'duplicated': sum(number - 1 for user in users for number in user.tags.values() if number > 1),
+            'p50': percentile(latencies, 0.5), 'p99': percentile(latencies, 0.99), 'max': max(latencies)}
+
+
+# Hot restarts of a busy server: connections dropped, messages lost or duplicated, and the delivery stall they cause.
+def benchmark_restart(arguments: argparse.Namespace) -> None:
+    raise_file_limit()
+    engines = ['threads', 'asyncio'] if arguments.engine == 'both' else [arguments.engine]
+    print('{:<8} {:>6} {:>9} {:>8} {:>8} {:>6} {:>11} {:>9} {:>9} {:>9}'.format(
+        'engine', 'users', 'restarts', 'sent', 'dropped', 'lost', 'duplicated', 'p50 (ms)', 'p99 (ms)', 'max (ms)'))
+    for engine in engines:
+        for restarts in (0, arguments.restarts):
+            server = start_server(arguments.port, ['--engine', engine, '--quiet'] + UNLIMITED)
+            try:
+                result = asyncio.run(run_restarts(server.pid, arguments.port, arguments.users, arguments.active,
+                                                  arguments.rate, arguments.interval * (arguments.restarts + 1),
+                                                  restarts, arguments.interval, arguments.concurrency))
+            finally:
+                stop_server(server)
+            print('{:<8} {:>6} {:>9} {:>8} {:>8} {:>6} {:>11} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+                engine, arguments.users, restarts, result['sent'], result['dropped'], result['lost'],
+                result['duplicated'], result['p50'] * 1000, result['p99'] * 1000, result['max'] * 1000))
+
+
+# ------------------------------------------------- Render Benchmark ------------------------------------------------- #
+
+# Render messages posted by another thread, as client.py's receive thread does, in a chat window: either one at a time,
+# straight from that thread (as the client used to, with every Tk call handed over to the main loop and waited for), or
+# through a ChatView. Returns the messages rendered per second, the longest the Tk main loop went without getting round
+# to a timer due every 5 ms (i.e. how long the window stopped responding), and the lines left in the window. Tk is
+# imported here rather than with the other modules, so that the other benchmarks (and loadgen.py, which imports this
+# module) run where Tk isn't installed.
+def render_messages(batched: bool, messages: int, scrollback: int) -> tuple:
+    import tkinter as tk
+    import chatview
+    root = tk.Tk()
+    text = tk.Text(root, wrap=tk.WORD)
+    text.pack()
+    view = chatview.ChatView(root, text, scrollback=scrollback) if batched else None
+    timer = {'last': time.perf_counter(), 'stall': 0.0}
+
+    def display(message: str) -> None:     # What GUI.display used to do for every message
+        text.config(state=tk.NORMAL)
+        text.insert(tk.END, message + '\n')
+        text.config(state=tk.DISABLED)
+        text.see(tk.END)
+
+    def produce() -> None:
+        for number in range(messages):
+            message = 'user{}> {}{}'.format(number % 100, BENCH_PREFIX, number)
+            if view is not None:
+                view.post(message)
+            else:
+                display(message)
+
+    def tick() -> None:
+        now = time.perf_counter()
+        timer['stall'] = max(timer['stall'], now - timer['last'])
+        timer['last'] = now
+        root.after(5, tick)
+
+    def finish() -> None:
+        if view.rendered == messages if view is not None else not producer.is_alive():
+            root.quit()
+        else:
+            root.after(5, finish)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    root.after(5, tick)
+    root.after(5, finish)
+    started = time.perf_counter()
+    producer.start()
+    root.mainloop()
+    elapsed = time.perf_counter() - started
+    lines = int(text.index('end-1c').split('.')[0]) - 1
+    root.destroy()
+    return messages / elapsed, timer['stall'], lines
+
+
+def benchmark_render(arguments: argparse.Namespace) -> None:
+    try:
+        import tkinter as tk
+        import chatview
+    except ImportError as err:
+        print('The render benchmark needs Tk. (Error: {}.)'.format(str(err)))
+        return
+    scrollback = arguments.scrollback if arguments.scrollback is not None else chatview.SCROLLBACK_LINES
+    print('{:<10} {:>9} {:>11} {:>16} {:>7}'.format('rendering', 'messages', 'rendered/s', 'max stall (ms)', 'lines'))
+    for batched in (False, True):
+        try:
+            rate, stall, lines = render_messages(batched, arguments.messages, scrollback)
+        except tk.TclError as err:
+            print('The render benchmark needs a display. (Error: {}.)'.format(str(err)))
+            return
+        print('{:<10} {:>9} {:>11.0f} {:>16.1f} {:>7}'.format('batched' if batched else 'direct', arguments.messages,
+                                                              rate, stall * 1000, lines))
+
+
+# ------------------------------------------------- Client Benchmark ------------------------------------------------- #
+
+# Messages per second one client sends through the server, timed until every one has come back to it: with a thread
+# started to send each message (as client.py's window used to), or queued on a chatclient.Connection or
+# AsyncConnection, whose single writer pipelines whatever has queued up.
+def client_send_rate(port: int, style: str, messages: int) -> float:
+    if style == 'async':
+        return asyncio.run(async_client_send_rate(port, messages))
+    connection = chatclient.Connection(style).connect(HOST_NAME, port)
+    started = time.perf_counter()
+    for number in range(messages):
+        message = '{}{}'.format(BENCH_PREFIX, number)
+        if style == 'thread-per-message':
+            threading.Thread(target=connection.sock.sendall, args=(connection.encode(message),)).start()
+        else:
+            connection.send(message)
+    echoed = 0
+    for frame in connection:
+        echoed += BENCH_PREFIX in frame.message
+        if echoed == messages:
+            break
+    elapsed = time.perf_counter() - started
+    connection.close()
+    return messages / elapsed
+
+
+async def async_client_send_rate(port: int, messages: int) -> float:
+    connection = await chatclient.AsyncConnection('async').connect(HOST_NAME, port)
+    started = time.perf_counter()
+    for number in range(messages):
+        await connection.send('{}{}'.format(BENCH_PREFIX, number))
+    echoed = 0
+    async for frame in connection:
+        echoed += BENCH_PREFIX in frame.message
+        if echoed == messages:
+            break
+    elapsed = time.perf_counter() - started
+    await connection.close()
+    return messages / elapsed
+
+
+def benchmark_client(arguments: argparse.Namespace) -> None:
+    print('{:<20} {:>9} {:>10}'.format('sending', 'messages', 'messages/s'))
+    server = start_server(arguments.port, ['--engine', arguments.engine, '--quiet', '--queue-size',
+                                           str(arguments.messages + 100)] + UNLIMITED)
+    try:
+        for style in ('thread-per-message', 'pipelined', 'async'):
+            rate = client_send_rate(arguments.port, style, arguments.messages)
+            print('{:<20} {:>9} {:>10.0f}'.format(style, arguments.messages, rate))
+    finally:
+        stop_server(server)
+
+
+# ------------------------------------------------ Commands Benchmark ------------------------------------------------ #
+
+# Stands in for a server's client, every command doing nothing, so only finding the command and checking and splitting
+# its arguments is timed.
+class CommandClient:
+    def __init__(self) -> None:
+        self.handled = 0
+        self.errors = 0
+
+    def handle(self, *arguments) -> None:
+        self.handled += 1
+
+    def param_error_handle(self, command: str) -> None:
+        self.errors += 1
+
+    change_username = list_users = watch_presence = whisper = help = leave = join_room = part_room = list_rooms = \
+        history = search = handle
+
+
+# The if/elif chain the server used before the command table, splitting every command at each space (and timing it,
+# as the server did).
+def chain_dispatch(client: CommandClient, message: str, timed) -> None:
+    started = time.perf_counter()
+    words = message.split(' ')
+    if words[0] == '/rename':
+        if len(words) != 2:
+            client.param_error_handle('/rename')
+        else:
+            client.change_username(words[1])
+    elif words[0] == '/users':
+        if len(words) > 2:
+            client.param_error_handle('/users')
+        else:
+            client.list_users(words[1] if len(words) == 2 else '')
+    elif words[0] == '/presence':
+        if len(words) != 2 or words[1] not in ('on', 'off'):
+            client.param_error_handle('/presence')
+        else:
+            client.watch_presence(words[1])
+    elif words[0] == '/whisper':
+        if len(words) < 3:
+            client.param_error_handle('/whisper')
+        else:
+            client.whisper(words[1], ' '.join(words[2:]))
+    elif words[0] == '/help':
+        if len(words) == 2:
+            client.help(words[1])
+        elif len(words) == 1:
+            client.help('')
+        else:
+            client.param_error_handle('/help')
+    elif words[0] == '/leave':
+        if len(words) > 1:
+            client.param_error_handle('/leave')
+        else:
+            client.leave()
+    elif words[0] == '/join':
+        if len(words) != 2:
+            client.param_error_handle('/join')
+        else:
+            client.join_room(words[1])
+    elif words[0] == '/part':
+        if len(words) > 1:
+            client.param_error_handle('/part')
+        else:
+            client.part_room()
+    elif words[0] == '/rooms':
+        if len(words) > 1:
+            client.param_error_handle('/rooms')
+        else:
+            client.list_rooms()
+    elif words[0] == '/history':
+        if len(words) > 2:
+            client.param_error_handle('/history')
+        else:
+            client.history(words[1] if len(words) == 2 else '')
+    elif words[0] == '/search':
+        if len(words) not in (2, 3):
+            client.param_error_handle('/search')
+        else:
+            client.search(words[1], words[2] if len(words) == 3 else '')
+    else:
+        client.param_error_handle(words[0])
+    timed(words[0], time.perf_counter() - started)
+
+
+# The server's commands, with the same arities, in a command table.
+def command_table() -> commands.CommandTable:
+    table = commands.CommandTable()
+    for name, arity in (('/rename', dict(min_args=1, max_args=1)), ('/users', dict(max_args=1)),
+                        ('/presence', dict(min_args=1, max_args=1, choices=('on', 'off'))),
+                        ('/whisper', dict(min_args=2, max_args=2, rest=True)), ('/help', dict(max_args=1)),
+                        ('/leave', {}), ('/join', dict(min_args=1, max_args=1)), ('/part', {}), ('/rooms', {}),
+                        ('/history', dict(max_args=1)), ('/search', dict(min_args=1, max_args=2))):
+        table.add(commands.Command(name, CommandClient.handle, name, '', **arity))
+    return table
+
+
+def table_dispatch(table: commands.CommandTable, client: CommandClient, message: str) -> None:
+    started = table.start()
+    command, arguments = table.parse(message)
+    if command is None or arguments is None:
+        client.param_error_handle(message.partition(' ')[0])
+    else:
+        command.handler(client, *arguments)
+    table.timed(command, started)
+
+
+# Commands handled per second by the if/elif chain and by the command table (which also times each command, as the
+# server does, and without timing hooks, as it is when nothing is timed), for commands early and late in the chain,
+# invalid ones, and whispers of a few words and of many.
+def benchmark_commands(arguments: argparse.Namespace) -> None:
+    table = command_table()
+    untimed_table = command_table()
+    times = collections.Counter()   # Stands in for the histograms the server keeps
+
+    def timed(name: str, seconds: float) -> None:
+        times[name] += seconds
+
+    table.add_timing_hook(timed)
+    long_whisper = '/whisper bob ' + ' '.join(['word'] * arguments.words)
+    mixes = (('/rename', ['/rename alice']), ('/search', ['/search * 5']), ('invalid', ['/nope']),
+             ('whisper', ['/whisper bob hello there']), ('long whisper', [long_whisper]),
+             ('mixed', ['/users', '/whisper bob hi', '/join room', '/part', '/help /join', '/history 10', '/search *',
+                        '/rooms', '/presence on', '/nope', '/leave']))
+    print('{:<14} {:>16} {:>16} {:>8} {:>16}'.format('commands', 'chain (cmd/s)', 'table (cmd/s)', 'speedup',
+                                                     'untimed (cmd/s)'))
+    for name, messages in mixes:
+        client = CommandClient()
+        chain_client = CommandClient()
+        untimed_client = CommandClient()
+
+        def chain() -> None:
+            for message in messages:
+                chain_dispatch(chain_client, message, timed)
+
+        def dispatch() -> None:
+            for message in messages:
+                table_dispatch(table, client, message)
+
+        def dispatch_untimed() -> None:
+            for message in messages:
+                table_dispatch(untimed_table, untimed_client, message)
+
+        rates = [arguments.repeat * len(messages) / min(timeit.repeat(run, number=arguments.repeat, repeat=3))
+                 for run in (chain, dispatch, dispatch_untimed)]
+        assert (client.handled, client.errors) == (chain_client.handled, chain_client.errors)
+        print('{:<14} {:>16,.0f} {:>16,.0f} {:>7.2f}x {:>16,.0f}'.format(name, rates[0], rates[1], rates[1] / rates[0],
+                                                                        rates[2]))
+
+
+# ---------------------------------------------- Commencement -------------------------------------------------------- #
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmarks for the chat room server.')
+    benchmarks = parser.add_subparsers(dest='benchmark', required=True)
+
+    connections = benchmarks.add_parser('connections', help='Idle and active connections held by one server process.')
+    connections.add_argument('--port', type=int, default=12500)
+    connections.add_argument('--engine', choices=('threads', 'asyncio', 'both'), default='both')
+    connections.add_argument('--idle', type=int, default=1000, help='Connections that only receive.')
+    connections.add_argument('--active', type=int, default=20, help='Connections that also send messages.')
+    connections.add_argument('--rate', type=float, default=2, help='Messages per second per active connection.')
+    connections.add_argument('--duration', type=float, default=5, help='Seconds the active connections send for.')
+    connections.add_argument('--concurrency', type=int, default=100, help='Handshakes in flight at once.')
+    connections.set_defaults(run=benchmark_connections)
+
+    workers = benchmarks.add_parser('workers', help='Delivery rate with the server split over worker processes.')
+    workers.add_argument('--port', type=int, default=12500)
+    workers.add_argument('--engine', choices=('threads', 'asyncio'), default='asyncio')
+    workers.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='Worker counts to compare.')
+    workers.add_argument('--idle', type=int, default=1000, help='Connections that only receive.')
+    workers.add_argument('--active', type=int, default=50, help='Connections that also send messages.')
+    workers.add_argument('--rate', type=float, default=5, help='Messages per second per active connection.')
+    workers.add_argument('--duration', type=float, default=5, help='Seconds the active connections send for.')
+    workers.add_argument('--concurrency', type=int, default=100, help='Handshakes in flight at once.')
+    workers.add_argument('--saturate', type=int, default=0, metavar='WINDOW',
+                         help='Send closed-loop, with this many messages per active connection in flight, instead of '
+                              'at --rate, and report the peak delivery rate.')
+    workers.set_defaults(run=benchmark_workers)
+
+    nodes = benchmarks.add_parser('cluster', help='Delivery and /users across server nodes joined by a relay.')
+    nodes.add_argument('--port', type=int, default=12500, help='Port of the relay; the nodes take the ports after it.')
+    nodes.add_argument('--engine', choices=('threads', 'asyncio'), default='asyncio')
+    nodes.add_argument('--nodes', type=int, nargs='+', default=[1, 2, 3], help='Node counts to compare.')
+    nodes.add_argument('--users', type=int, default=100, help='Users connected to each node.')
+    nodes.add_argument('--active', type=int, default=20, help='Users that also send messages.')
+    nodes.add_argument('--rate', type=float, default=5, help='Messages per second per active user.')
+    nodes.add_argument('--duration', type=float, default=5, help='Seconds the active users send for.')
+    nodes.add_argument('--concurrency', type=int, default=100, help='Handshakes in flight at once.')
+    nodes.set_defaults(run=benchmark_cluster)
+
+    compression = benchmarks.add_parser('compression', help='Bandwidth saved by compression against its CPU cost.')
+    compression.add_argument('--users', type=int, default=10000, help='Users listed in the /users reply.')
+    compression.add_argument('--recipients', type=int, default=1000, help='Members of the room messages are sent to.')
+    compression.add_argument('--threshold', type=int, default=protocol.DEFAULT_COMPRESSION_THRESHOLD)
+    compression.add_argument('--level', type=int, default=protocol.COMPRESSION_LEVEL, help='zlib compression level.')
+    compression.add_argument('--repeat', type=int, default=200)
+    compression.set_defaults(run=benchmark_compression)
+
+    tls = benchmarks.add_parser('tls', help='Connection rate and message latency over plain TCP against TLS.')
+    tls.add_argument('--port', type=int, default=12500)
+    tls.add_argument('--engine', choices=('threads', 'asyncio', 'both'), default='both')
+    tls.add_argument('--connections', type=int, default=1000, help='Connections opened and closed in each run.')
+    tls.add_argument('--concurrency', type=int, default=8, help='Clients reconnecting at once.')
+    tls.add_argument('--messages', type=int, default=500, help='Messages timed over one connection.')
+    tls.add_argument('--openssl', default='openssl', help='The openssl command, used to make a test certificate.')
+    tls.set_defaults(run=benchmark_tls)
+
+    lookups = benchmarks.add_parser('registry', help='Whisper target lookup: client scan against the username index.')
+    lookups.add_argument('--users', type=int, default=10000)
+    lookups.add_argument('--repeat', type=int, default=20)
+    lookups.set_defaults(run=benchmark_registry)
+
+    listing = benchmarks.add_parser('presence', help='/users: the whole list against pages of the sorted index, and '
+                                    'presence updates pushed one by one against gathered.')
+    listing.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000])
+    listing.add_argument('--repeat', type=int, default=20)
+    listing.add_argument('--joins', type=int, default=10000, help='Users joining in the storm.')
+    listing.add_argument('--subscribers', type=int, default=100, help='Clients subscribed to presence updates.')
+    listing.set_defaults(run=benchmark_presence)
+
+    restart = benchmarks.add_parser('restart', help='Connections and messages lost across hot restarts of a busy '
+                                    'server, and the delivery stall they cause.')
+    restart.add_argument('--port', type=int, default=12500)
+    restart.add_argument('--engine', choices=('threads', 'asyncio', 'both'), default='both')
+    restart.add_argument('--users', type=int, default=200, help='Users connected (every one receives every message).')
+    restart.add_argument('--active', type=int, default=10, help='Users that also send messages.')
+    restart.add_argument('--rate', type=float, default=20, help='Messages per second per active user.')
+    restart.add_argument('--restarts', type=int, default=3)
+    restart.add_argument('--interval', type=float, default=2, help='Seconds between restarts.')
+    restart.add_argument('--concurrency', type=int, default=100, help='Handshakes in flight at once.')
+    restart.set_defaults(run=benchmark_restart)
+
+    render = benchmarks.add_parser('render', help='Messages per second rendered by the client\'s chat window, one at a '
+                                   'time from the receive thread against batched from the Tk main loop.')
+    render.add_argument('--messages', type=int, default=50000)
+    render.add_argument('--scrollback', type=int, default=None,
+                        help='Lines kept by the batched chat window (default: as many as the client keeps).')
+    render.set_defaults(run=benchmark_render)
+
+    sending = benchmarks.add_parser('client', help='Messages per second sent by one client: a thread per message '
+                                    'against the client library\'s pipelined connections.')
+    sending.add_argument('--port', type=int, default=12500)
+    sending.add_argument('--engine', choices=('threads', 'asyncio'), default='asyncio')
+    sending.add_argument('--messages', type=int, default=20000)
+    sending.set_defaults(run=benchmark_client)
+
+    dispatching = benchmarks.add_parser('commands', help='Commands handled per second by the if/elif chain against '
+                                        'the command table.')
+    dispatching.add_argument('--repeat', type=int, default=20000)
+    dispatching.add_argument('--words', type=int, default=200, help='Words in the long whisper.')
+    dispatching.set_defaults(run=benchmark_commands)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    arguments.run(arguments)
@@ -0,0 +1,291 @@
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import os
+import socket
+import threading
+
+import fanout
+import presence
+import protocol
+from protocol import Frame
+
+
+# ---------------------------------------------- INITIALISATION ------------------------------------------------------ #
+
+QUEUE_SIZE = 100000                     # Bus messages that may wait to be written to one link
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024     # Longest bus message, in bytes (a new worker is sent every username in one)
+REQUEST_TIMEOUT = 10.0                  # Seconds a worker waits for the hub to answer a request
+
+
+# Raised in a worker when the hub does not answer a request (e.g. because it has gone).
+class BusError(RuntimeError):
+    pass
+
+
+# ------------------------------------------------------ Links ------------------------------------------------------- #
+
+# Bus messages are JSON objects, each sent as the body of a v2 frame, so the bus reuses the chat protocol's framing.
+def encode(message: dict) -> bytes:
+    return Frame(json.dumps(message, separators=(',', ':'))).encode(protocol.V2)
+
+
+# One end of the Unix socket between the hub and a worker. Messages are written by a ThreadedOutbound and read by a
+# thread of their own, which passes each one to on_message, and calls on_close once the other end has gone. Under the
+# backpressure policy (the hub's), sending waits on the other process if it falls far behind; under the disconnect
+# policy (a worker's, whose messages may be sent from its event loop), sending never waits, and the link is dropped.
+class Link:
+    def __init__(self, sock: socket.socket, on_message, on_close, policy: str = fanout.BACKPRESSURE) -> None:
+        self.sock = sock
+        self.on_message = on_message
+        self.on_close = on_close
+        self.outbound = fanout.ThreadedOutbound(sock, QUEUE_SIZE, policy, held=True)
+        self.decoder = protocol.FrameDecoder(protocol.V2, MAX_MESSAGE_SIZE)
+        self.reader_thread = threading.Thread(target=self._read, name='bus-reader', daemon=True)
+        self.reader_thread.start()
+
+    def send(self, message: dict) -> bool:
+        return self.outbound.put(encode(message))
+
+    def close(self) -> None:
+        self.outbound.close()
+
+    def _read(self) -> None:
+        try:
+            while True:
+                for frame in self.decoder.frames():
+                    self.on_message(self, json.loads(frame.message))
+                if not self.decoder.recv_into(self.sock):
+                    break
+        except (OSError, ValueError):
+            pass
+        self.outbound.close()
+        self.outbound.release()
+        self.on_close(self)
+
+
+# ------------------------------------------------------- Hub -------------------------------------------------------- #
+
+# The hub side of the bus, run by the parent process of the workers. It holds the directory of every connected user
+# (the worker they are connected to and the room they are in), which makes it the single authority on which usernames
+# are taken, and relays broadcasts and whispers between the workers. Every change to who is online is pushed to every
+# worker, each of which keeps its own sorted copy of the list for /users. Every message is handled by the reader thread
+# of the link it arrived on; the directory is guarded by a lock.
+class Hub:
+    def __init__(self, path: str, log, message_store=None) -> None:
+        self.path = path
+        self.log = log
+        self.message_store = message_store
+        self.lock = threading.Lock()
+        self.links = {}         # Worker number -> Link
+        self.workers = {}       # Link -> worker number
+        self.directory = {}     # Username -> [worker number, room]
+        self.closed = threading.Event()     # Set once every worker has disconnected
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+        threading.Thread(target=self._accept, name='bus-accept', daemon=True).start()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            Link(sock, self._handle, self._closed)
+
+    def _closed(self, link: Link) -> None:
+        with self.lock:
+            worker = self.workers.pop(link, None)
+            self.links.pop(worker, None)
+            gone = [name for name, (owner, _) in self.directory.items() if owner == worker]
+            for username in gone:
+                del self.directory[username]
+            if not self.links:
+                self.closed.set()
+        if gone:
+            self._relay({'op': 'presence', 'changes': [[presence.LEFT, username] for username in gone]})
+        if worker is not None:
+            self.log('[BUS] Worker {} disconnected from the bus.'.format(worker))
+
+    # Send a message to every worker other than the one given.
+    def _relay(self, message: dict, exclude: int = None) -> None:
+        with self.lock:
+            links = [link for worker, link in self.links.items() if worker != exclude]
+        for link in links:
+            link.send(message)
+
+    # Send a console command to the workers: /kick only to the worker the user is connected to, anything else to all.
+    def console(self, line: str) -> None:
+        words = line.split(' ')
+        if words[0] == '/kick' and len(words) > 1:
+            with self.lock:
+                entry = self.directory.get(words[1])
+                link = self.links.get(entry[0]) if entry else None
+            if link is None:
+                self.log('[ERROR] Kick failed as the user was not found.')
+            else:
+                link.send({'op': 'console', 'line': line})
+        else:
+            self._relay({'op': 'console', 'line': line})
+
+    def close(self) -> None:
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _handle(self, link: Link, message: dict) -> None:
+        op = message['op']
+        worker = self.workers.get(link)
+        reply = None
+        if op == 'hello':
+            with self.lock:     # The worker is sent every user online, before any change to them
+                self.links[message['worker']] = link
+                self.workers[link] = message['worker']
+                link.send({'op': 'presence', 'changes': [[presence.JOINED, username] for username in self.directory]})
+            self.log('[BUS] Worker {} connected to the bus.'.format(message['worker']))
+        elif op == 'claim':
+            with self.lock:
+                ok = message['username'] not in self.directory
+                if ok:
+                    self.directory[message['username']] = [worker, message['room']]
+            reply = {'ok': ok}
+            if ok:
+                self._relay({'op': 'presence', 'changes': [[presence.JOINED, message['username']]]})
+        elif op == 'rename':
+            with self.lock:
+                ok = message['new'] not in self.directory and message['old'] in self.directory
+                if ok:
+                    self.directory[message['new']] = self.directory.pop(message['old'])
+            reply = {'ok': ok}
+            if ok:
+                self._relay({'op': 'presence', 'changes': [[presence.RENAMED, message['old'], message['new']]]})
+        elif op == 'move':
+            with self.lock:
+                if message['username'] in self.directory:
+                    self.directory[message['username']][1] = message['room']
+        elif op == 'release':
+            with self.lock:
+                entry = self.directory.get(message['username'])
+                released = entry is not None and entry[0] == worker
+                if released:
+                    del self.directory[message['username']]
+            if released:
+                self._relay({'op': 'presence', 'changes': [[presence.LEFT, message['username']]]})
+        elif op == 'deliver':
+            self._relay(message, exclude=worker)
+        elif op == 'whisper':
+            with self.lock:
+                entry = self.directory.get(message['to'])
+                target = self.links.get(entry[0]) if entry else None
+            reply = {'ok': target is not None}
+            if target is not None:
+                target.send(message)
+        elif op == 'record':
+            if self.message_store is not None:
+                self.message_store.append(*message['event'])
+        elif op == 'rooms':
+            counts = {}
+            with self.lock:
+                for _, room in self.directory.values():
+                    counts[room] = counts.get(room, 0) + 1
+            reply = {'rooms': sorted(counts.items(), key=lambda c: (-c[1], c[0]))}
+        elif op == 'search':
+            if self.message_store is None:
+                reply = {'events': None}
+            else:
+                seen_by = tuple(message['visible_to']) if message['visible_to'] else None
+                events = self.message_store.query(message['user'], since=message['since'], limit=message['limit'],
+                                                  seen_by=seen_by)
+                reply = {'events': [list(event) for event in events]}
+        if reply is not None:
+            reply['op'] = 'reply'
+            reply['id'] = message['id']
+            link.send(reply)
+
+
+# ----------------------------------------------------- Worker ------------------------------------------------------- #
+
+# The worker side of the bus. request() sends a message and waits for the hub's answer to it, and request_async() awaits
+# it, without holding up the event loop; publish() only sends, and never waits either, as the worker's link drops (and
+# the worker shuts down) rather than wait for a hub that has fallen that far behind. Messages the hub sends of its own
+# accord (broadcasts and whispers from other workers, console commands) are passed to on_message, on the bus reader
+# thread.
+class Worker:
+    def __init__(self, path: str, number: int, on_message, on_close) -> None:
+        self.number = number
+        self.on_message = on_message
+        self.on_hub_close = on_close
+        self.ids = itertools.count()
+        self.pending = {}       # Request id -> (op, concurrent.futures.Future of the reply)
+        self.lock = threading.Lock()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        self.link = Link(sock, self._handle, self._closed, fanout.DISCONNECT)
+        self.publish('hello', worker=number)
+
+    def publish(self, op: str, **fields) -> None:
+        fields['op'] = op
+        self.link.send(fields)
+
+    # Send a request; returns a future of the hub's answer, which fails with BusError if the hub goes first.
+    def submit(self, op: str, **fields) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        with self.lock:
+            fields['id'] = next(self.ids)
+            self.pending[fields['id']] = (op, future)
+        fields['op'] = op
+        if not self.link.send(fields):
+            self._forget(fields['id'])
+            future.set_exception(BusError('The hub went away before answering the {} request.'.format(op)))
+        return future
+
+    def request(self, op: str, **fields) -> dict:
+        future = self.submit(op, **fields)
+        try:
+            return future.result(REQUEST_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            self._forget(fields['id'])
+            raise BusError('The hub did not answer the {} request.'.format(op))
+
+    async def request_async(self, op: str, **fields) -> dict:
+        future = self.submit(op, **fields)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._forget(fields['id'])
+            raise BusError('The hub did not answer the {} request.'.format(op))
+
+    def close(self) -> None:
+        self.link.close()
+
+    def _forget(self, request_id: int) -> None:
+        with self.lock:
+            self.pending.pop(request_id, None)
+
+    def _handle(self, link: Link, message: dict) -> None:
+        if message['op'] == 'reply':
+            with self.lock:
+                _, future = self.pending.pop(message['id'], (None, None))
+            if future is not None and not future.cancelled():
+                try:
+                    future.set_result(message)
+                except concurrent.futures.InvalidStateError:    # Timed out (and cancelled) just now
+                    pass
+        else:
+            self.on_message(message)
+
+    def _closed(self, link: Link) -> None:
+        with self.lock:
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for op, future in pending:      # Their requests fail rather than wait out the timeout
+            try:
+                future.set_exception(BusError('The hub went away before answering the {} request.'.format(op)))
+            except concurrent.futures.InvalidStateError:
+                pass
+        self.on_hub_close()
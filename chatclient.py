@@ -0,0 +1,315 @@
+import asyncio
+import collections
+import socket
+import ssl
+
+import fanout
+import protocol
+from protocol import Frame
+
+
+# ---------------------------------------------- INITIALISATION ------------------------------------------------------ #
+
+MAX_FRAME_SIZE = protocol.DEFAULT_MAX_FRAME_SIZE    # Longest v2 frame sent (the server's default limit)
+QUEUE_SIZE = 1000           # Frames that may wait to be written before send() waits for the writer
+CONNECT_TIMEOUT = 10.0      # Seconds connecting (including the TLS and username handshakes) may take
+CLOSE_TIMEOUT = 5.0         # Seconds closing may wait for the frames still queued to be written
+QUIET_KINDS = (protocol.PING, protocol.PONG)    # Frames the connection deals with itself, never returned by receive()
+CLOSING_KINDS = (protocol.LEAVE, protocol.END, protocol.USERNAME_IN_USE)   # Frames after which the server disconnects
+
+
+# Raised by connect() when the server turns the username down.
+class UsernameInUse(ConnectionError):
+    pass
+
+
+# Stands in for the SSLContext given to asyncio, which has no way of resuming a TLS session, passing the session on
+# when the context is asked for the connection's TLS object; anything else is left to the context itself.
+class ResumingContext:
+    def __init__(self, context: ssl.SSLContext, session: ssl.SSLSession) -> None:
+        self.context = context
+        self.session = session
+
+    def wrap_bio(self, incoming: ssl.MemoryBIO, outgoing: ssl.MemoryBIO, server_side: bool = False,
+                 server_hostname: str = None) -> ssl.SSLObject:
+        return self.context.wrap_bio(incoming, outgoing, server_side, server_hostname, session=self.session)
+
+    def __getattr__(self, name: str):
+        return getattr(self.context, name)
+
+
+# The text shown for a frame received from the server.
+def describe(frame: Frame) -> str:
+    if frame.kind == protocol.LEAVE:
+        return 'You have left the server.'
+    if frame.kind == protocol.END:
+        return 'The server has forced your disconnection.'
+    return frame.message
+
+
+# ---------------------------------------------------- Connection ---------------------------------------------------- #
+
+# What the two kinds of connection share: the username handshake, in which the framing (and compression) the server
+# offers is accepted, the encoding of messages in that framing, and the answers made to the server's control frames.
+# A connection may be connected again once it has closed; over TLS, it then resumes the session of its last connection
+# (if connecting with the same context), which skips the costly part of the handshake.
+class BaseConnection:
+    def __init__(self, username: str, queue_size: int = QUEUE_SIZE) -> None:
+        self.username = username
+        self.queue_size = queue_size
+        self.tls_session = None     # (context, ssl.SSLSession) of the last TLS connection, to be resumed
+        self._reset()
+
+    # Start afresh, for a new connection.
+    def _reset(self) -> None:
+        self.decoder = protocol.FrameDecoder(max_frame_size=MAX_FRAME_SIZE)
+        self.version = protocol.V1          # Framing version; switches to v2 if the server offers it
+        self.compression_threshold = 0      # Set if the server offers compression too
+        self.pending = collections.deque()  # Frames read during the handshake, to be returned by receive()
+        self.closed = False                 # Set once either side has ended the connection
+
+    # The session to resume when connecting with a TLS context, if any.
+    def _session(self, tls_context: ssl.SSLContext) -> ssl.SSLSession or None:
+        if self.tls_session is not None and self.tls_session[0] is tls_context:
+            return self.tls_session[1]
+        return None
+
+    # The reply to the server's username request, which accepts v2 framing and compression if they were offered.
+    def _username_reply(self, request: Frame) -> bytes:
+        if request.kind != protocol.GET_USERNAME:
+            raise ConnectionError('The server did not ask for a username.')
+        reply = protocol.encode_v1(self.username.encode(protocol.FORMAT), offer_v2=self.decoder.v2_offered,
+                                   offer_compression=self.decoder.compression_offered)
+        # The offers are left out of the header if there is no room for them (a long username), in which case the
+        # server carries on with v1 framing (or without compression)
+        _, v2_accepted, compression_accepted = protocol.parse_v1_header(reply[:protocol.HEADER_LENGTH])
+        if v2_accepted:
+            self.version = self.decoder.version = protocol.V2
+            if compression_accepted:
+                self.compression_threshold = protocol.DEFAULT_COMPRESSION_THRESHOLD
+        return reply
+
+    # Check the server's answer to the username.
+    def _admitted(self, answer: Frame) -> None:
+        if answer.kind == protocol.USERNAME_IN_USE:
+            raise UsernameInUse('The username {} is already in use.'.format(self.username))
+        self.pending.append(answer)     # The welcome message
+
+    def encode(self, message: str or Frame) -> bytes:
+        if not isinstance(message, Frame):
+            message = Frame(message)
+        if self.version == protocol.V2 and len(message) > MAX_FRAME_SIZE:
+            raise protocol.FrameTooLarge('A {} byte frame is over the {} byte limit.'.format(len(message),
+                                                                                             MAX_FRAME_SIZE))
+        return message.encode(self.version, self.compression_threshold)
+
+    # What the connection itself sends back for a frame from the server (a PONG for a PING, or an END to acknowledge
+    # being disconnected), if anything.
+    def _answer(self, frame: Frame) -> bytes or None:
+        if frame.kind in CLOSING_KINDS:
+            self.closed = True
+        if frame.kind == protocol.PING:
+            return Frame.control(protocol.PONG).encode(self.version)
+        if frame.kind == protocol.END:
+            return Frame.control(protocol.END).encode(self.version)
+        return None
+
+
+# A connection used from threads. Sending only queues the encoded frame, which a single writer thread (a
+# fanout.ThreadedOutbound) writes, coalescing whatever has queued up into one system call, so a burst of messages is
+# pipelined rather than sent one round of locking and writing at a time; send() only waits if the queue is full.
+# receive() blocks until the next frame arrives, and is meant to be called from one thread.
+#
+#     with Connection('alice').connect(host, port) as connection:
+#         connection.send('Hello!')
+#         for frame in connection:
+#             print(frame.message)
+class Connection(BaseConnection):
+    def __init__(self, username: str, queue_size: int = QUEUE_SIZE) -> None:
+        super().__init__(username, queue_size)
+        self.sock = None
+        self.outbound = None
+
+    # Connect and complete the username handshake; raises UsernameInUse if the username is taken, or OSError.
+    def connect(self, host: str, port: int, tls_context: ssl.SSLContext = None,
+                timeout: float = CONNECT_TIMEOUT) -> 'Connection':
+        self._reset()
+        sock = socket.create_connection((host, port), timeout)
+        try:
+            if tls_context is not None:
+                sock = tls_context.wrap_socket(sock, server_hostname=host, session=self._session(tls_context))
+            self.sock = sock
+            sock.sendall(self._username_reply(self._read()))
+            self._admitted(self._read())
+        except BaseException:
+            sock.close()
+            raise
+        if tls_context is not None:     # TLS 1.3 session tickets have arrived by the time the server has answered
+            self.tls_session = (tls_context, sock.session)
+        sock.settimeout(None)
+        self.outbound = fanout.ThreadedOutbound(sock, self.queue_size, fanout.BACKPRESSURE)
+        return self
+
+    def _read(self) -> Frame:
+        frame = self.decoder.next_frame()
+        while frame is None:
+            if not self.decoder.recv_into(self.sock):
+                raise ConnectionError('The server closed the connection.')
+            frame = self.decoder.next_frame()
+        return frame
+
+    # Queue a message (or a Frame) to be sent; raises protocol.FrameTooLarge if it is too long, or ConnectionError if
+    # the connection has closed.
+    def send(self, message: str or Frame) -> None:
+        if not self.outbound.put(self.encode(message)):
+            raise ConnectionError('The connection is closed.')
+
+    # The next frame from the server (including control frames such as LEAVE and END, after which the server
+    # disconnects), or None once the connection has closed.
+    def receive(self) -> Frame or None:
+        while True:
+            try:
+                frame = self.pending.popleft() if self.pending else self._read()
+            except OSError:     # Including the server closing the connection
+                self.closed = True
+                self.outbound.close()
+                return None
+            answer = self._answer(frame)
+            if answer is not None:
+                self.outbound.put(answer)
+            if frame.kind not in QUIET_KINDS:
+                return frame
+
+    # Leave (unless the server has already ended the connection), and close once everything queued has been sent.
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.outbound.put(Frame.control(protocol.END).encode(self.version))
+        self.outbound.close()
+        self.outbound.writer_thread.join(CLOSE_TIMEOUT)
+
+    def __iter__(self):
+        frame = self.receive()
+        while frame is not None:
+            yield frame
+            frame = self.receive()
+
+    def __enter__(self) -> 'Connection':
+        return self
+
+    def __exit__(self, *exception) -> None:
+        self.close()
+
+
+# A connection used from asyncio. send() puts the encoded frame on a bounded queue, waiting only while the queue is
+# full, and a single writer task takes everything queued each time it runs, writing it with one write and one drain.
+#
+#     connection = AsyncConnection('alice')
+#     await connection.connect(host, port)
+#     await connection.send('Hello!')
+#     async for frame in connection:
+#         print(frame.message)
+class AsyncConnection(BaseConnection):
+    def __init__(self, username: str, queue_size: int = QUEUE_SIZE) -> None:
+        super().__init__(username, queue_size)
+        self.reader = None
+        self.writer = None
+        self.outbound = None    # asyncio.Queue of encoded frames, ended by None
+        self.writer_task = None
+
+    # Coroutine counterpart of Connection.connect.
+    async def connect(self, host: str, port: int, tls_context: ssl.SSLContext = None,
+                      timeout: float = CONNECT_TIMEOUT) -> 'AsyncConnection':
+        self._reset()
+        session = self._session(tls_context)
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ResumingContext(tls_context, session) if session else tls_context,
+                                    server_hostname=host if tls_context else None),
+            timeout)
+        try:
+            await asyncio.wait_for(self._handshake(), timeout)
+        except BaseException:
+            self.writer.close()
+            raise
+        if tls_context is not None:
+            self.tls_session = (tls_context, self.writer.get_extra_info('ssl_object').session)
+        self.outbound = asyncio.Queue(self.queue_size)
+        self.writer_task = asyncio.create_task(self._write())
+        return self
+
+    async def _handshake(self) -> None:
+        self.writer.write(self._username_reply(await self._read()))
+        self._admitted(await self._read())
+
+    async def _read(self) -> Frame:
+        frame = self.decoder.next_frame()
+        while frame is None:
+            data = await self.reader.read(self.decoder.chunk_size)
+            if not data:
+                raise ConnectionError('The server closed the connection.')
+            self.decoder.feed(data)
+            frame = self.decoder.next_frame()
+        return frame
+
+    async def _write(self) -> None:
+        try:
+            running = True
+            while running:
+                batch = [await self.outbound.get()]
+                while not self.outbound.empty():
+                    batch.append(self.outbound.get_nowait())
+                running = batch[-1] is not None
+                self.writer.write(b''.join(data for data in batch if data is not None))
+                await self.writer.drain()
+        except ConnectionError:
+            pass
+        self.writer.close()
+
+    # Coroutine counterpart of Connection.send.
+    async def send(self, message: str or Frame) -> None:
+        data = self.encode(message)
+        if self.writer_task.done():
+            raise ConnectionError('The connection is closed.')
+        await self.outbound.put(data)
+
+    # Coroutine counterpart of Connection.receive.
+    async def receive(self) -> Frame or None:
+        while True:
+            try:
+                frame = self.pending.popleft() if self.pending else await self._read()
+            except OSError:
+                self.closed = True
+                await self._stop_writer()
+                return None
+            answer = self._answer(frame)
+            if answer is not None and not self.writer_task.done():
+                await self.outbound.put(answer)
+            if frame.kind not in QUIET_KINDS:
+                return frame
+
+    async def _stop_writer(self) -> None:
+        if not self.writer_task.done():
+            await self.outbound.put(None)
+            await self.writer_task
+
+    # Coroutine counterpart of Connection.close.
+    async def close(self) -> None:
+        if not self.closed and not self.writer_task.done():
+            self.closed = True
+            await self.outbound.put(Frame.control(protocol.END).encode(self.version))
+        await self._stop_writer()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Frame:
+        frame = await self.receive()
+        if frame is None:
+            raise StopAsyncIteration
+        return frame
+
+    async def __aenter__(self) -> 'AsyncConnection':
+        return self
+
+    async def __aexit__(self, *exception) -> None:
+        await self.close()
@@ -0,0 +1,152 @@
+import queue
+import threading
+import tkinter as tk
+
+import chatclient
+import protocol
+
+
+# ---------------------------------------------- INITIALISATION ------------------------------------------------------ #
+
+RENDER_INTERVAL = 50        # Milliseconds between renders of the messages received
+RENDER_BATCH = 1000         # Most messages rendered at once; a bigger backlog is worked through over several renders
+SCROLLBACK_LINES = 5000     # Lines kept in the chat window, beyond which the oldest are trimmed
+
+
+# ---------------------------------------------------- Chat View ----------------------------------------------------- #
+
+# The messages shown in a chat window (a tk.Text). Messages may be posted from any thread, such as the one receiving
+# them from the server, but the widget is only ever touched by the Tk main loop: posted messages wait in a queue, which
+# a timer drains every RENDER_INTERVAL ms, inserting everything received since the last render in one go. A busy room
+# therefore costs one insert (and at most one scroll) per interval rather than per message, and the window keeps only
+# the newest SCROLLBACK_LINES lines, so it neither slows down nor grows without bound however long it is left open.
+class ChatView:
+    def __init__(self, root: tk.Tk, text: tk.Text, interval: int = RENDER_INTERVAL, batch: int = RENDER_BATCH,
+                 scrollback: int = SCROLLBACK_LINES) -> None:
+        self.root = root
+        self.text = text
+        self.interval = interval
+        self.batch = batch
+        self.scrollback = scrollback
+        self.pending = queue.SimpleQueue()  # Messages posted but not yet rendered
+        self.rendered = 0                   # Messages rendered so far
+        self.root.after(self.interval, self.render)
+
+    # Queue a message to be shown; safe to call from any thread.
+    def post(self, message: str) -> None:
+        self.pending.put(message)
+
+    # Show the messages posted since the last render, then schedule the next one (straight away, if a backlog is left).
+    def render(self) -> None:
+        messages = []
+        try:
+            while len(messages) < self.batch:
+                messages.append(self.pending.get_nowait())
+        except queue.Empty:
+            pass
+        if messages:
+            self.show(messages)
+        self.root.after(1 if len(messages) == self.batch else self.interval, self.render)
+
+    # Append messages to the window, trimming the oldest lines beyond the scrollback, and keep the newest in view unless
+    # the user has scrolled up to read earlier ones.
+    def show(self, messages: list) -> None:
+        following = self.text.yview()[1] >= 1.0
+        self.text.config(state=tk.NORMAL)
+        self.text.insert(tk.END, '\n'.join(messages) + '\n')
+        excess = self.lines() - self.scrollback
+        if excess > 0:
+            self.text.delete('1.0', '{}.0'.format(excess + 1))
+        self.text.config(state=tk.DISABLED)
+        if following:
+            self.text.see(tk.END)
+        self.rendered += len(messages)
+
+    # The number of lines in the window (not counting the empty one after the last newline).
+    def lines(self) -> int:
+        return int(self.text.index('end-1c').split('.')[0]) - 1
+
+
+# ------------------------------------- GUI Setup, with read/write methods ------------------------------------------- #
+
+# The chat window, a thin layer over a chatclient.Connection: typed messages are queued on the connection (whose own
+# writer thread sends them), and a single thread receives messages and posts them to the chat view.
+class GUI:
+    def __init__(self, connection: chatclient.Connection, address: str) -> None:
+        self.connection = connection
+
+        # Initialise tkinter instance
+        self.root = tk.Tk()
+        self.root.title('Chat Room')
+        self.root.resizable(width=True, height=True)
+        self.root.minsize(width=350, height=420)
+        self.root.maxsize(width=1000, height=800)
+        self.root.configure(width=700, height=500, bg='#ABB2B9')
+
+        # A header that displays the server address, with a line beneath to separate
+        self.head = tk.Label(self.root, bg='#17202A', fg='#EAECEE', pady=5, text=address)
+        self.head.place(relwidth=1)
+        self.line = tk.Label(self.root, width=450, bg="#ABB2B9")
+        self.line.place(relwidth=1, rely=0.07, relheight=0.012)
+
+        # The chat area (received messages)
+        self.chat_window = tk.Text(self.root, width=25, height=2, bg="#17202A", fg="#EAECEE",
+                                   font="Helvetica 14",  padx=5, pady=5, wrap=tk.WORD)
+        self.chat_window.place(relheight=0.75, relwidth=1, rely=0.07)
+        self.view = ChatView(self.root, self.chat_window)     # Renders the messages received, in batches
+
+        # The message area (sending messages) and an input prompt
+        self.message_window = tk.Label(self.root, bg='#ABB2B9', fg='white', height=80, text="WRITE MESSAGE HERE")
+        self.message_window.place(relwidth=1, rely=0.8)
+        self.input_prompt = tk.Label(self.message_window, bg='#ABB2B9', fg='#17202A',
+                                     font=('Arial', 12), text='Input your message here:')
+        self.input_prompt.place(relwidth=0.5, relheight=0.02, rely=0.004, relx=0.1)
+        self.entry_message = tk.Entry(self.message_window, bg='black', fg='white')
+        self.entry_message.place(relwidth=0.74, relheight=0.038, rely=0.028, relx=0.011)
+        self.entry_message.focus()
+
+        # "Write" button
+        self.send_button = tk.Button(self.message_window, text='Write', bg='blue', activebackground='light blue',
+                                     width=20, font=('Arial', 16),  height=5,
+                                     command=lambda: self.send(self.entry_message.get()))
+        self.send_button.place(relx=0.77, rely=0.006, relheight=0.06, relwidth=0.22)
+        self.root.bind('<Return>', self.enter)
+
+        # Begin receiving messages
+        receive_thread = threading.Thread(target=self.receive, daemon=True)
+        receive_thread.start()
+
+        # Finalise initialisation
+        self.root.mainloop()
+
+    # Allow "enter" to be used for writing messages
+    def enter(self, event=None) -> None:
+        self.send(self.entry_message.get())
+
+    # Function for writing messages, which will then be sent to the server and back to the clients. Sending only queues
+    # the message, so the window never waits on the network.
+    def send(self, message: str) -> None:
+        if len(message) != 0:
+            self.entry_message.delete(0, tk.END)
+            try:
+                self.connection.send(message)
+            except protocol.FrameTooLarge:
+                self.display('Your message is too long to send to this server; it was not sent.')
+            except OSError:
+                self.display('You are no longer connected to the server.')
+
+    # Function for displaying a message in the chat window. It is called by the receive thread, so the message is only
+    # queued here; the chat view renders it from the Tk main loop (Tk widgets are not thread-safe).
+    def display(self, message: str) -> None:
+        self.view.post(message)
+
+    # Function for receiving messages from the server until it ends the connection.
+    def receive(self) -> None:
+        try:
+            for frame in self.connection:
+                message = chatclient.describe(frame)
+                if frame.kind in chatclient.CLOSING_KINDS:
+                    message += ' Please close the window.'
+                self.display(message)
+        except Exception as e:
+            self.display('Something unexpected went wrong, connection closing. (Error: {}.)'.format(str(e)))
@@ -1,211 +1,147 @@
-import socket
+import argparse
+import asyncio
+import ssl
 import sys
 import threading
-import tkinter as tk
 
+import chatclient
+import protocol
 
-# ------------------------------------------------ Initialisation ---------------------------------------------------- #
 
-try:
-    USER_NAME = str(sys.argv[1])
-    HOST_NAME = str(sys.argv[2])
-    PORT = int(sys.argv[3])
-except Exception as err:
-    print('Couldn\'t start client! Ensure the username, hostname, and port are included respectively when starting the'
-          ' client. (Error: {}.)'.format(str(err)))
-    sys.exit(1)
+# ------------------------------------------------ Initialisation ---------------------------------------------------- #
 
-ADDRESS = (HOST_NAME, PORT)
-HEADER_LENGTH = 4
-FORMAT = 'utf-8'
 DISCONNECT_MESSAGE = '/leave'
-DISCONNECT = 'LEAVE'
-MAKE_EXIT = 'END'
-USER_NAME_GET = 'GET_USERNAME'
-USER_NAME_USED = 'USERNAME_IN_USE'
-
-try:
-    clientSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-except (socket.error, Exception) as err:
-    print('Error occurred whilst attempting to create the client socket. (Error: {})'.format(str(err)))
-    sys.exit(1)
+RECONNECT_ATTEMPTS = 5      # Times the terminal client tries to connect again once its connection has been lost...
+RECONNECT_DELAY = 1.0       # ... this many seconds apart
 
 
-# ------------------------------------- GUI Setup, with read/write methods ------------------------------------------- #
-
-class GUI:
-    def __init__(self) -> None:
-        self.message = None
-        self.username = None
-
-        # Initialise tkinter instance
-        self.root = tk.Tk()
-        self.root.title('Chat Room')
-        self.root.resizable(width=True, height=True)
-        self.root.minsize(width=350, height=420)
-        self.root.maxsize(width=1000, height=800)
-        self.root.configure(width=700, height=500, bg='#ABB2B9')
-
-        # A header that displays the server address, with a line beneath to separate
-        self.head = tk.Label(self.root, bg='#17202A', fg='#EAECEE', pady=5, text='{}:{}'.format(HOST_NAME, PORT))
-        self.head.place(relwidth=1)
-        self.line = tk.Label(self.root, width=450, bg="#ABB2B9")
-        self.line.place(relwidth=1, rely=0.07, relheight=0.012)
-
-        # The chat area (received messages)
-        self.chat_window = tk.Text(self.root, width=25, height=2, bg="#17202A", fg="#EAECEE",
-                                   font="Helvetica 14",  padx=5, pady=5, wrap=tk.WORD)
-        self.chat_window.place(relheight=0.75, relwidth=1, rely=0.07)
-
-        # The message area (sending messages) and an input prompt
-        self.message_window = tk.Label(self.root, bg='#ABB2B9', fg='white', height=80, text="WRITE MESSAGE HERE")
-        self.message_window.place(relwidth=1, rely=0.8)
-        self.input_prompt = tk.Label(self.message_window, bg='#ABB2B9', fg='#17202A',
-                                     font=('Arial', 12), text='Input your message here:')
-        self.input_prompt.place(relwidth=0.5, relheight=0.02, rely=0.004, relx=0.1)
-        self.entry_message = tk.Entry(self.message_window, bg='black', fg='white')
-        self.entry_message.place(relwidth=0.74, relheight=0.038, rely=0.028, relx=0.011)
-        self.entry_message.focus()
-
-        # "Write" button
-        self.send_button = tk.Button(self.message_window, text='Write', bg='blue', activebackground='light blue',
-                                     width=20, font=('Arial', 16),  height=5,
-                                     command=lambda: self.send(self.entry_message.get()))
-        self.send_button.place(relx=0.77, rely=0.006, relheight=0.06, relwidth=0.22)
-        self.root.bind('<Return>', self.enter)
-
-        # Begin receiving messages
-        receive_thread = threading.Thread(target=self.receive)
-        receive_thread.start()
-
-        # Finalise initialisation
-        self.root.mainloop()
-
-    # Allow "enter" to be used for writing messages
-    def enter(self, event=None) -> None:
-        self.send(self.entry_message.get())
-
-    # Function to begin the thread for writing messages
-    def send(self, message: str) -> None:
-        if len(message) != 0:
-            self.chat_window.config(state=tk.DISABLED)
-            self.message = message
-            self.entry_message.delete(0, tk.END)
-            write_thread = threading.Thread(target=self.write)
-            write_thread.start()
-
-    # Function for displaying a message in the chat window
-    def display(self, message: str) -> None:
-        self.chat_window.config(state=tk.NORMAL)
-        self.chat_window.insert(tk.END, message + "\n")
-        self.chat_window.config(state=tk.DISABLED)
-        self.chat_window.see(tk.END)
-
-    # Function for examining and handling messages received by the server
-    def query_received_message(self, message: str) -> bool:
-        connected = True
-        if message == USER_NAME_GET:
-            username = USER_NAME.encode(FORMAT)
-            username_header = "{username_length:<{header_length}}" \
-                .format(username_length=len(username), header_length=HEADER_LENGTH).encode(FORMAT)
-            clientSocket.send(username_header + username)
-        elif message == USER_NAME_USED:
-            self.display('The username {} is already in use! '
-                         'Please close the window then try again with a new one.'.format(USER_NAME))
-            connected = False
-        elif message == DISCONNECT:
-            self.display('You have left the server. Please close the window.')
-            connected = False
-        elif message == MAKE_EXIT:
-            ext = MAKE_EXIT.encode(FORMAT)
-            ext_header = "{exit_length:<{header_length}}" \
-                .format(exit_length=len(ext),
-                        header_length=HEADER_LENGTH).encode(FORMAT)
-            clientSocket.send(ext_header + ext)
-            self.display('The server has forced your disconnection. Please close the window.')
-            connected = False
-        else:
-            self.display(message)
-        return connected
-
-    # Function for receiving messages from the server, these could indicate commands or could broadcast messages.
-    def receive(self) -> None:
-        connected = True
-        while connected:
-            try:
-                message_header = clientSocket.recv(HEADER_LENGTH)
-                if len(message_header):
-                    message_length = int(message_header.decode(FORMAT).strip())
-                    message = clientSocket.recv(message_length).decode(FORMAT)
-                    connected = self.query_received_message(message)
-            except WindowsError:
-                connected = False
-            except Exception as e:
-                print('An error occurred! (Error: {})'.format(str(e)))
-                connected = False
-        clientSocket.close()
-        sys.exit(0)
-
-    # Function for writing messages which will then be sent to the server and back to the clients.
-    def write(self) -> None:
-        self.chat_window.config(state=tk.DISABLED)
-        connected = True
-        while connected:
-            try:
-                message = self.message
-                if message == DISCONNECT_MESSAGE:
-                    connected = False
-                encode_and_send(message)
-                break
-            except WindowsError:
-                self.display('You are no longer connected to the server.')
-                connected = False
-            except Exception as e:
-                self.display('Something unexpected went wrong, connection closing. (Error: {}.)'.format(str(e)))
-                clientSocket.close()
-                sys.exit(1)
-        if not connected:
-            sys.exit(0)
+# ------------------------------------------------ Functions --------------------------------------------------------- #
 
+# The TLS settings of the client: the server's certificate must be signed by (or be) one in the given file.
+def create_tls_context(ca_file: str) -> ssl.SSLContext:
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_verify_locations(ca_file)
+    return context
 
-# ------------------------------------------------ Functions --------------------------------------------------------- #
 
-def encode_and_send(message: str) -> None:
-    encoded_message = message.encode(FORMAT)
-    message_header = "{encoded_length:<{header_length}}"\
-        .format(encoded_length=len(encoded_message), header_length=HEADER_LENGTH).encode(FORMAT)
-    clientSocket.send(message_header + encoded_message)
+def connection_failed(arguments: argparse.Namespace, error: Exception) -> None:
+    if isinstance(error, chatclient.UsernameInUse):
+        print('The username {} is already in use! Please try again with a new one.'.format(arguments.username))
+    else:
+        print('Couldn\'t start client! Could not connect to the address {}:{}. '
+              'Try a different hostname or port. (Error: {}.)'.format(arguments.hostname, arguments.port, str(error)))
+    sys.exit(1)
 
 
-def start_client() -> None:
+def start_client(arguments: argparse.Namespace, tls_context: ssl.SSLContext or None) -> None:
+    import chatview     # Only the window needs Tk, so the terminal client runs where it isn't installed
     try:
-        clientSocket.connect(ADDRESS)
-    except (socket.gaierror, Exception) as e:
-        print('Couldn\'t start client! Could not connect to the address {}:{}. '
-              'Try a different hostname or port. (Error: {}.)'.format(HOST_NAME, PORT, str(e)))
-        sys.exit(1)
+        connection = chatclient.Connection(arguments.username).connect(arguments.hostname, arguments.port,
+                                                                       tls_context)
+    except OSError as e:    # Including UsernameInUse
+        connection_failed(arguments, e)
     print('The client has begun in a separate window.')
-    interface = GUI()
-    if interface:   # Will only run when the GUI is closed
-        print('Client closed.')
-        try:        # If the GUI was closed without typing /leave
-            encode_and_send(MAKE_EXIT)
-        except WindowsError:     # Will except if /leave had been typed (so the client had "officially" left)
-            print('You left the server.')
-            sys.exit(0)
+    chatview.GUI(connection, '{}:{}'.format(arguments.hostname, arguments.port))
+    print('Client closed.')     # Only reached once the window is closed
+    if connection.closed:   # /leave had been typed (so the client had "officially" left), or the server ended it
+        print('You left the server.')
+    else:
         print('You have forcefully left the server.')
-        clientSocket.close()
-        sys.exit(0)
+    connection.close()
+
+
+# Connect again once the connection has been lost (rather than ended by either side), resuming its TLS session if it had
+# one; returns False if every attempt failed.
+async def reconnect(arguments: argparse.Namespace, connection: chatclient.AsyncConnection,
+                    tls_context: ssl.SSLContext or None) -> bool:
+    for attempt in range(1, RECONNECT_ATTEMPTS + 1):
+        print('The connection was lost; reconnecting (attempt {} of {})...'.format(attempt, RECONNECT_ATTEMPTS),
+              flush=True)
+        await asyncio.sleep(RECONNECT_DELAY)
+        try:
+            await connection.connect(arguments.hostname, arguments.port, tls_context)
+            return True
+        except OSError:     # Including UsernameInUse, as the server may not have noticed the old connection go yet
+            pass
+    print('Could not reconnect to the server.')
+    return False
+
+
+# The client without a window: lines typed into the terminal (or piped in) are sent, and messages received are printed
+# until the server ends the connection (a lost connection is reconnected). Input is read by one thread of its own, as
+# reading it would block the event loop; the end of the input leaves the server (as /leave does, so the replies to
+# everything sent are printed first).
+async def run_terminal(arguments: argparse.Namespace, tls_context: ssl.SSLContext or None) -> None:
+    connection = chatclient.AsyncConnection(arguments.username)
+    try:
+        await connection.connect(arguments.hostname, arguments.port, tls_context)
+    except OSError as e:
+        connection_failed(arguments, e)
+    loop = asyncio.get_running_loop()
+    lines = asyncio.Queue()
+
+    def read_input() -> None:
+        try:
+            for line in sys.stdin:
+                loop.call_soon_threadsafe(lines.put_nowait, line.rstrip('\n'))
+            loop.call_soon_threadsafe(lines.put_nowait, None)
+        except RuntimeError:    # The event loop has closed
+            pass
+
+    async def write() -> None:
+        line = await lines.get()
+        while line is not None:
+            if line:
+                try:
+                    await connection.send(line)
+                except protocol.FrameTooLarge:
+                    print('Your message is too long to send to this server; it was not sent.')
+                except ConnectionError:
+                    print('You are not connected to the server; your message was not sent.')
+            line = await lines.get()
+        try:
+            await connection.send(DISCONNECT_MESSAGE)
+        except ConnectionError:     # Already gone, so there is nothing to leave
+            pass
+
+    threading.Thread(target=read_input, daemon=True).start()
+    writer = asyncio.create_task(write())
+    running = True
+    while running:
+        ended = False
+        async for frame in connection:
+            print(chatclient.describe(frame), flush=True)
+            ended = ended or frame.kind in chatclient.CLOSING_KINDS
+        running = not ended and not writer.done() and await reconnect(arguments, connection, tls_context)
+    writer.cancel()
+    await connection.close()
 
 
 # ---------------------------------------------- Commencement -------------------------------------------------------- #
 
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Connects to a chat room server.')
+    parser.add_argument('username')
+    parser.add_argument('hostname')
+    parser.add_argument('port', type=int)
+    parser.add_argument('ca_file', nargs='?',
+                        help='Connect with TLS, trusting the certificates in this PEM file.')
+    parser.add_argument('--terminal', action='store_true',
+                        help='Chat in the terminal (one message per line) instead of a window.')
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
+    arguments = parse_arguments()
     try:
-        start_client()
+        tls_context = create_tls_context(arguments.ca_file) if arguments.ca_file else None
+        if arguments.terminal:
+            asyncio.run(run_terminal(arguments, tls_context))
+        else:
+            start_client(arguments, tls_context)
     except KeyboardInterrupt:
         print("Keyboard Interrupt detected! Disconnecting from server...")
-        clientSocket.close()
     except Exception as err:
         print("Unexpected error: {}".format(str(err)))
     sys.exit(0)
@@ -0,0 +1,441 @@
+import abc
+import argparse
+import collections
+import itertools
+import queue
+import socket
+import sys
+import threading
+import time
+
+import bus
+import presence
+
+
+# ---------------------------------------------- INITIALISATION ------------------------------------------------------ #
+
+DEFAULT_RELAY_PORT = 12400
+RECONNECT_DELAY = 1.0       # Seconds between attempts to reach the relay
+RECONNECT_ATTEMPTS = 30     # Attempts to reach the relay made before giving up on it
+RESEND_WINDOW = 10000       # Most messages kept to be sent again after reconnecting to the relay
+RESEND_SECONDS = 2.0        # Messages sent this long before the relay was lost are sent again, as they may not have
+                            # got through (along with those published while it was unreachable)
+DEDUPLICATION_WINDOW = 100000       # Message ids remembered, so a message sent again is only acted on once
+
+GONE = 'gone'               # Published on behalf of a node that has left the cluster
+
+
+# Raised when a node can't reach the relay it was started with.
+class ClusterError(RuntimeError):
+    pass
+
+
+# ------------------------------------------------- Pub/Sub Backends ------------------------------------------------- #
+
+# What a cluster node needs from the link between the nodes: every message published by one node is passed to every
+# other node. Backends may deliver a message more than once (nodes discard repeats by id) but never back to its sender.
+# on_connect is called each time the backend (re)connects, so the node can announce itself, and on_close if it gives up
+# on the link for good; on_message is called on a thread of the backend's own.
+class PubSub(abc.ABC):
+    @abc.abstractmethod
+    def start(self, node: str, on_message, on_connect, on_close) -> None:
+        pass
+
+    @abc.abstractmethod
+    def publish(self, message: dict) -> None:
+        pass
+
+    @abc.abstractmethod
+    def close(self) -> None:
+        pass
+
+
+# The in-process stand-in for a relay, for running several nodes in one process (as test_cluster.py does). Each node's
+# messages are delivered by a thread of its own, as they would be by a network. While held, messages are kept back
+# until released, as a slow network might, so that nodes can be made to act at the same moment.
+class LocalBroker:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.members = []
+        self.held = None    # Messages kept back while held, as (recipients, message)
+
+    def connect(self) -> 'LocalPubSub':
+        return LocalPubSub(self)
+
+    def hold(self) -> None:
+        with self.lock:
+            if self.held is None:
+                self.held = []
+
+    def release(self) -> None:
+        with self.lock:
+            held, self.held = self.held or [], None
+        for members, message in held:
+            for member in members:
+                member.inbox.put(message)
+
+    def _publish(self, sender: 'LocalPubSub', message: dict) -> None:
+        with self.lock:
+            members = [member for member in self.members if member is not sender]
+            if self.held is not None:
+                self.held.append((members, message))
+                return
+        for member in members:
+            member.inbox.put(message)
+
+
+class LocalPubSub(PubSub):
+    def __init__(self, broker: LocalBroker) -> None:
+        self.broker = broker
+        self.node = None
+        self.inbox = queue.SimpleQueue()
+
+    def start(self, node: str, on_message, on_connect, on_close) -> None:
+        self.node = node
+        with self.broker.lock:
+            self.broker.members.append(self)
+        threading.Thread(target=self._deliver, args=(on_message,), name='pubsub-local', daemon=True).start()
+        on_connect()
+
+    def _deliver(self, on_message) -> None:
+        message = self.inbox.get()
+        while message is not None:
+            on_message(message)
+            message = self.inbox.get()
+
+    def publish(self, message: dict) -> None:
+        self.broker._publish(self, message)
+
+    def close(self) -> None:
+        with self.broker.lock:
+            if self in self.broker.members:
+                self.broker.members.remove(self)
+        self.broker._publish(self, {'op': GONE, 'node': self.node, 'id': '{}:gone'.format(self.node)})
+        self.inbox.put(None)
+
+
+# A connection to a TCP relay (see Relay), carrying bus messages. If the relay goes away it is reconnected to, and the
+# messages sent just before it went, or while it was away, are sent again, since some of them may not have got through.
+# Reaching the relay is given up on after RECONNECT_ATTEMPTS attempts: at the start, by raising ClusterError, and once
+# running, by calling on_close.
+class RelayPubSub(PubSub):
+    def __init__(self, host: str, port: int) -> None:
+        self.address = (host, port)
+        self.lock = threading.Lock()
+        self.link = None
+        self.sent = collections.deque(maxlen=RESEND_WINDOW)     # (time, message) of the most recent messages
+        self.lost_time = None   # When the connection to the relay was lost
+        self.closed = False
+        self.node = None
+        self.on_message = None
+        self.on_connect = None
+        self.on_close = None
+
+    def start(self, node: str, on_message, on_connect, on_close) -> None:
+        self.node = node
+        self.on_message = on_message
+        self.on_connect = on_connect
+        self.on_close = on_close
+        if not self._connect():
+            raise ClusterError('Could not reach the relay at {}:{}.'.format(*self.address))
+
+    # Connect to the relay; returns False if it could not be reached in RECONNECT_ATTEMPTS attempts.
+    def _connect(self) -> bool:
+        for attempt in range(RECONNECT_ATTEMPTS):
+            if self.closed:
+                return True
+            if attempt:
+                time.sleep(RECONNECT_DELAY)
+            try:
+                sock = socket.create_connection(self.address)
+            except OSError:
+                continue
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                self.link = bus.Link(sock, lambda link, message: self.on_message(message), self._lost)
+                self.link.send({'op': 'hello', 'node': self.node})
+                if self.lost_time is not None:
+                    for sent_time, message in self.sent:
+                        if sent_time >= self.lost_time - RESEND_SECONDS:
+                            self.link.send(message)
+            self.on_connect()
+            return True
+        return False
+
+    def _lost(self, link: bus.Link) -> None:
+        with self.lock:
+            self.link = None
+            self.lost_time = time.monotonic()
+        if not self.closed:
+            threading.Thread(target=self._reconnect, name='pubsub-reconnect', daemon=True).start()
+
+    def _reconnect(self) -> None:
+        if not self._connect():
+            self.on_close()
+
+    def publish(self, message: dict) -> None:
+        with self.lock:
+            self.sent.append((time.monotonic(), message))
+            if self.link is not None:
+                self.link.send(message)
+
+    def close(self) -> None:
+        self.closed = True
+        with self.lock:
+            if self.link is not None:
+                self.link.close()
+
+
+# ------------------------------------------------------ Relay ------------------------------------------------------- #
+
+# The TCP relay between the nodes of a cluster: passes every message it receives on to every other connected node, and
+# tells the others when a node disconnects. It holds no state beyond the connections.
+class Relay:
+    def __init__(self, host: str, port: int, log=print) -> None:
+        self.log = log
+        self.lock = threading.Lock()
+        self.nodes = {}     # Link -> node name (None until the node says hello)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen()
+
+    def serve_forever(self) -> None:
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            link = bus.Link(sock, self._handle, self._closed)
+            with self.lock:
+                self.nodes.setdefault(link, None)
+
+    def _handle(self, link: bus.Link, message: dict) -> None:
+        if message['op'] == 'hello':
+            with self.lock:
+                self.nodes[link] = message['node']
+            self.log('[RELAY] Node {} joined the cluster.'.format(message['node']))
+        else:
+            self._forward(link, message)
+
+    def _forward(self, sender: bus.Link, message: dict) -> None:
+        with self.lock:
+            links = [link for link in self.nodes if link is not sender]
+        for link in links:
+            link.send(message)
+
+    def _closed(self, link: bus.Link) -> None:
+        with self.lock:
+            node = self.nodes.pop(link, None)
+        if node is not None:
+            self.log('[RELAY] Node {} left the cluster.'.format(node))
+            self._forward(link, {'op': GONE, 'node': node, 'id': '{}:gone:{}'.format(node, time.time())})
+
+    def close(self) -> None:
+        self.listener.close()
+
+
+# ------------------------------------------------------ Nodes ------------------------------------------------------- #
+
+# A server's membership of a cluster. It answers the same requests as a worker's link to its hub (see bus.Worker), so
+# the server uses either in the same way: here the directory of users is replicated on every node, each node
+# publishing the changes to its own users (joins, renames, room moves and leaves) for the others to apply. Usernames
+# are checked against the whole directory; if two nodes admit the same name at the same moment, the node whose name
+# sorts first keeps its user, and the other is told (through on_message) to evict its own. Broadcasts and whispers are
+# published for the other nodes to deliver, each under an id that is remembered, so that none is delivered twice.
+# Every change to who is online, on this node or another, is passed to on_message as a presence message.
+class ClusterNode:
+    def __init__(self, node: str, pubsub: PubSub, on_message, message_store=None, log=print, on_close=None) -> None:
+        self.node = node
+        self.pubsub = pubsub
+        self.on_message = on_message
+        self.on_close = on_close    # Called if the node is cut off from the cluster for good
+        self.message_store = message_store
+        self.log = log
+        self.lock = threading.Lock()
+        self.directory = {}     # Username -> [node name, room]
+        self.sequence = itertools.count()
+        self.seen = set()
+        self.seen_order = collections.deque()
+        pubsub.start(node, self._receive, self._announce, self._cut_off)
+
+    # ---------------------------------------------- Requests ------------------------------------------------------- #
+
+    def publish(self, op: str, **fields) -> None:
+        if op == 'move':
+            with self.lock:
+                if fields['username'] in self.directory:
+                    self.directory[fields['username']][1] = fields['room']
+        elif op == 'release':
+            with self.lock:
+                entry = self.directory.get(fields['username'])
+                if entry is None or entry[0] != self.node:    # Not one of ours (e.g. evicted)
+                    return
+                del self.directory[fields['username']]
+            self._changed([presence.LEFT, fields['username']])
+        self._send(op, **fields)
+
+    def request(self, op: str, **fields) -> dict:
+        if op == 'claim':
+            with self.lock:
+                ok = fields['username'] not in self.directory
+                if ok:
+                    self.directory[fields['username']] = [self.node, fields['room']]
+            if ok:
+                self._changed([presence.JOINED, fields['username']])
+                self._send('claim', **fields)
+            return {'ok': ok}
+        elif op == 'rename':
+            with self.lock:
+                ok = fields['new'] not in self.directory and fields['old'] in self.directory
+                if ok:
+                    self.directory[fields['new']] = self.directory.pop(fields['old'])
+                    fields['room'] = self.directory[fields['new']][1]
+            if ok:
+                self._changed([presence.RENAMED, fields['old'], fields['new']])
+                self._send('rename', **fields)
+            return {'ok': ok}
+        elif op == 'whisper':
+            with self.lock:
+                entry = self.directory.get(fields['to'])
+            if entry is None or entry[0] == self.node:
+                return {'ok': False}
+            self._send('whisper', node=entry[0], **fields)
+            return {'ok': True}
+        elif op == 'rooms':
+            counts = {}
+            with self.lock:
+                for _, room in self.directory.values():
+                    counts[room] = counts.get(room, 0) + 1
+            return {'rooms': sorted(counts.items(), key=lambda c: (-c[1], c[0]))}
+        elif op == 'search':    # Each node stores the messages of the whole cluster, so searches are answered locally
+            return {'events': None}
+        raise bus.BusError('Cluster nodes do not answer {} requests.'.format(op))
+
+    def close(self) -> None:
+        self.pubsub.close()
+
+    # Tell the server of users joining, leaving or renaming anywhere in the cluster.
+    def _changed(self, *changes: list) -> None:
+        if changes:
+            self.on_message({'op': 'presence', 'changes': list(changes)})
+
+    def _send(self, op: str, **fields) -> None:
+        fields['op'] = op
+        fields['origin'] = self.node
+        fields['id'] = '{}:{}'.format(self.node, next(self.sequence))
+        self.pubsub.publish(fields)
+
+    def _cut_off(self) -> None:
+        self.log('[CLUSTER] Gave up on reaching the other nodes after {} attempts.'.format(RECONNECT_ATTEMPTS))
+        if self.on_close is not None:
+            self.on_close()
+
+    # Tell the other nodes about this node's users, and ask for theirs; done whenever the pub/sub (re)connects.
+    def _announce(self) -> None:
+        with self.lock:
+            users = [[username, room] for username, (node, room) in self.directory.items() if node == self.node]
+        self._send('roster', users=users, reply=True)
+
+    # --------------------------------------------- Receiving ------------------------------------------------------- #
+
+    # Whether a message has been received before; remembers the ids of the most recent messages.
+    def _repeated(self, message_id: str) -> bool:
+        if message_id in self.seen:
+            return True
+        self.seen.add(message_id)
+        self.seen_order.append(message_id)
+        if len(self.seen_order) > DEDUPLICATION_WINDOW:
+            self.seen.discard(self.seen_order.popleft())
+        return False
+
+    # Add another node's user to the directory, settling a clash with a user of this node or of a third node by node
+    # name, so that every node keeps the same one whichever claim it hears of first; returns True if the username was
+    # not in the directory before.
+    def _add_remote(self, username: str, node: str, room: str) -> bool:
+        with self.lock:
+            entry = self.directory.get(username)
+            replace = entry is None or node <= entry[0]
+            evict = replace and entry is not None and entry[0] == self.node
+            if replace:
+                self.directory[username] = [node, room]
+        if evict:
+            self.on_message({'op': 'evict', 'username': username})
+        return entry is None
+
+    def _receive(self, message: dict) -> None:
+        op = message['op']
+        with self.lock:
+            if self._repeated(message['id']):
+                return
+        origin = message.get('origin', message.get('node'))
+        if op == 'roster':
+            self._changed(*[[presence.JOINED, username] for username, room in message['users']
+                            if self._add_remote(username, origin, room)])
+            if message['reply']:    # A node that has just connected: tell it about this node's users
+                with self.lock:
+                    users = [[name, room] for name, (node, room) in self.directory.items() if node == self.node]
+                self._send('roster', users=users, reply=False)
+        elif op == 'claim':
+            if self._add_remote(message['username'], origin, message['room']):
+                self._changed([presence.JOINED, message['username']])
+        elif op == 'rename':
+            with self.lock:
+                entry = self.directory.get(message['old'])
+                removed = entry is not None and entry[0] == origin
+                if removed:
+                    del self.directory[message['old']]
+            added = self._add_remote(message['new'], origin, message['room'])
+            if removed and added:
+                self._changed([presence.RENAMED, message['old'], message['new']])
+            elif removed:
+                self._changed([presence.LEFT, message['old']])
+            elif added:
+                self._changed([presence.JOINED, message['new']])
+        elif op == 'move':
+            with self.lock:
+                entry = self.directory.get(message['username'])
+                if entry is not None and entry[0] == origin:
+                    entry[1] = message['room']
+        elif op == 'release':
+            with self.lock:
+                entry = self.directory.get(message['username'])
+                removed = entry is not None and entry[0] == origin
+                if removed:
+                    del self.directory[message['username']]
+            if removed:
+                self._changed([presence.LEFT, message['username']])
+        elif op == GONE:
+            with self.lock:
+                gone = [name for name, (node, _) in self.directory.items() if node == message['node']]
+                for username in gone:
+                    del self.directory[username]
+            self._changed(*[[presence.LEFT, username] for username in gone])
+            self.log('[CLUSTER] Node {} left the cluster.'.format(message['node']))
+        elif op == 'record':
+            if self.message_store is not None:
+                self.message_store.append(*message['event'])
+        elif op == 'deliver' or op == 'whisper' and message['node'] == self.node:
+            self.on_message(message)
+
+
+# ---------------------------------------------- Commencement -------------------------------------------------------- #
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Runs the TCP relay between the server nodes of a cluster.')
+    parser.add_argument('port', type=int, nargs='?', default=DEFAULT_RELAY_PORT,
+                        help='The port to listen on (default: {}).'.format(DEFAULT_RELAY_PORT))
+    parser.add_argument('--host', default='127.0.0.1', help='The address to listen on (default: 127.0.0.1).')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    relay = Relay(arguments.host, arguments.port)
+    print('[RELAY] Listening on {}:{}.'.format(arguments.host, arguments.port))
+    sys.stdout.flush()
+    try:
+        relay.serve_forever()
+    except KeyboardInterrupt:
+        relay.close()
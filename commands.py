@@ -0,0 +1,104 @@
+import importlib
+import sys
+import time
+
+
+# ----------------------------------------------------- Commands ----------------------------------------------------- #
+
+# A command: its name (e.g. /join), the function carrying it out, called with the client and the command's arguments,
+# the usage and description shown by /help, and the arguments it takes: at least min_args and at most max_args of
+# them (max_args None for no limit), each one of choices if given. With rest set, the last argument is the rest of the
+# line, spaces included. Arguments are separated by single spaces, so a command is split no further than it needs to
+# be however long the line is. A blocking command may wait on another process (the hub of a server run as several
+# workers), so the asyncio engine carries it out on an executor thread rather than on the event loop.
+class Command:
+    def __init__(self, name: str, handler, usage: str, description: str, min_args: int = 0, max_args: int or None = 0,
+                 choices: tuple = None, rest: bool = False, blocking: bool = False) -> None:
+        self.name = name
+        self.handler = handler
+        self.usage = usage
+        self.description = description
+        self.min_args = min_args
+        self.max_args = max_args
+        self.choices = frozenset(choices) if choices is not None else None
+        self.rest = rest
+        self.blocking = blocking
+        # Most splits made of the arguments (one more than the last argument needs, unless it is the rest of the line,
+        # so that a line with too many arguments is caught), and the most arguments the line may then have
+        self.splits = -1 if max_args is None else max_args - 1 if rest else max_args
+        self.most = sys.maxsize if max_args is None else max_args
+
+    # The arguments given after the command's name, or None if they aren't ones the command takes.
+    def parse(self, text: str or None) -> list or None:
+        arguments = text.split(' ', self.splits) if text is not None else []    # None: not even a space after the name
+        if not self.min_args <= len(arguments) <= self.most:
+            return None
+        if self.choices is not None and not self.choices.issuperset(arguments):
+            return None
+        return arguments
+
+
+# Every command the server understands, by name, so a command is found with one dictionary lookup however many there
+# are. Commands are added with add(), or by decorating their function with register(), which is how plug-ins add
+# commands of their own (see load_plugin). Each command carried out is timed, and the time passed to every timing hook;
+# with no timing hooks, nothing is timed, and messages naming no command never are.
+#
+#     @table.register('/roll', '/roll [Sides (optional)]', 'Function: Rolls a die.', max_args=1)
+#     def roll(client, sides='6'):
+#         client.send('You rolled a {}.'.format(random.randint(1, int(sides))))
+class CommandTable:
+    def __init__(self) -> None:
+        self.commands = {}          # Name -> Command, in the order they were added (the order /help lists them in)
+        self.timing_hooks = []      # Functions called with the name of each command carried out and the seconds taken
+
+    def add(self, command: Command) -> Command:
+        if command.name in self.commands:
+            raise ValueError('The command {} already exists.'.format(command.name))
+        self.commands[command.name] = command
+        return command
+
+    def register(self, name: str, usage: str, description: str, **arity):
+        def decorator(handler):
+            self.add(Command(name, handler, usage, description, **arity))
+            return handler
+        return decorator
+
+    def add_timing_hook(self, hook) -> None:
+        self.timing_hooks.append(hook)
+
+    def get(self, name: str) -> Command or None:
+        return self.commands.get(name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.commands
+
+    def __iter__(self):
+        return iter(self.commands)
+
+    # The command a message names and its arguments: (None, None) if it names no command, or (command, None) if the
+    # arguments aren't ones the command takes.
+    def parse(self, message: str) -> tuple:
+        name, space, text = message.partition(' ')
+        command = self.commands.get(name)
+        if command is None:
+            return None, None
+        return command, command.parse(text if space else None)
+
+    # The time a command is started at, to be passed to timed() once it is done; None if there are no timing hooks.
+    def start(self) -> float or None:
+        return time.perf_counter() if self.timing_hooks else None
+
+    # Pass the time taken by a command (None if the message named no command, which isn't timed) to the timing hooks.
+    def timed(self, command: Command or None, started: float or None) -> None:
+        if command is None or started is None:
+            return
+        seconds = time.perf_counter() - started
+        for hook in self.timing_hooks:
+            hook(command.name, seconds)
+
+
+# Load a plug-in: a module (on the import path) with a register_commands function, which is called with the table to
+# add its commands to.
+def load_plugin(table: CommandTable, module_name: str) -> None:
+    module = importlib.import_module(module_name)
+    module.register_commands(table)
@@ -0,0 +1,325 @@
+import asyncio
+import collections
+import socket
+import threading
+
+
+# ---------------------------------------------- INITIALISATION ------------------------------------------------------ #
+
+# What happens when a message is queued for a client whose outbound queue is already full.
+DROP_OLDEST = 'drop-oldest'     # Discard the oldest queued frame to make room
+DISCONNECT = 'disconnect'       # Disconnect the slow client
+BACKPRESSURE = 'backpressure'   # Make the senders wait until the slow client catches up
+POLICIES = (DROP_OLDEST, DISCONNECT, BACKPRESSURE)
+
+DEFAULT_QUEUE_SIZE = 1000       # Frames
+BACKPRESSURE_TIMEOUT = 5.0      # Seconds a client may hold back the senders before it is treated as dead
+
+
+# ------------------------------------------------- Outbound Queues -------------------------------------------------- #
+
+# A bounded queue of encoded frames waiting to be written to one client. Frames are only ever written by the queue's
+# own writer, so one slow or stalled reader never holds up the thread that produced the message. Subclasses supply the
+# writer for each server engine.
+class OutboundQueue:
+    def __init__(self, max_frames: int, policy: str, on_overflow) -> None:
+        self.frames = collections.deque()
+        self.max_frames = max_frames
+        self.policy = policy
+        self.on_overflow = on_overflow  # Called (with no arguments) when the disconnect policy drops the client
+        self.closed = False
+        self.paused = False             # While paused, frames are queued but not written (see pause())
+
+        # Counters
+        self.high_water = 0
+        self.enqueued = 0
+        self.dropped = 0
+        self.sent_bytes = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self.frames)
+
+    def _append(self, data: bytes) -> None:
+        self.frames.append(data)
+        self.enqueued += 1
+        if len(self.frames) > self.high_water:
+            self.high_water = len(self.frames)
+
+    def _drop_oldest(self) -> None:
+        self.frames.popleft()
+        self.dropped += 1
+
+    # The frames queued but not yet written, e.g. to be handed over to another process while the queue is paused.
+    def unsent(self) -> list:
+        return list(self.frames)
+
+    # Take every queued frame as a single buffer, so a backlog is written with one system call.
+    def _take_batch(self) -> bytes:
+        batch = b''.join(self.frames) if len(self.frames) > 1 else self.frames[0]
+        self.frames.clear()
+        return batch
+
+
+# Outbound queue of the threads engine: a dedicated writer thread sends the queued frames with blocking sendall calls.
+# Given held, the thread reading from the socket holds it open until it calls release(): the socket is only closed once
+# neither thread uses it, as a descriptor closed under a thread still reading from it may be reused by a new connection,
+# whose first bytes that thread would then take.
+class ThreadedOutbound(OutboundQueue):
+    def __init__(self, client_socket: socket.socket, max_frames: int = DEFAULT_QUEUE_SIZE, policy: str = DISCONNECT,
+                 on_overflow=None, held: bool = False) -> None:
+        super().__init__(max_frames, policy, on_overflow)
+        self.client_socket = client_socket
+        self.condition = threading.Condition()
+        self.writing = False        # Whether the writer is part way through sending a batch
+        self.held = held            # Whether the reader holds the socket open
+        self.finished = False       # Whether the writer has finished with the socket
+        self.writer_thread = threading.Thread(target=self._write, daemon=True)
+        self.writer_thread.start()
+
+    # Queue a frame; returns False if the frame could not be queued (the client has gone).
+    def put(self, data: bytes) -> bool:
+        overflowed = False
+        with self.condition:
+            if self.closed:
+                return False
+            if len(self.frames) >= self.max_frames:
+                if self.policy == DROP_OLDEST:
+                    self._drop_oldest()
+                elif self.policy == BACKPRESSURE:
+                    if not self.condition.wait_for(lambda: self.closed or len(self.frames) < self.max_frames,
+                                                   BACKPRESSURE_TIMEOUT):
+                        overflowed = True
+                    elif self.closed:
+                        return False
+                else:
+                    overflowed = True
+            if not overflowed:
+                self._append(data)
+                self.condition.notify_all()
+            if overflowed:
+                self.dropped += 1
+        if overflowed:
+            self.close(flush=False)
+            if self.on_overflow:
+                self.on_overflow()
+            return False
+        return True
+
+    # Stop writing (frames are still queued) once the batch being sent, if any, has been sent; returns False if that
+    # takes longer than the timeout (e.g. because the client has stalled).
+    def pause(self, timeout: float = None) -> bool:
+        with self.condition:
+            self.paused = True
+            return self.condition.wait_for(lambda: not self.writing, timeout)
+
+    def resume(self) -> None:
+        with self.condition:
+            self.paused = False
+            self.condition.notify_all()
+
+    # Stop accepting frames. When flushing, the writer sends what is already queued before closing the socket;
+    # otherwise the socket is shut down straight away, which also releases a writer stuck on a stalled client.
+    def close(self, flush: bool = True) -> None:
+        with self.condition:
+            if self.closed and flush:
+                return
+            self.closed = True
+            if not flush:
+                self.frames.clear()
+                try:
+                    self.client_socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self.condition.notify_all()
+
+    def _write(self) -> None:
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or self.frames and not self.paused)
+                if not self.frames:     # Closed, and everything queued has been sent
+                    break
+                batch = self._take_batch()
+                self.writing = True
+                self.condition.notify_all()     # Wake any senders waiting for room
+            try:
+                self.client_socket.sendall(batch)
+                self.sent_bytes += len(batch)
+            except OSError:
+                with self.condition:
+                    self.closed = True
+                    self.writing = False
+                    self.frames.clear()
+                    self.condition.notify_all()
+                break
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()     # Wake pause(), if it is waiting for the batch to be sent
+        try:    # Closing alone neither ends the connection nor wakes a thread blocked reading from it
+            self.client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        with self.condition:
+            self.finished = True
+            last = not self.held
+        if last:
+            self.client_socket.close()
+
+    # Called by the reader once it has stopped reading from the socket (see held).
+    def release(self) -> None:
+        with self.condition:
+            self.held = False
+            last = self.finished
+        if last:
+            self.client_socket.close()
+
+
+# Pauses reading from every client of the asyncio engine while any outbound queue is over its limit under the
+# backpressure policy, so that senders slow down to the pace of the slowest reader.
+class IngressGate:
+    def __init__(self) -> None:
+        self.saturated = set()
+        self.open = None
+
+    def _event(self) -> asyncio.Event:
+        if self.open is None:
+            self.open = asyncio.Event()
+            self.open.set()
+        return self.open
+
+    def hold(self, queue: OutboundQueue) -> None:
+        self.saturated.add(queue)
+        self._event().clear()
+
+    def release(self, queue: OutboundQueue) -> None:
+        self.saturated.discard(queue)
+        if not self.saturated:
+            self._event().set()
+
+    async def wait(self) -> None:
+        if self.saturated:
+            await self._event().wait()
+
+
+ingress_gate = IngressGate()
+
+
+# Outbound queue of the asyncio engine: a writer task per client moves queued frames into the stream, waiting for the
+# transport to drain before taking more. Frames may be queued from other threads too: the queue itself is guarded by a
+# lock, so put() tells any thread whether its frame was queued, and only waking the writer is handed to the event loop.
+# Under the backpressure policy a full queue pauses reading from every client (see IngressGate) rather than blocking the
+# sender; frames still arriving for it (e.g. from other threads) are rejected until it has room again.
+class AsyncOutbound(OutboundQueue):
+    def __init__(self, writer: asyncio.StreamWriter, max_frames: int = DEFAULT_QUEUE_SIZE, policy: str = DISCONNECT,
+                 on_overflow=None) -> None:
+        super().__init__(max_frames, policy, on_overflow)
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.lock = threading.Lock()
+        self.ready = asyncio.Event()
+        self.stall_timer = None
+        self.writer_task = self.loop.create_task(self._write())
+
+    def _in_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    # Run a callback on the event loop: straight away if called from it, otherwise as soon as the loop gets to it.
+    def _call(self, callback, *args) -> None:
+        if self._in_loop():
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    # Queue a frame; returns False if the frame could not be queued (the client has gone, or is being held back).
+    def put(self, data: bytes) -> bool:
+        with self.lock:
+            if self.closed:
+                return False
+            if len(self.frames) >= self.max_frames:
+                if self.policy == DROP_OLDEST:
+                    self._drop_oldest()
+                else:
+                    self.dropped += 1
+                    if self.policy == BACKPRESSURE:
+                        self._call(self._hold)
+                    else:
+                        self.closed = True
+                        self._call(self._overflow)
+                    return False
+            self._append(data)
+        self._call(self.ready.set)
+        return True
+
+    # Stop writing (frames are still queued), and wait until everything already written to the transport has been sent.
+    async def pause(self) -> None:
+        self.paused = True
+        self.writer.transport.set_write_buffer_limits(0)
+        await self.writer.drain()
+
+    def resume(self) -> None:
+        self.paused = False
+        self.writer.transport.set_write_buffer_limits()
+        self.ready.set()
+
+    def _hold(self) -> None:
+        if self.stall_timer is None and not self.closed and len(self.frames) >= self.max_frames:
+            ingress_gate.hold(self)
+            self.stall_timer = self.loop.call_later(BACKPRESSURE_TIMEOUT, self._overflow)
+
+    def _overflow(self) -> None:
+        self.close(flush=False)
+        if self.on_overflow:
+            self.on_overflow()
+
+    def _release(self) -> None:
+        if self.stall_timer is not None:
+            self.stall_timer.cancel()
+            self.stall_timer = None
+            ingress_gate.release(self)
+
+    def close(self, flush: bool = True) -> None:
+        if not self._in_loop():
+            self.loop.call_soon_threadsafe(self.close, flush)
+            return
+        with self.lock:
+            self.closed = True
+            if not flush:
+                self.frames.clear()
+        if not flush:
+            self.writer.transport.abort()   # Also releases a writer waiting on a stalled client
+        self.ready.set()
+
+    async def _write(self) -> None:
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                batch = None
+                with self.lock:
+                    if self.frames and not self.paused:
+                        batch = self._take_batch()
+                if batch is not None:
+                    self.writer.write(batch)
+                    self.sent_bytes += len(batch)
+                    await self.writer.drain()
+                    self._release()
+                if self.closed and not self.frames:
+                    break
+        except ConnectionError:
+            with self.lock:
+                self.closed = True
+                self.frames.clear()
+        self._release()
+        self.writer.close()
+
+
+# Totals of the counters across a collection of outbound queues.
+def queue_stats(queues: list) -> dict:
+    depths = [queue.depth for queue in queues]
+    return {'queues': len(depths), 'depth': sum(depths), 'max_depth': max(depths, default=0),
+            'high_water': max((queue.high_water for queue in queues), default=0),
+            'dropped': sum(queue.dropped for queue in queues),
+            'sent_bytes': sum(queue.sent_bytes for queue in queues)}
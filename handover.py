@@ -0,0 +1,127 @@
+import json
+import os
+import select
+import socket
+import threading
+
+
+# ---------------------------------------------- INITIALISATION ------------------------------------------------------ #
+
+MAX_FDS = 250               # File descriptors passed in one message (Linux takes at most 253 at once)
+CHUNK_SIZE = 60000          # Bytes of the handed over state passed in one message
+PAUSE_TIMEOUT = 10.0        # Seconds the old server waits for its clients to pause before handing over without them
+READY_TIMEOUT = 30.0        # Seconds the old server waits for the new one to take over before carrying on itself
+
+# The first byte of each message over the channel between the old and the new server process.
+FDS = b'F'                  # Passes file descriptors: the listening socket, then a socket per client
+STATE = b'S'                # Carries part of the state (the clients' usernames, rooms, buffered data, ...) as JSON
+END = b'E'                  # Ends the handover
+READY = b'K'                # Sent back by the new server once it is serving the clients it was handed
+
+
+# Raised in the new server when the old one goes before it has handed everything over.
+class HandoverError(RuntimeError):
+    pass
+
+
+# ----------------------------------------------------- Channel ------------------------------------------------------ #
+
+# The two ends of the channel between the old server and its successor. A sequenced packet socket keeps every message
+# (and the file descriptors passed with it) separate, so neither side needs to frame them.
+def channel() -> tuple:
+    return socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+
+# Pass the sockets and the state to the new server.
+def send(sock: socket.socket, fds: list, state: dict) -> None:
+    for start in range(0, len(fds), MAX_FDS):
+        socket.send_fds(sock, [FDS], fds[start:start + MAX_FDS])
+    data = json.dumps(state, separators=(',', ':')).encode()
+    for start in range(0, len(data), CHUNK_SIZE):
+        sock.send(STATE + data[start:start + CHUNK_SIZE])
+    sock.send(END)
+
+
+# Receive the sockets (as file descriptors, in the order they were sent) and the state from the old server.
+def receive(sock: socket.socket) -> tuple:
+    fds = []
+    chunks = []
+    while True:
+        data, received, _, _ = socket.recv_fds(sock, CHUNK_SIZE + 1, MAX_FDS)
+        fds.extend(received)
+        if not data:
+            for fd in fds:
+                os.close(fd)
+            raise HandoverError('The old server went before handing everything over.')
+        if data[:1] == STATE:
+            chunks.append(data[1:])
+        elif data[:1] == END:
+            return fds, json.loads(b''.join(chunks))
+
+
+def ready(sock: socket.socket) -> None:
+    sock.send(READY)
+
+
+# Wait for the new server to report that it has taken over; returns False if it failed to (or took too long).
+def wait_ready(sock: socket.socket, timeout: float = READY_TIMEOUT) -> bool:
+    sock.settimeout(timeout)
+    try:
+        return sock.recv(1) == READY
+    except OSError:
+        return False
+
+
+# ------------------------------------------------------ Pauser ------------------------------------------------------ #
+
+# Pauses the threads that spend their time blocked on sockets (the reader thread of every client and the accept loop)
+# at a point where nothing has been read that they have not finished with. Each thread polls its socket together with
+# the read end of a pipe, which pause() makes readable, rather than blocking in recv() or accept() (which nothing could
+# interrupt without also ending the connection for the new server); seeing it, the thread calls park(), which holds it
+# until resume().
+class Pauser:
+    def __init__(self) -> None:
+        self.read_fd, self.write_fd = os.pipe()
+        self.condition = threading.Condition()
+        self.paused = False
+        self.parked = set()     # The sockets whose threads are parked
+
+    # A poll object for a socket and the pipe, for wait_readable().
+    def poller(self, sock: socket.socket) -> select.poll:
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        poller.register(self.read_fd, select.POLLIN)
+        return poller
+
+    # Block until the socket can be read from (or accepted from); returns False if the pauser was paused instead.
+    def wait_readable(self, poller: select.poll) -> bool:
+        if self.paused:
+            return False
+        return all(fd != self.read_fd for fd, _ in poller.poll())
+
+    # Hold the thread reading from a socket until the pauser is resumed.
+    def park(self, sock: socket.socket) -> None:
+        with self.condition:
+            self.parked.add(sock)
+            self.condition.notify_all()
+            self.condition.wait_for(lambda: not self.paused)
+            self.parked.discard(sock)
+
+    def pause(self) -> None:
+        with self.condition:
+            if not self.paused:
+                self.paused = True
+                os.write(self.write_fd, b'P')
+
+    # Wait until the threads of the given sockets have parked; returns the sockets whose threads parked in time.
+    def wait_parked(self, sockets: set, timeout: float) -> set:
+        with self.condition:
+            self.condition.wait_for(lambda: sockets <= self.parked, timeout)
+            return sockets & self.parked
+
+    def resume(self) -> None:
+        with self.condition:
+            if self.paused:
+                self.paused = False
+                os.read(self.read_fd, 1)
+                self.condition.notify_all()
@@ -0,0 +1,148 @@
+import threading
+import time
+
+import protocol
+
+
+# ---------------------------------------------- INITIALISATION ------------------------------------------------------ #
+
+DEFAULT_INTERVAL = 30.0     # Seconds a v2 client may be silent before it is sent a PING
+DEFAULT_TIMEOUT = 90.0      # Seconds a v2 client may be silent (not even answering a PING) before it is evicted
+DEFAULT_IDLE_TIMEOUT = 0.0  # Seconds any client may go without sending a message before it is evicted (0: never)
+TICK = 1.0                  # Resolution of the timer wheel, in seconds
+
+# Why a client was evicted.
+DEAD = 'dead'               # It stopped answering heartbeats
+IDLE = 'idle'               # It stopped sending messages
+REASONS = (DEAD, IDLE)
+
+PING_FRAME = protocol.Frame.control(protocol.PING)
+PONG_FRAME = protocol.Frame.control(protocol.PONG)
+
+
+# -------------------------------------------------- Timer Wheel ----------------------------------------------------- #
+
+# A hashed timer wheel: a ring of slots, one per tick, each holding the keys due in that tick. Scheduling or cancelling
+# a key is O(1), and expire() only visits the slots that have come due since it was last called, so it costs
+# O(expired) (plus one step per elapsed tick) however many keys are scheduled. Deadlines beyond the end of the ring are
+# brought forward to its last slot, so a key may come due early; the owner is expected to check and schedule it again.
+class TimerWheel:
+    def __init__(self, tick: float, span: float) -> None:
+        self.tick = tick
+        self.slots = [set() for _ in range(int(span / tick) + 2)]
+        self.where = {}         # Key -> the slot it is in
+        self.current = int(time.monotonic() / tick)    # The last tick expired
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.where)
+
+    def schedule(self, key, deadline: float) -> None:
+        due = -int(-deadline // self.tick)      # The tick the deadline falls in, rounded up
+        due = min(max(due, self.current + 1), self.current + len(self.slots) - 1)
+        with self.lock:
+            self._cancel(key)
+            slot = self.slots[due % len(self.slots)]
+            slot.add(key)
+            self.where[key] = slot
+
+    def cancel(self, key) -> None:
+        with self.lock:
+            self._cancel(key)
+
+    def _cancel(self, key) -> None:
+        slot = self.where.pop(key, None)
+        if slot is not None:
+            slot.discard(key)
+
+    # Take every key that has come due by now out of the wheel.
+    def expire(self, now: float) -> list:
+        expired = []
+        with self.lock:
+            target = int(now / self.tick)
+            self.current = max(self.current, target - len(self.slots))  # A whole turn visits every slot
+            while self.current < target:
+                self.current += 1
+                slot = self.slots[self.current % len(self.slots)]
+                for key in slot:
+                    del self.where[key]
+                expired.extend(slot)
+                slot.clear()
+        return expired
+
+
+# ----------------------------------------------------- Reaper ------------------------------------------------------- #
+
+# Finds clients whose connections have died or gone idle, without ever scanning every client. Each watched client sits
+# in a timer wheel at the next moment it could need attention, and is only looked at then: if it has been heard from
+# in the meantime it is simply rescheduled. A v2 client that has been silent for the heartbeat interval is sent a PING
+# (which a live client answers), and one silent for the heartbeat timeout is passed to evict. With an idle timeout,
+# any client that has sent no messages for that long is evicted too.
+#
+# Watched clients must have last_seen (when anything, even a PONG, was last received from them), last_active (when
+# they last sent a message), last_ping (when they were last sent a PING) and version attributes, all times being
+# time.monotonic() values.
+class Reaper:
+    def __init__(self, evict, ping, interval: float = DEFAULT_INTERVAL, timeout: float = DEFAULT_TIMEOUT,
+                 idle_timeout: float = DEFAULT_IDLE_TIMEOUT, tick: float = TICK) -> None:
+        self.evict = evict          # Called with a client and the reason (DEAD or IDLE) it is to be evicted
+        self.ping = ping            # Called with a client to send it a PING
+        self.interval = interval
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.tick = tick
+        self.wheel = TimerWheel(tick, max(interval, timeout, idle_timeout))
+        self.stopped = threading.Event()
+        self.paused = False         # While paused, no client is pinged or evicted (they are looked at once resumed)
+        self.thread = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.timeout or self.idle_timeout)
+
+    def start(self) -> None:
+        if self.enabled and self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='reaper', daemon=True)
+            self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def watch(self, client) -> None:
+        if self.enabled:
+            self._schedule(client, time.monotonic())
+
+    def forget(self, client) -> None:
+        self.wheel.cancel(client)
+
+    def _schedule(self, client, now: float) -> None:
+        deadlines = []
+        if self.timeout and client.version == protocol.V2:
+            deadlines.append(client.last_seen + (self.interval if client.last_ping < client.last_seen and
+                                                 self.interval < self.timeout else self.timeout))
+        if self.idle_timeout:
+            deadlines.append(client.last_active + self.idle_timeout)
+        if deadlines:
+            self.wheel.schedule(client, max(min(deadlines), now))
+
+    def _check(self, client, now: float) -> None:
+        if self.idle_timeout and now - client.last_active >= self.idle_timeout:
+            self.evict(client, IDLE)
+            return
+        if self.timeout and client.version == protocol.V2:
+            silent = now - client.last_seen
+            if silent >= self.timeout:
+                self.evict(client, DEAD)
+                return
+            if silent >= self.interval and client.last_ping < client.last_seen:
+                client.last_ping = now
+                self.ping(client)
+        self._schedule(client, now)
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.tick):
+            if self.paused:
+                continue
+            now = time.monotonic()
+            for client in self.wheel.expire(now):
+                self._check(client, now)
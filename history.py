@@ -0,0 +1,50 @@
+import collections
+import itertools
+import threading
+
+
+# ---------------------------------------------- INITIALISATION ------------------------------------------------------ #
+
+DEFAULT_MAX_MESSAGES = 100          # Per room
+DEFAULT_MAX_BYTES = 64 * 1024       # Per room, counting message bodies
+
+
+# ------------------------------------------------- Message History -------------------------------------------------- #
+
+# The most recent messages of every room, kept as the Frames they were broadcast as. Each room's history is a ring
+# buffer capped both by number of messages and by total size, dropping the oldest messages first. Since frames cache
+# their encodings, replaying history to any number of clients never encodes a message again.
+class MessageHistory:
+    def __init__(self, max_messages: int = DEFAULT_MAX_MESSAGES, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.rooms = {}         # Room -> deque of frames
+        self.sizes = {}         # Room -> total length of the frames in its deque
+
+    def record(self, room: str, frame) -> None:
+        if not self.max_messages or len(frame) > self.max_bytes:
+            return
+        with self.lock:
+            frames = self.rooms.get(room)
+            if frames is None:
+                frames = self.rooms[room] = collections.deque()
+                self.sizes[room] = 0
+            frames.append(frame)
+            self.sizes[room] += len(frame)
+            while len(frames) > self.max_messages or self.sizes[room] > self.max_bytes:
+                self.sizes[room] -= len(frames.popleft())
+
+    # The last count messages of a room (all that are kept, if count is None), oldest first.
+    def recent(self, room: str, count: int = None) -> list:
+        with self.lock:
+            frames = self.rooms.get(room, ())
+            if count is None or count >= len(frames):
+                return list(frames)
+            return list(itertools.islice(frames, len(frames) - max(count, 0), None))
+
+    # Drop the history of a room that no longer exists.
+    def forget(self, room: str) -> None:
+        with self.lock:
+            self.rooms.pop(room, None)
+            self.sizes.pop(room, None)
@@ -0,0 +1,289 @@
+import argparse
+import asyncio
+import collections
+import json
+import random
+import sys
+import time
+
+import benchmark
+import protocol
+from protocol import Frame
+
+
+# ------------------------------------------------ Initialisation ---------------------------------------------------- #
+
+HOST_NAME = '127.0.0.1'
+LOAD_PREFIX = 'load '       # Starts every chat message and whisper sent, followed by the time it was sent
+
+CHAT = 'chat'
+WHISPER = 'whisper'
+USERS = 'users'
+RENAME = 'rename'
+ACTIONS = (CHAT, WHISPER, USERS, RENAME)
+DEFAULT_MIX = 'chat=85,whisper=10,users=4,rename=1'
+
+# Metrics compared against a baseline by --baseline: whether each is better when higher or when lower.
+HIGHER_IS_BETTER = ('setup_rate', 'actions_per_second', 'delivered_per_second')
+LOWER_IS_BETTER = ('fanout_p50', 'fanout_p99', 'fanout_p999', 'whisper_p50', 'whisper_p99', 'users_p50', 'users_p99')
+
+
+# ---------------------------------------------------- Helpers ------------------------------------------------------- #
+
+# Parse a command mix such as "chat=85,whisper=10,users=4,rename=1" into the weight of each action.
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(','):
+        action, _, weight = part.partition('=')
+        if action.strip() not in ACTIONS:
+            raise argparse.ArgumentTypeError('Unknown action {!r}; the actions are {}.'.format(action,
+                                                                                              ', '.join(ACTIONS)))
+        try:
+            mix[action.strip()] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError('The weight of {} must be a number.'.format(action))
+    if not sum(mix.values()) > 0:
+        raise argparse.ArgumentTypeError('At least one action needs a positive weight.')
+    return mix
+
+
+# The given percentiles of the samples, sorting them only once.
+def percentiles(samples: list, fractions: tuple) -> list:
+    ordered = sorted(samples)
+    if not ordered:
+        return [float('nan')] * len(fractions)
+    return [ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] for fraction in fractions]
+
+
+# ---------------------------------------------------- Load User ----------------------------------------------------- #
+
+# A simulated user. It completes the username handshake (accepting v2 framing, and compression, if asked to), then
+# reads every frame it is sent, timing the delivery of chat and whispers (which carry their send time; all users share
+# this process, so the times are comparable) and the replies to its own /users commands.
+class LoadUser:
+    def __init__(self, username: str, v2: bool, compression: bool = False) -> None:
+        self.username = username
+        self.v2 = v2
+        self.compression = compression
+        self.received_bytes = 0
+        self.version = protocol.V1
+        self.decoder = protocol.FrameDecoder(protocol.V1)
+        self.reader = None
+        self.writer = None
+        self.renames = 0
+        self.received = 0
+        self.fanout = []        # Delivery latencies of chat messages
+        self.whispers = []      # Delivery latencies of whispers
+        self.commands = []      # Round trip times of /users
+        self.pending_users = collections.deque()    # Send times of the /users commands not yet answered
+
+    async def next_frame(self) -> Frame:
+        frame = self.decoder.next_frame()
+        while frame is None:
+            data = await self.reader.read(self.decoder.chunk_size)
+            if not data:
+                raise ConnectionError('The server closed the connection.')
+            self.received_bytes += len(data)
+            self.decoder.feed(data)
+            frame = self.decoder.next_frame()
+        return frame
+
+    async def connect(self, port: int) -> None:
+        self.reader, self.writer = await asyncio.open_connection(HOST_NAME, port)
+        frame = await self.next_frame()
+        if frame.kind != protocol.GET_USERNAME and frame.message != protocol.KEYWORDS[protocol.GET_USERNAME]:
+            raise RuntimeError('Unexpected handshake from the server.')
+        reply = protocol.encode_v1(self.username.encode(protocol.FORMAT), offer_v2=self.v2 and self.decoder.v2_offered,
+                                   offer_compression=self.compression and self.decoder.compression_offered)
+        self.writer.write(reply)
+        if protocol.parse_v1_header(reply[:protocol.HEADER_LENGTH])[1]:    # The offer fitted in the header
+            self.version = self.decoder.version = protocol.V2
+        frame = await self.next_frame()     # The welcome message, or USERNAME_IN_USE
+        if frame.kind == protocol.USERNAME_IN_USE or frame.message == protocol.KEYWORDS[protocol.USERNAME_IN_USE]:
+            raise RuntimeError('The username {} is in use.'.format(self.username))
+
+    def send(self, message: str) -> None:
+        self.writer.write(Frame(message).encode(self.version))
+
+    async def receive(self) -> None:
+        try:
+            while True:
+                frame = await self.next_frame()
+                if frame.kind == protocol.PING:     # Answered like client.py, so the server keeps the user
+                    self.writer.write(Frame.control(protocol.PONG).encode(self.version))
+                    continue
+                now = time.perf_counter()
+                self.received += 1
+                prefix, _, body = frame.message.partition('> ')
+                if body.startswith(LOAD_PREFIX):
+                    latency = now - float(body[len(LOAD_PREFIX):])
+                    if not prefix.startswith('From '):
+                        self.fanout.append(latency)
+                    elif not prefix.startswith('From you '):
+                        self.whispers.append(latency)
+                elif frame.message.startswith('There ') and self.pending_users:
+                    self.commands.append(now - self.pending_users.popleft())
+        except (ConnectionError, OSError, ValueError, protocol.FramingError):
+            pass
+
+    # Perform actions chosen from the mix, at random (exponentially distributed) intervals averaging 1 / rate seconds.
+    async def act(self, population: list, mix: dict, rate: float, duration: float, counts: collections.Counter) -> None:
+        actions, weights = list(mix), list(mix.values())
+        end = time.perf_counter() + duration
+        while True:
+            await asyncio.sleep(random.expovariate(rate))
+            if time.perf_counter() >= end:
+                return
+            action = random.choices(actions, weights)[0]
+            if action == CHAT:
+                self.send('{}{}'.format(LOAD_PREFIX, time.perf_counter()))
+            elif action == WHISPER:
+                target = random.choice(population)
+                if target is self:
+                    continue
+                self.send('/whisper {} {}{}'.format(target.username, LOAD_PREFIX, time.perf_counter()))
+            elif action == USERS:
+                self.pending_users.append(time.perf_counter())
+                self.send('/users')
+            else:
+                self.renames += 1
+                self.username = '{}-{}'.format(self.username.partition('-')[0], self.renames)
+                self.send('/rename {}'.format(self.username))
+            counts[action] += 1
+
+
+# ----------------------------------------------------- Run ---------------------------------------------------------- #
+
+async def run_load(arguments: argparse.Namespace) -> dict:
+    users = [LoadUser('load{}'.format(number), arguments.framing != 'v1', arguments.framing == 'v2z')
+             for number in range(arguments.users)]
+    gate = asyncio.Semaphore(arguments.concurrency)
+    receivers = []
+
+    async def connect(user: LoadUser) -> bool:
+        async with gate:
+            try:
+                await user.connect(arguments.port)
+            except (OSError, asyncio.IncompleteReadError, ConnectionError, RuntimeError, protocol.FramingError):
+                user.writer = None
+                return False
+        receivers.append(asyncio.create_task(user.receive()))
+        return True
+
+    start = time.perf_counter()
+    connected = sum(await asyncio.gather(*(connect(user) for user in users)))
+    setup_time = time.perf_counter() - start
+    users = [user for user in users if user.writer is not None]
+    await asyncio.sleep(arguments.settle)     # Let the join announcements drain before measuring
+
+    received_before = sum(user.received for user in users)
+    bytes_before = sum(user.received_bytes for user in users)
+    counts = collections.Counter()
+    active = users[:arguments.active]
+    start = time.perf_counter()
+    await asyncio.gather(*(user.act(users, arguments.mix, arguments.rate, arguments.duration, counts)
+                           for user in active))
+    await asyncio.sleep(arguments.settle)     # Allow the last messages to be delivered
+    elapsed = time.perf_counter() - start
+    delivered = sum(user.received for user in users) - received_before
+    received_bytes = sum(user.received_bytes for user in users) - bytes_before
+
+    for user in users:
+        user.writer.close()
+    for receiver in receivers:
+        receiver.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+
+    fanout = [latency for user in users for latency in user.fanout]
+    whispers = [latency for user in users for latency in user.whispers]
+    commands = [latency for user in users for latency in user.commands]
+    result = {'users': arguments.users, 'connected': connected, 'setup_rate': connected / setup_time,
+              'active': len(active), 'actions': dict(counts),
+              'actions_per_second': sum(counts.values()) / arguments.duration,
+              'delivered': delivered, 'delivered_per_second': delivered / elapsed,
+              'received_bytes_per_second': received_bytes / elapsed}
+    for name, samples in (('fanout', fanout), ('whisper', whispers), ('users', commands)):
+        result['{}_samples'.format(name)] = len(samples)
+        for label, value in zip(('p50', 'p99', 'p999'), percentiles(samples, (0.5, 0.99, 0.999))):
+            result['{}_{}'.format(name, label)] = value * 1000     # Milliseconds
+    return result
+
+
+def report(result: dict) -> None:
+    print('connected {}/{} users at {:.0f} connections/s'.format(result['connected'], result['users'],
+                                                                  result['setup_rate']))
+    print('{} active users performed {:.0f} actions/s ({}); {:.0f} frames/s ({:.0f} kB/s) delivered'.format(
+        result['active'], result['actions_per_second'],
+        ', '.join('{} {}'.format(count, action) for action, count in sorted(result['actions'].items())),
+        result['delivered_per_second'], result.get('received_bytes_per_second', 0) / 1000))
+    print('{:<10} {:>9} {:>9} {:>9} {:>10}'.format('latency', 'p50 (ms)', 'p99 (ms)', 'p999 (ms)', 'samples'))
+    for name in ('fanout', 'whisper', 'users'):
+        print('{:<10} {:>9.2f} {:>9.2f} {:>9.2f} {:>10}'.format(
+            name, result[name + '_p50'], result[name + '_p99'], result[name + '_p999'], result[name + '_samples']))
+
+
+# Compare a result against a baseline result (as written by --json); returns a description of every metric that got
+# worse by more than the tolerance (a fraction of the baseline value).
+def regressions(result: dict, baseline: dict, tolerance: float) -> list:
+    found = []
+    for metric in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+        old, new = baseline.get(metric), result.get(metric)
+        if old is None or new is None or old != old or new != new:     # Missing, or NaN (no samples)
+            continue
+        if metric in HIGHER_IS_BETTER and new < old * (1 - tolerance) or \
+                metric in LOWER_IS_BETTER and new > old * (1 + tolerance):
+            found.append('{}: {:.3f} against a baseline of {:.3f}'.format(metric, new, old))
+    return found
+
+
+# ---------------------------------------------- Commencement -------------------------------------------------------- #
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Headless load generator for the chat room server.')
+    parser.add_argument('--port', type=int, default=12600)
+    parser.add_argument('--spawn', choices=('threads', 'asyncio'),
+                        help='Start a server with this engine on the port (in a scratch directory) for the run, '
+                             'instead of using one that is already running.')
+    parser.add_argument('--server-args', default='', help='Further arguments for a spawned server.')
+    parser.add_argument('--users', type=int, default=1000, help='Simulated users to connect.')
+    parser.add_argument('--active', type=int, default=50, help='How many of the users perform actions.')
+    parser.add_argument('--rate', type=float, default=2, help='Actions per second per active user.')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='Relative weights of the actions (default: {}).'.format(DEFAULT_MIX))
+    parser.add_argument('--duration', type=float, default=10, help='Seconds the active users act for.')
+    parser.add_argument('--settle', type=float, default=1, help='Seconds to wait before and after acting.')
+    parser.add_argument('--concurrency', type=int, default=100, help='Handshakes in flight at once.')
+    parser.add_argument('--framing', choices=('v1', 'v2', 'v2z'), default='v2',
+                        help='Framing the users accept (v2z: v2 with compression).')
+    parser.add_argument('--seed', type=int, help='Seed for the random choice of actions.')
+    parser.add_argument('--json', help='Also write the results to this file as JSON.')
+    parser.add_argument('--baseline', help='Results (as written by --json) to check this run against.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Fraction by which a metric may be worse than the baseline (default: 0.2).')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    if isinstance(arguments.mix, str):
+        arguments.mix = parse_mix(arguments.mix)
+    random.seed(arguments.seed)
+    benchmark.raise_file_limit()
+    server = benchmark.start_server(arguments.port, ['--engine', arguments.spawn] + arguments.server_args.split()) \
+        if arguments.spawn else None
+    try:
+        result = asyncio.run(run_load(arguments))
+    finally:
+        if server is not None:
+            benchmark.stop_server(server)
+
+    report(result)
+    if arguments.json:
+        with open(arguments.json, 'w') as file:
+            json.dump(result, file, indent=2)
+    if arguments.baseline:
+        with open(arguments.baseline) as file:
+            found = regressions(result, json.load(file), arguments.tolerance)
+        for regression in found:
+            print('[REGRESSION] {}'.format(regression))
+        sys.exit(1 if found else 0)
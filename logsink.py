@@ -0,0 +1,101 @@
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+
+# ---------------------------------------------- INITIALISATION ------------------------------------------------------ #
+
+TEXT = 'text'       # Lines in the form "17/10/2026 10:05:02 AM: [TAG] message"
+JSON = 'json'       # One JSON object per line, with the time, the [TAG] of the message and the message itself
+FORMATS = (TEXT, JSON)
+
+DATE_FORMAT = '%d/%m/%Y %I:%M:%S %p'
+BATCH_SIZE = 1024           # Most records written with one write call
+STOP = object()             # Queued by close() to stop the writer
+
+
+# ---------------------------------------------------- Log Sink ------------------------------------------------------ #
+
+# Logs messages from any thread without doing any I/O on that thread: put() only timestamps the message and queues it.
+# A single writer thread takes whatever has queued up, formats it, echoes it to the console (if enabled) and appends it
+# to the log file with one write, rotating the file once it reaches max_bytes.
+class LogSink:
+    def __init__(self, filename: str, log_format: str = TEXT, echo: bool = True, max_bytes: int = 0,
+                 backups: int = 5) -> None:
+        self.filename = filename
+        self.log_format = log_format
+        self.echo = echo
+        self.max_bytes = max_bytes      # 0 disables rotation
+        self.backups = backups
+        self.queue = queue.SimpleQueue()
+        self.file = open(filename, 'ab')    # Written as UTF-8 bytes, so the size counts bytes
+        self.size = self.file.tell()
+        self.last_second = None
+        self.last_stamp = ''
+        self.writer_thread = threading.Thread(target=self._write, name='log-writer', daemon=True)
+        self.writer_thread.start()
+
+    def put(self, message: str) -> None:
+        self.queue.put((time.time(), message))
+
+    # Write out everything already queued, then stop the writer.
+    def close(self) -> None:
+        if self.writer_thread.is_alive():
+            self.queue.put(STOP)
+            self.writer_thread.join()
+
+    def _stamp(self, timestamp: float) -> str:
+        second = int(timestamp)
+        if second != self.last_second:     # Format each second's date only once
+            self.last_second = second
+            self.last_stamp = time.strftime(DATE_FORMAT, time.localtime(second))
+        return self.last_stamp
+
+    def _format(self, timestamp: float, message: str) -> str:
+        if self.log_format == JSON:
+            tag, _, _ = message.partition(']')
+            return json.dumps({'time': self._stamp(timestamp), 'timestamp': round(timestamp, 6),
+                               'event': tag[1:] if tag.startswith('[') else None, 'message': message}) + '\n'
+        return '{}: {}\n'.format(self._stamp(timestamp), message)
+
+    def _rotate(self) -> None:
+        self.file.close()
+        for number in range(self.backups - 1, 0, -1):
+            older = '{}.{}'.format(self.filename, number)
+            if os.path.exists(older):
+                os.replace(older, '{}.{}'.format(self.filename, number + 1))
+        if self.backups:
+            os.replace(self.filename, '{}.1'.format(self.filename))
+        else:
+            os.remove(self.filename)
+        self.file = open(self.filename, 'ab')
+        self.size = 0
+
+    def _write(self) -> None:
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if STOP in batch:
+                batch = [record for record in batch if record is not STOP]
+                running = False
+            if not batch:
+                continue
+
+            if self.echo:
+                sys.stdout.write(''.join(message + '\n' for _, message in batch))
+                sys.stdout.flush()
+            data = ''.join(self._format(timestamp, message) for timestamp, message in batch).encode('utf-8')
+            self.file.write(data)
+            self.file.flush()
+            self.size += len(data)
+            if self.max_bytes and self.size >= self.max_bytes:
+                self._rotate()
+        self.file.close()
@@ -0,0 +1,196 @@
+import bisect
+import http.server
+import threading
+
+
+# ---------------------------------------------- INITIALISATION ------------------------------------------------------ #
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+SECONDS_BUCKETS = tuple(1e-6 * 2 ** power for power in range(25))        # 1 us to about 17 s
+BYTES_BUCKETS = tuple(64 * 4 ** power for power in range(10))            # 64 B to 16 MiB
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+# ----------------------------------------------------- Metrics ------------------------------------------------------ #
+
+# Label values are kept as a tuple of (name, value) pairs, so a metric can be looked up without building a string.
+def _labels_text(labels: tuple, extra: str = '') -> str:
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels]
+    if extra:
+        pairs.append(extra)
+    return '{{{}}}'.format(','.join(pairs)) if pairs else ''
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# A count that only goes up. Incrementing takes an uncontended lock, so counts are exact under the threads engine too.
+class Counter:
+    kind = COUNTER
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name: str, labels: tuple) -> list:
+        return ['{}{} {}'.format(name, _labels_text(labels), _number(self.value))]
+
+    def summary(self) -> str:
+        return _number(self.value)
+
+
+# A value read (by calling a function) only when the metrics are collected, e.g. the number of connected users, so it
+# costs nothing on the paths being measured. Can also be a counter whose value is computed this way.
+class Callback:
+    def __init__(self, function, kind: str = GAUGE) -> None:
+        self.function = function
+        self.kind = kind
+
+    def samples(self, name: str, labels: tuple) -> list:
+        return ['{}{} {}'.format(name, _labels_text(labels), _number(self.function()))]
+
+    def summary(self) -> str:
+        return _number(self.function())
+
+
+# Counts observations into fixed buckets (by upper bound), along with their number and sum. Observing costs a binary
+# search over the bucket bounds and an uncontended lock.
+class Histogram:
+    kind = HISTOGRAM
+
+    def __init__(self, buckets: tuple = SECONDS_BUCKETS) -> None:
+        self.lock = threading.Lock()
+        self.bounds = buckets
+        self.counts = [0] * (len(buckets) + 1)      # The last bucket is everything above the largest bound
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        bucket = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.sum += value
+
+    # An estimate of a quantile: the upper bound of the bucket it falls in.
+    def quantile(self, fraction: float) -> float:
+        with self.lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return float('nan')
+        target = fraction * count
+        seen = 0
+        for bound, bucket_count in zip(self.bounds, counts):
+            seen += bucket_count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+    def samples(self, name: str, labels: tuple) -> list:
+        with self.lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.bounds, counts):
+            cumulative += bucket_count
+            lines.append('{}_bucket{} {}'.format(name, _labels_text(labels, 'le="{}"'.format(repr(float(bound)))),
+                                                 cumulative))
+        lines.append('{}_bucket{} {}'.format(name, _labels_text(labels, 'le="+Inf"'), count))
+        lines.append('{}_sum{} {}'.format(name, _labels_text(labels), repr(total)))
+        lines.append('{}_count{} {}'.format(name, _labels_text(labels), count))
+        return lines
+
+    def summary(self) -> str:
+        if not self.count:
+            return 'count 0'
+        return 'count {}, mean {:.3g}, p50 <= {:.3g}, p99 <= {:.3g}'.format(
+            self.count, self.sum / self.count, self.quantile(0.5), self.quantile(0.99))
+
+
+# ------------------------------------------------- Metrics Registry ------------------------------------------------- #
+
+# Every metric of the server, by name and labels. Metrics are created once (when first asked for) and then updated
+# directly by the code they measure; only collection, for the HTTP endpoint or the /stats console command, walks them.
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.families = {}      # Name -> (kind, help text, {labels: metric})
+
+    def _get(self, name: str, help_text: str, labels: dict, create):
+        key = tuple(sorted(labels.items())) if labels else ()
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = [None, help_text, {}]
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = create()
+                family[0] = metric.kind
+            return metric
+
+    def counter(self, name: str, help_text: str, **labels) -> Counter:
+        return self._get(name, help_text, labels, Counter)
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = SECONDS_BUCKETS, **labels) -> Histogram:
+        return self._get(name, help_text, labels, lambda: Histogram(buckets))
+
+    def callback(self, name: str, help_text: str, function, kind: str = GAUGE, **labels) -> Callback:
+        return self._get(name, help_text, labels, lambda: Callback(function, kind))
+
+    def _snapshot(self) -> list:
+        with self.lock:
+            return [(name, kind, help_text, list(metrics.items()))
+                    for name, (kind, help_text, metrics) in sorted(self.families.items())]
+
+    # Every metric in the Prometheus text exposition format.
+    def render(self) -> str:
+        lines = []
+        for name, kind, help_text, metrics in self._snapshot():
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, metric in metrics:
+                lines.extend(metric.samples(name, labels))
+        return '\n'.join(lines) + '\n'
+
+    # One short line per metric, for the server console.
+    def summary(self) -> list:
+        return ['{}{}: {}'.format(name, _labels_text(labels), metric.summary())
+                for name, _, _, metrics in self._snapshot() for labels, metric in metrics]
+
+
+# --------------------------------------------------- HTTP Endpoint -------------------------------------------------- #
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    metrics_registry = None
+
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.metrics_registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:    # Scrapes are not worth logging
+        pass
+
+
+# Serve the metrics of a registry over HTTP (at /metrics) from a background thread; returns the HTTP server.
+def serve(metrics_registry: MetricsRegistry, host: str, port: int) -> http.server.ThreadingHTTPServer:
+    handler = type('MetricsHandler', (_MetricsHandler,), {'metrics_registry': metrics_registry})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
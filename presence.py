@@ -0,0 +1,184 @@
+import bisect
+import threading
+
+from protocol import Frame
+
+
+# ---------------------------------------------- INITIALISATION ------------------------------------------------------ #
+
+PAGE_SIZE = 50              # Usernames listed by each page of /users (and by a /users prefix query)
+FLUSH_DELAY = 0.2           # Seconds changes are gathered for before they are pushed to subscribers, as one frame
+FRAME_BUDGET = 8000         # Most bytes of changes put in one frame, which keeps it within a v1 header's 4 digits
+
+# The changes pushed to subscribers, one per line of a frame beginning with HEADER: '+ name' (joined), '- name' (left)
+# and '~ old new' (renamed; a new username never contains a space, so the line splits at its last space).
+HEADER = '[PRESENCE]'
+JOINED = '+'
+LEFT = '-'
+RENAMED = '~'
+
+
+# ------------------------------------------------- Presence Index --------------------------------------------------- #
+
+# Every username online, kept in sorted order as users join, leave and rename, so a page of the list, or the usernames
+# beginning with a prefix, are found by bisection (O(log n) plus the length of the answer) instead of by sorting or
+# scanning every user each time one is asked for.
+class PresenceIndex:
+    def __init__(self) -> None:
+        self.lock = threading.RLock()
+        self.names = []
+
+    # Insert a username in its place; returns False if it was already there.
+    def add(self, username: str) -> bool:
+        with self.lock:
+            position = bisect.bisect_left(self.names, username)
+            if position < len(self.names) and self.names[position] == username:
+                return False
+            self.names.insert(position, username)
+            return True
+
+    # Take a username out; returns False if it was not there.
+    def remove(self, username: str) -> bool:
+        with self.lock:
+            position = bisect.bisect_left(self.names, username)
+            if position == len(self.names) or self.names[position] != username:
+                return False
+            del self.names[position]
+            return True
+
+    # The usernames on a page (counting from 1) of the sorted list.
+    def page(self, number: int, size: int = PAGE_SIZE) -> list:
+        with self.lock:
+            return self.names[(number - 1) * size:number * size]
+
+    def pages(self, size: int = PAGE_SIZE) -> int:
+        return max(1, -(-len(self.names) // size))
+
+    # The first limit usernames beginning with a prefix, and how many there are in all.
+    def starting_with(self, prefix: str, limit: int = PAGE_SIZE) -> tuple:
+        with self.lock:
+            start = bisect.bisect_left(self.names, prefix)
+            end = bisect.bisect_left(self.names, successor(prefix)) if prefix else len(self.names)
+            return self.names[start:min(end, start + limit)], end - start
+
+    def __contains__(self, username: str) -> bool:
+        with self.lock:
+            position = bisect.bisect_left(self.names, username)
+            return position < len(self.names) and self.names[position] == username
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+# The first string that sorts after every string beginning with prefix.
+def successor(prefix: str) -> str:
+    while prefix and prefix[-1] == '\U0010ffff':
+        prefix = prefix[:-1]
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1) if prefix else '\U0010ffff'
+
+
+# ----------------------------------------------------- Presence ----------------------------------------------------- #
+
+# The presence index, and the clients subscribed to its changes. Rather than asking for the whole list again and again,
+# a subscriber is sent the list once (as '+' lines) and then every change to it as it happens; the changes made within
+# FLUSH_DELAY of each other are pushed together, as one frame shared by every subscriber, so a burst of users joining
+# costs each subscriber a few frames rather than one per user. The list and the changes are sent under the same lock,
+# so a subscriber's copy of the list is never missing a change or given one twice.
+#
+# Changes are applied with join(), leave() and rename(), or with apply() for changes in the form they are passed between
+# processes: lists of the change and the username(s), such as ['~', old, new].
+class Presence(PresenceIndex):
+    def __init__(self, flush_delay: float = FLUSH_DELAY) -> None:
+        super().__init__()
+        self.flush_delay = flush_delay
+        self.subscribers = set()
+        self.pending = []       # Lines of the changes not yet pushed to the subscribers
+        self.timer = None
+
+    def join(self, username: str) -> None:
+        with self.lock:
+            if self.add(username):
+                self._changed('{} {}'.format(JOINED, username))
+
+    def leave(self, username: str) -> None:
+        with self.lock:
+            if self.remove(username):
+                self._changed('{} {}'.format(LEFT, username))
+
+    def rename(self, old_username: str, new_username: str) -> None:
+        with self.lock:
+            if self.remove(old_username):
+                self.add(new_username)
+                self._changed('{} {} {}'.format(RENAMED, old_username, new_username))
+            else:
+                self.join(new_username)
+
+    def apply(self, changes: list) -> None:
+        with self.lock:
+            for change in changes:
+                if change[0] == JOINED:
+                    self.join(change[1])
+                elif change[0] == LEFT:
+                    self.leave(change[1])
+                elif change[0] == RENAMED:
+                    self.rename(change[1], change[2])
+
+    # Send a client the whole list (unless it already has it) and then every change to it; returns the number of users
+    # online.
+    def subscribe(self, client, send_list: bool = True) -> int:
+        with self.lock:
+            self.flush()    # The changes so far are already part of the list the client is sent
+            if send_list:
+                for frame in frames(['{} {}'.format(JOINED, username) for username in self.names]):
+                    client.send(frame)
+            self.subscribers.add(client)
+            return len(self.names)
+
+    # Returns False if the client was not subscribed.
+    def unsubscribe(self, client) -> bool:
+        with self.lock:
+            if client not in self.subscribers:
+                return False
+            self.subscribers.discard(client)
+            return True
+
+    def _changed(self, line: str) -> None:
+        if not self.subscribers:
+            return
+        self.pending.append(line)
+        if self.timer is None:
+            self.timer = threading.Timer(self.flush_delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    # Push the pending changes to every subscriber; each frame is encoded once and shared between them.
+    def flush(self) -> None:
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.pending:
+                return
+            batch = frames(self.pending)
+            self.pending = []
+            for client in self.subscribers:
+                for frame in batch:
+                    client.send(frame)
+
+
+# Pack lines of changes into as few frames as FRAME_BUDGET allows.
+def frames(lines: list) -> list:
+    batch = []
+    chunk = []
+    size = 0
+    for line in lines:
+        length = len(line.encode()) + 1
+        if chunk and size + length > FRAME_BUDGET:
+            batch.append(Frame('\n'.join([HEADER] + chunk)))
+            chunk = []
+            size = 0
+        chunk.append(line)
+        size += length
+    if chunk:
+        batch.append(Frame('\n'.join([HEADER] + chunk)))
+    return batch
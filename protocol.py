@@ -0,0 +1,260 @@
+import struct
+import zlib
+
+
+# ---------------------------------------------- INITIALISATION ------------------------------------------------------ #
+
+FORMAT = 'utf-8'
+
+# Framing versions. A v1 header is the body length in ASCII decimal, space padded to HEADER_LENGTH bytes, so v1 frames
+# are limited to V1_MAX_LENGTH bytes. A v2 header is the body length as an unsigned 32-bit big-endian integer followed
+# by a type byte, and frames are limited only by the configured maximum frame size.
+V1 = 1
+V2 = 2
+HEADER_LENGTH = 4
+V1_MAX_LENGTH = 10 ** HEADER_LENGTH - 1
+V2_HEADER = struct.Struct('>IB')
+V2_HEADER_LENGTH = V2_HEADER.size
+DEFAULT_MAX_FRAME_SIZE = 1024 * 1024
+
+# Placed in the padding of a v1 header to offer v2 framing. Peers that only know v1 strip it along with the spaces when
+# they parse the header, so the offer is invisible to them. The server offers v2 in its GET_USERNAME frame; a client
+# that also supports v2 accepts by offering it back in its username frame, and both sides use v2 from then on.
+V2_OFFER = b'\t'
+# Offered alongside V2_OFFER (and accepted in the same way) for compressed v2 frames. A frame whose body is compressed
+# has the COMPRESSED bit set in its type byte; the sender only compresses bodies of at least its compression threshold,
+# and only when that makes them smaller.
+COMPRESSION_OFFER = b'\x0b'
+COMPRESSED = 0x80
+DEFAULT_COMPRESSION_THRESHOLD = 512     # Bytes
+COMPRESSION_LEVEL = 1         # zlib's fastest; higher levels cost several times the CPU for ~10% smaller frames
+
+# Frame types. In v1 the control frames are told apart from chat by their text (the keywords below); in v2 the type
+# byte says what a frame is, so a user typing one of the keywords is just chatting.
+MESSAGE = 0
+LEAVE = 1
+END = 2
+GET_USERNAME = 3
+USERNAME_IN_USE = 4
+PING = 5        # Heartbeats: a peer answers a PING with a PONG. They have no keyword, so they are only sent with v2
+PONG = 6        # framing (a v1 peer would see them as chat)
+
+KEYWORDS = {LEAVE: 'LEAVE', END: 'END', GET_USERNAME: 'GET_USERNAME', USERNAME_IN_USE: 'USERNAME_IN_USE'}
+KINDS = {keyword: kind for kind, keyword in KEYWORDS.items()}
+
+
+# Raised for a frame that can not be read: a malformed header, or a length over the maximum frame size.
+class FramingError(ValueError):
+    pass
+
+
+# Raised when a message is too long to be framed for a peer.
+class FrameTooLarge(FramingError):
+    pass
+
+
+# ---------------------------------------------------- Frames -------------------------------------------------------- #
+
+# A message together with its encodings. The body is encoded once, and each framing version's header is only built
+# the first time the frame is sent with that version; the resulting immutable buffer is then handed to the outbound
+# queue of every recipient, so a broadcast costs one encode however many clients it reaches.
+class Frame:
+    __slots__ = ('message', 'kind', 'body', 'v1', 'v2', 'v2z')
+
+    def __init__(self, message: str, kind: int = MESSAGE) -> None:
+        self.message = message
+        self.kind = kind
+        self.body = message.encode(FORMAT)
+        self.v1 = None
+        self.v2 = None
+        self.v2z = None     # The v2 encoding for peers that accept compression
+
+    # Build a frame around a body that was received, rather than one about to be sent, decompressing it if need be
+    # (to no more than max_size bytes).
+    @classmethod
+    def received(cls, body: bytes, kind: int, version: int, max_size: int = DEFAULT_MAX_FRAME_SIZE) -> 'Frame':
+        frame = cls.__new__(cls)
+        if kind & COMPRESSED:
+            body = decompress(body, max_size)
+            kind &= ~COMPRESSED
+        frame.body = bytes(body)
+        frame.v1 = None
+        frame.v2 = None
+        frame.v2z = None
+        try:
+            frame.message = frame.body.decode(FORMAT)
+        except UnicodeDecodeError as e:
+            raise FramingError('Frame body is not valid {}: {}'.format(FORMAT, e))
+        frame.kind = KINDS.get(frame.message, MESSAGE) if version == V1 else kind
+        return frame
+
+    @classmethod
+    def control(cls, kind: int) -> 'Frame':
+        return cls(KEYWORDS.get(kind, ''), kind)
+
+    # The frame encoded for a peer using the given framing version. A compression threshold (given only for peers that
+    # accepted compression) compresses bodies at least that long; like the other encodings, the compressed one is made
+    # once, however many peers it is sent to.
+    def encode(self, version: int = V1, compression_threshold: int = 0) -> bytes:
+        if version == V2:
+            if compression_threshold and len(self.body) >= compression_threshold:
+                if self.v2z is None:
+                    compressed = zlib.compress(self.body, COMPRESSION_LEVEL)
+                    if len(compressed) < len(self.body):
+                        self.v2z = V2_HEADER.pack(len(compressed), self.kind | COMPRESSED) + compressed
+                    else:   # Not worth it: send the body as it is
+                        self.v2z = self.encode(V2)
+                return self.v2z
+            if self.v2 is None:
+                self.v2 = V2_HEADER.pack(len(self.body), self.kind) + self.body
+            return self.v2
+        if self.v1 is None:
+            self.v1 = encode_v1(self.body)
+        return self.v1
+
+    def __len__(self) -> int:
+        return len(self.body)
+
+
+# Prefix an encoded body with a v1 header, optionally offering v2 framing (and compression with it) to the peer. The
+# offers go in the header's padding, so a long body leaves no room for them.
+def encode_v1(body: bytes, offer_v2: bool = False, offer_compression: bool = False) -> bytes:
+    if len(body) > V1_MAX_LENGTH:
+        raise FrameTooLarge('A {} byte frame does not fit in a v1 header.'.format(len(body)))
+    header = str(len(body)).encode(FORMAT)
+    if offer_v2 and len(header) < HEADER_LENGTH:
+        header += V2_OFFER
+        if offer_compression and len(header) < HEADER_LENGTH:
+            header += COMPRESSION_OFFER
+    return header.ljust(HEADER_LENGTH) + body
+
+
+# Encode a message and prefix it with its header.
+def encode_message(message: str, version: int = V1) -> bytes:
+    return Frame(message).encode(version)
+
+
+# Returns the body length given by a v1 header, whether the header offers v2 framing, and whether it offers compression.
+def parse_v1_header(header: bytes) -> tuple:
+    try:
+        return int(header), V2_OFFER in header, COMPRESSION_OFFER in header
+    except ValueError:
+        raise FramingError('Malformed v1 header {!r}.'.format(bytes(header)))
+
+
+# Returns the body length and frame type given by the v2 header at the start of (or at offset in) buffer.
+def parse_v2_header(buffer: bytes, offset: int = 0, max_frame_size: int = DEFAULT_MAX_FRAME_SIZE) -> tuple:
+    length, kind = V2_HEADER.unpack_from(buffer, offset)
+    if length > max_frame_size:
+        raise FramingError('Frame of {} bytes is over the {} byte limit.'.format(length, max_frame_size))
+    return length, kind
+
+
+# Decompress the body of a compressed frame, refusing to inflate it past max_size bytes.
+def decompress(body: bytes, max_size: int) -> bytes:
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(body, max_size)
+    except zlib.error as e:
+        raise FramingError('Compressed frame body is corrupt: {}'.format(e))
+    if decompressor.unconsumed_tail:
+        raise FramingError('Compressed frame inflates to over the {} byte limit.'.format(max_size))
+    if not decompressor.eof:
+        raise FramingError('Compressed frame body is truncated.')
+    return data
+
+
+# --------------------------------------------------- Decoding ------------------------------------------------------- #
+
+# Incremental frame decoder. Received bytes are read in large chunks straight into one reusable buffer, and every
+# complete frame in the buffer is returned without further system calls; frames split across reads are simply kept
+# until the rest arrives. The framing version can be switched between frames, as happens after the username handshake.
+class FrameDecoder:
+    def __init__(self, version: int = V1, max_frame_size: int = DEFAULT_MAX_FRAME_SIZE,
+                 chunk_size: int = 64 * 1024) -> None:
+        self.version = version
+        self.max_frame_size = max_frame_size
+        self.chunk_size = chunk_size
+        self.v2_offered = False     # Whether the last v1 header read offered v2 framing...
+        self.compression_offered = False    # ... and compression
+        self.buffer = bytearray(chunk_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0      # First unread byte
+        self.end = 0        # End of the received data
+
+    @property
+    def buffered(self) -> int:
+        return self.end - self.start
+
+    # Make room for at least size more bytes after the received data, moving the unread bytes to the front of the
+    # buffer first and only growing it if that is not enough.
+    def _reserve(self, size: int) -> None:
+        if len(self.buffer) - self.end >= size:
+            return
+        if self.start:
+            self.buffer[:self.buffered] = self.buffer[self.start:self.end]
+            self.end -= self.start
+            self.start = 0
+        if len(self.buffer) - self.end < size:
+            self.view.release()
+            self.buffer.extend(bytes(size - (len(self.buffer) - self.end)))
+            self.view = memoryview(self.buffer)
+
+    # Once everything has been read, go back to the start of the buffer (and shrink it, if a large frame grew it).
+    def _reset(self) -> None:
+        self.start = self.end = 0
+        if len(self.buffer) > 4 * self.chunk_size:
+            self.view.release()
+            del self.buffer[self.chunk_size:]
+            self.view = memoryview(self.buffer)
+
+    # The bytes received but not yet decoded.
+    def unread(self) -> bytes:
+        return bytes(self.view[self.start:self.end])
+
+    def feed(self, data: bytes) -> None:
+        self._reserve(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    # Receive up to one chunk from a socket directly into the buffer; returns the number of bytes received, which is 0
+    # once the peer has closed the connection. Flags (such as socket.MSG_DONTWAIT) are passed on to the socket.
+    def recv_into(self, sock, flags: int = 0) -> int:
+        self._reserve(self.chunk_size)
+        received = sock.recv_into(self.view[self.end:], 0, flags) if flags else sock.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    # Returns the next complete frame in the buffer, or None if more data is needed.
+    def next_frame(self) -> Frame or None:
+        available = self.end - self.start
+        if self.version == V2:
+            if available < V2_HEADER_LENGTH:
+                return None
+            length, kind = parse_v2_header(self.buffer, self.start, self.max_frame_size)
+            header_length = V2_HEADER_LENGTH
+        else:
+            if available < HEADER_LENGTH:
+                return None
+            length, offered, compression = parse_v1_header(self.buffer[self.start:self.start + HEADER_LENGTH])
+            kind = MESSAGE
+            header_length = HEADER_LENGTH
+        if available < header_length + length:
+            return None
+
+        body_start = self.start + header_length
+        frame = Frame.received(self.view[body_start:body_start + length], kind, self.version, self.max_frame_size)
+        if self.version == V1:
+            self.v2_offered = offered
+            self.compression_offered = compression
+        self.start = body_start + length
+        if self.start == self.end:
+            self._reset()
+        return frame
+
+    # Yields every complete frame in the buffer.
+    def frames(self):
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
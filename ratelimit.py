@@ -0,0 +1,124 @@
+import threading
+import time
+
+
+# ---------------------------------------------- INITIALISATION ------------------------------------------------------ #
+
+# What is limited: every frame a client sends, each of the kinds of message below, and every frame received by the
+# whole server.
+MESSAGE = 'message'
+CHAT = 'chat'
+WHISPER = 'whisper'
+RENAME = 'rename'
+INGRESS = 'ingress'
+KINDS = (MESSAGE, CHAT, WHISPER, RENAME, INGRESS)
+
+# The kind of limit (besides MESSAGE) each command counts against; plain messages count against CHAT.
+COMMAND_KINDS = {'/whisper': WHISPER, '/rename': RENAME}
+
+# Rate (per second) and burst of each limit; a rate of 0 means no limit.
+DEFAULT_LIMITS = {MESSAGE: (20.0, 40), CHAT: (5.0, 10), WHISPER: (5.0, 10), RENAME: (0.2, 3), INGRESS: (10000.0, 20000)}
+DEFAULT_STRIKES = 20            # Throttled messages a client may send in a row before it is kicked...
+DEFAULT_STRIKE_DECAY = 1.0      # ... each of them forgiven after this many seconds
+
+
+# Parse a limit given on the command line as KIND=RATE or KIND=RATE/BURST (the burst defaults to twice the rate).
+def parse_limit(text: str) -> tuple:
+    kind, _, value = text.partition('=')
+    if kind not in KINDS:
+        raise ValueError('unknown limit {!r} (expected one of {})'.format(kind, ', '.join(KINDS)))
+    rate, _, burst = value.partition('/')
+    rate = float(rate)
+    return kind, (rate, int(burst) if burst else max(1, int(2 * rate)))
+
+
+# ------------------------------------------------- Token Buckets ---------------------------------------------------- #
+
+# Allows rate events a second on average, and bursts of up to capacity at once. The bucket is refilled lazily (from the
+# time since it was last used) when a token is taken, so it costs a few arithmetic operations and no timers.
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    # Whether a token can be taken, without taking it.
+    def ready(self, now: float = None) -> bool:
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens >= 1
+
+    def take(self, now: float = None) -> bool:
+        if not self.ready(now):
+            return False
+        self.tokens -= 1
+        return True
+
+
+# A token bucket shared by every client, for the global ingress budget.
+class SharedTokenBucket(TokenBucket):
+    __slots__ = ('lock',)
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        super().__init__(rate, capacity)
+        self.lock = threading.Lock()
+
+    def take(self, now: float = None) -> bool:
+        with self.lock:
+            return super().take(now)
+
+
+# ------------------------------------------------- Rate Limiters ---------------------------------------------------- #
+
+# The limits applied to every client, and the global ingress budget they share.
+class RateLimits:
+    def __init__(self, limits: dict = None, strikes: int = DEFAULT_STRIKES,
+                 strike_decay: float = DEFAULT_STRIKE_DECAY) -> None:
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(limits or {})
+        self.strikes = strikes
+        self.strike_decay = strike_decay
+        rate, burst = self.limits[INGRESS]
+        self.ingress = SharedTokenBucket(rate, burst) if rate else None
+
+    def limiter(self) -> 'ClientLimiter':
+        return ClientLimiter(self)
+
+
+# The buckets of one client. A client's frames are only ever handled by its own thread or coroutine, so its buckets
+# need no lock. check() returns None if a message may go ahead, or else the kind of limit it broke. Tokens are only
+# taken once every limit allows the message, so a message throttled by one limit costs nothing from the others.
+class ClientLimiter:
+    __slots__ = ('limits', 'buckets', 'strikes', 'throttled')
+
+    def __init__(self, limits: RateLimits) -> None:
+        self.limits = limits
+        self.buckets = {kind: TokenBucket(rate, burst) for kind, (rate, burst) in limits.limits.items()
+                        if rate and kind != INGRESS}
+        # Every throttled message takes a strike; a client that runs out of them is a repeat offender
+        self.strikes = TokenBucket(1 / limits.strike_decay, limits.strikes) if limits.strikes else None
+        self.throttled = False      # Whether the client's last message was throttled
+
+    def check(self, kind: str) -> str or None:
+        now = time.monotonic()
+        limits = (MESSAGE, kind) if kind != MESSAGE else (MESSAGE,)
+        for limit in limits:
+            bucket = self.buckets.get(limit)
+            if bucket is not None and not bucket.ready(now):
+                return limit
+        ingress = self.limits.ingress
+        if ingress is not None and not ingress.take(now):
+            return INGRESS
+        for limit in limits:
+            bucket = self.buckets.get(limit)
+            if bucket is not None:
+                bucket.tokens -= 1
+        return None
+
+    # Count a throttled message against the client; returns True once the client has run out of strikes.
+    def strike(self) -> bool:
+        return self.strikes is not None and not self.strikes.take()
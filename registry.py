@@ -0,0 +1,66 @@
+import threading
+
+
+# ------------------------------------------------- User Registry ---------------------------------------------------- #
+
+# The connected clients, indexed by username. Joining, leaving and renaming are single atomic operations, so the
+# username index can never disagree with the set of clients, whichever threads (or coroutines, which never yield inside
+# these methods) use it. Membership can be tested with either a username or a client.
+class UserRegistry:
+    def __init__(self) -> None:
+        self.lock = threading.RLock()
+        self.emptied = threading.Condition(self.lock)     # Notified whenever the last client is removed
+        self.by_username = {}
+
+    # Register a client under its username; returns False (leaving the registry unchanged) if the name is taken.
+    def add(self, client) -> bool:
+        with self.lock:
+            if client.username in self.by_username:
+                return False
+            self.by_username[client.username] = client
+            return True
+
+    # Unregister a client; returns False if it was not registered (e.g. it has already been removed).
+    def remove(self, client) -> bool:
+        with self.lock:
+            if self.by_username.get(client.username) is not client:
+                return False
+            del self.by_username[client.username]
+            if not self.by_username:
+                self.emptied.notify_all()
+            return True
+
+    # Wait until every client has been removed, or the timeout runs out; returns True if the registry is empty.
+    def wait_empty(self, timeout: float = None) -> bool:
+        with self.emptied:
+            return self.emptied.wait_for(lambda: not self.by_username, timeout)
+
+    # Move a client to a new username (also updating client.username); returns False if the name is taken.
+    def rename(self, client, new_username: str) -> bool:
+        with self.lock:
+            if new_username in self.by_username or self.by_username.get(client.username) is not client:
+                return False
+            del self.by_username[client.username]
+            client.username = new_username
+            self.by_username[new_username] = client
+            return True
+
+    def get(self, username: str):
+        return self.by_username.get(username)
+
+    def usernames(self) -> list:
+        with self.lock:
+            return list(self.by_username)
+
+    def __contains__(self, item) -> bool:
+        if isinstance(item, str):
+            return item in self.by_username
+        return self.by_username.get(item.username) is item
+
+    def __len__(self) -> int:
+        return len(self.by_username)
+
+    # Iterates over a snapshot, so clients may join or leave during the iteration.
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.by_username.values()))
@@ -0,0 +1,54 @@
+import threading
+
+
+# ---------------------------------------------- INITIALISATION ------------------------------------------------------ #
+
+DEFAULT_ROOM = 'lobby'      # Every client starts in (and returns to, after /part) this room
+
+
+# --------------------------------------------------- Room Index ----------------------------------------------------- #
+
+# The members of every room, as a set per room, so joining or leaving a room is O(1) and sending to a room only
+# touches that room's members. A client is in exactly one room at a time, recorded in its room attribute. Empty rooms
+# (other than the default room) are deleted.
+class RoomIndex:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.members = {DEFAULT_ROOM: set()}
+
+    # Move a client into a room, creating the room if needed; returns the room the client was in before (or None).
+    def join(self, client, room: str) -> str or None:
+        with self.lock:
+            previous = self._remove(client)
+            self.members.setdefault(room, set()).add(client)
+            client.room = room
+            return previous
+
+    # Take a client out of its room, e.g. when it disconnects; returns the room it was in (or None).
+    def leave(self, client) -> str or None:
+        with self.lock:
+            return self._remove(client)
+
+    def _remove(self, client) -> str or None:
+        room = getattr(client, 'room', None)
+        members = self.members.get(room)
+        if members is None:
+            return None
+        members.discard(client)
+        if not members and room != DEFAULT_ROOM:
+            del self.members[room]
+        client.room = None
+        return room
+
+    # A snapshot of the members of a room, safe to iterate while clients join and leave.
+    def members_of(self, room: str) -> list:
+        with self.lock:
+            return list(self.members.get(room, ()))
+
+    # Every room with its number of members, largest first.
+    def counts(self) -> list:
+        with self.lock:
+            return sorted(((room, len(members)) for room, members in self.members.items()), key=lambda c: (-c[1], c[0]))
+
+    def __contains__(self, room: str) -> bool:
+        return room in self.members
@@ -1,349 +1,1054 @@
+import argparse
+import asyncio
+import atexit
+import base64
+import os
+import signal
 import socket
+import ssl
+import subprocess
 import sys
+import tempfile
 import threading
-import logging
+import time
+
+import bus
+import cluster
+import commands
+import fanout
+import handover
+import heartbeat
+import history
+import logsink
+import metrics
+import presence
+import protocol
+import ratelimit
+import registry
+import rooms
+import store
+from protocol import Frame
 
 
 # ---------------------------------------------- INITIALISATION ------------------------------------------------------ #
 
-HEADER_LENGTH = 4
-FORMAT = 'utf-8'
-DISCONNECT = 'LEAVE'
-MAKE_EXIT = 'END'
-USER_NAME_GET = 'GET_USERNAME'
-USER_NAME_USED = 'USERNAME_IN_USE'
+HEADER_LENGTH = protocol.HEADER_LENGTH
+FORMAT = protocol.FORMAT
+DISCONNECT = protocol.KEYWORDS[protocol.LEAVE]
+MAKE_EXIT = protocol.KEYWORDS[protocol.END]
+USER_NAME_GET = protocol.KEYWORDS[protocol.GET_USERNAME]
+USER_NAME_USED = protocol.KEYWORDS[protocol.USERNAME_IN_USE]
 
+# The username request, offering v2 framing (and compression) to clients that support it.
+USER_NAME_REQUEST = protocol.encode_v1(USER_NAME_GET.encode(FORMAT), offer_v2=True, offer_compression=True)
+# Sent in place of a message that is too long for a v1 client to receive.
+TOO_LONG_NOTICE = Frame('[SERVER] A message was too long for your client to receive, so it was not delivered.')
 
-logging.basicConfig(filename='server.log', level=logging.INFO,
-                    format='%(asctime)s: %(message)s', datefmt='%d/%m/%Y %I:%M:%S %p')
 
 HOST_NAME = '127.0.0.1'  # IP
+ENGINES = ('threads', 'asyncio')
 
-try:
-    PORT = int(sys.argv[1])
-except Exception as err:
-    print('Couldn\'t start server! Ensure you include the port when starting the server. (Error: {})'.format(str(err)))
-    sys.exit(1)
+# Set from the command line arguments when the server is started (see the bottom of the file).
+PORT = None
+ADDRESS = None
+ENGINE = 'threads'
+QUEUE_SIZE = fanout.DEFAULT_QUEUE_SIZE      # Frames each client's outbound queue holds
+OVERFLOW_POLICY = fanout.DISCONNECT         # What happens when a client's outbound queue is full
+MAX_FRAME_SIZE = protocol.DEFAULT_MAX_FRAME_SIZE    # Longest frame (in bytes) accepted from a v2 client
+COMPRESSION_THRESHOLD = protocol.DEFAULT_COMPRESSION_THRESHOLD  # Shortest message compressed (0: never compress)
+REPLAY_COUNT = 20       # Messages of a room's history replayed to clients as they join it
+SEARCH_LIMIT = 20       # Most messages returned by one /search
+WORKER = None           # Number of this process, when it is one of several worker processes (see run_workers)
+HANDSHAKE_TIMEOUT = 10.0    # Seconds a new connection has to complete the TLS and username handshakes
+TLS_TICKETS = 2         # TLS session tickets given to each client, each letting it resume its session once
+SHUTDOWN_TIMEOUT = 5.0  # Seconds clients have to leave when the server shuts down, before they are disconnected
 
-ADDRESS = (HOST_NAME, PORT)
+serverSocket = None     # Listening socket of the threads engine
+event_loop = None       # Running event loop of the asyncio engine
+stop_serving = None     # asyncio.Event that ends the asyncio engine's accept loop when set
+unpaused = None         # asyncio.Event, cleared while the asyncio engine is paused for a hot restart
+async_server = None     # asyncio.Server accepting the asyncio engine's connections
+pauser = None           # handover.Pauser of the threads engine's threads (None if the server can't be hot restarted)
+handover_channel = None     # Socket the previous server hands over on, in a server started by a hot restart
+restart_command = None  # The command that started this server, which a hot restart runs again
+restart_lock = threading.Lock()     # Held during a hot restart
+shutdown_requested = False  # Set by request_shut_down, for the main thread to shut the server down
+metrics_server = None   # The HTTP server serving the metrics, if any
+log_sink = None         # logsink.LogSink that log() hands messages to
+tls_context = None      # ssl.SSLContext that connections are wrapped in (None if the server uses plain TCP)
+message_store = None    # store.MessageStore that chat and whispers are recorded in (None if it is disabled)
+hub = None              # bus.Worker linking a worker to its hub, or cluster.ClusterNode linking a node to the others
 
-try:
-    serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Overcomes "address already in use" error
-except socket.error as err:
-    print('Error occurred whilst attempting to create the server socket. (Error: {})'.format(str(err)))
-    sys.exit(1)
+clients = registry.UserRegistry()     # Every connected Client, indexed by username
+room_index = rooms.RoomIndex()        # The members of every room
+# Every user online (with several workers or a cluster, on every worker or node), sorted, and the presence subscribers
+users_online = presence.Presence()
+message_history = history.MessageHistory()     # The recent messages of every room
+rate_limits = None      # ratelimit.RateLimits: how fast clients may send, and the ingress budget (see configure_limits)
+reaper = None           # heartbeat.Reaper that pings silent clients and evicts dead or idle ones (see configure_limits)
 
-clients = set()
-usernames = set()
+command_table = commands.CommandTable()     # Every command clients may use (see Commands, below)
 
-commands = {"/rename": ("/rename [New Username]", "Function: Renames your username to [New Username]."),
-            "/users": ("/users", "Function: Outputs a list of all users currently online."),
-            "/whisper": ("/whisper [Username] [Message...]",
-                         "Function: Sends a private message to [Username]. Remember, usernames are case sensitive."),
-            "/help": ("/help [/command (optional)]", "Function: Returns information about a specified command; "
-                      "if no command is specified then outputs a list of available commands. "
-                      "Commands are case sensitive."),
-            "/leave": ("/leave", "Function: Removes you from the server.")}
+# Metrics, served over HTTP with --metrics-port and logged by the /stats console command. Values that can be read off
+# the server's state (such as the number of users) are only computed when the metrics are collected.
+server_metrics = metrics.MetricsRegistry()
+bytes_received = server_metrics.counter('chat_received_bytes_total', 'Bytes received from clients.')
+frame_sizes = server_metrics.histogram('chat_received_frame_bytes', 'Sizes of the frames received from clients.',
+                                       metrics.BYTES_BUCKETS)
+handling_time = server_metrics.histogram('chat_handle_message_seconds', 'Time taken to act upon a received frame.')
+command_times = {}      # Histogram of the time taken by each command, fed by time_command
+broadcast_times = {scope: server_metrics.histogram('chat_broadcast_seconds', 'Time taken to queue a message for '
+                                                   'every recipient of a broadcast.', scope=scope)
+                   for scope in ('server', 'room')}
+broadcast_recipients = server_metrics.counter('chat_broadcast_recipients_total', 'Frames queued by broadcasts.')
+removal_time = server_metrics.histogram('chat_remove_client_seconds', 'Time taken to remove a client.')
+handler_errors = {kind: server_metrics.counter('chat_handler_errors_total', 'Errors met while handling clients.',
+                                               kind=kind)
+                  for kind in ('command', 'message', 'framing', 'connection', 'bus')}
+throttled_messages = {limit: server_metrics.counter('chat_throttled_messages_total', 'Messages dropped for breaking '
+                                                   'a rate limit.', limit=limit) for limit in ratelimit.KINDS}
+throttle_kicks = server_metrics.counter('chat_throttle_kicks_total', 'Clients kicked for repeatedly breaking the rate '
+                                        'limits.')
+compression_saved_bytes = server_metrics.counter('chat_compression_saved_bytes_total', 'Bytes not sent to clients '
+                                                 'thanks to compression.')
+tls_handshakes = {resumed: server_metrics.counter('chat_tls_handshakes_total', 'Completed TLS handshakes.',
+                                                  resumed='yes' if resumed else 'no') for resumed in (True, False)}
+tls_failures = server_metrics.counter('chat_tls_handshake_failures_total', 'TLS handshakes that failed or timed out.')
+tls_handshake_time = server_metrics.histogram('chat_tls_handshake_seconds', 'Time taken by TLS handshakes.')
+heartbeat_pings = server_metrics.counter('chat_heartbeat_pings_total', 'PINGs sent to silent clients.')
+evictions = {reason: server_metrics.counter('chat_evicted_clients_total', 'Clients evicted by the reaper.',
+                                            reason=reason) for reason in heartbeat.REASONS}
+# The final counters of the outbound queues of removed clients
+closed_queue_totals = {'sent_bytes': metrics.Counter(), 'dropped': metrics.Counter()}
 
 
 # --------------------------------------------------- Client Class --------------------------------------------------- #
 
 # Class containing the essential information about all connected clients, and methods "invoked" by them
 class Client:
-    def __init__(self, client_socket: socket.socket, username: str, client_address: str) -> None:
+    def __init__(self, client_socket: socket.socket, username: str, client_address: str,
+                 decoder: protocol.FrameDecoder) -> None:
         self.client_socket = client_socket
         self.username = username
         self.client_address = client_address
+        self.decoder = decoder              # Buffers and decodes the frames received from the client
+        self.room = None                    # Set by room_index
+        self.version = decoder.version      # Framing version agreed during the username handshake
+        # Messages at least this long are sent compressed, if the client accepted compression (0 if not)
+        self.compression_threshold = COMPRESSION_THRESHOLD if self.version == protocol.V2 and \
+            decoder.compression_offered else 0
+        self.outbound = open_outbound(self)
+        self.limiter = rate_limits.limiter()    # The client's token buckets
+        self.last_seen = self.last_active = time.monotonic()    # When the client last sent anything / a message
+        self.last_ping = 0.0                # When the reaper last sent the client a PING
+
+    # Queue a message for this client; it is written by the client's own writer, so this never blocks on the socket.
+    # Messages going to several clients should be passed as a Frame, so that they are only encoded once.
+    def send(self, message: str or Frame) -> None:
+        if not isinstance(message, Frame):
+            message = Frame(message)
+        try:
+            data = message.encode(self.version, self.compression_threshold)
+        except protocol.FrameTooLarge:
+            data = TOO_LONG_NOTICE.encode(self.version)
+        if data is message.v2z and data is not message.v2:
+            compression_saved_bytes.inc(len(message) + protocol.V2_HEADER_LENGTH - len(data))
+        self.outbound.put(data)
 
     def error_handle(self, command: str, error: Exception) -> None:
-        send_server_message("An error occurred! The {} command has failed for unforeseen reasons.".format(command),
-                            self.client_socket)
+        self.send("An error occurred! The {} command has failed for unforeseen reasons.".format(command))
         log('[PROTOCOL ERROR] Error ({}) occurred after {} attempted the {} command.'
             .format(str(error), self.username, command))
 
+    # Tell the client a command could not be carried out because the hub did not answer (see bus.Worker.request).
+    def hub_error_handle(self, command: str, error: bus.BusError) -> None:
+        handler_errors['bus'].inc()
+        self.send('The {} command could not be carried out right now; please try again shortly.'.format(command))
+        log('[BUS ERROR] {} ({} attempted the {} command.)'.format(str(error), self.username, command))
+
     def param_error_handle(self, command: str) -> None:
-        send_server_message('Invalid parameters! Ensure command is in the form: {}.'.format(commands[command][0]),
-                            self.client_socket)
+        self.send('Invalid parameters! Ensure command is in the form: {}.'.format(command_table.get(command).usage))
         log('[PROTOCOL ERROR] {} inputted the wrong parameters for the {} command.'.format(self.username, command))
 
     def send_all(self, message: str) -> None:
-        log("[NEW MESSAGE] Received message from {}: {}".format(self.username, message))
-        broadcast('{}> {}'.format(self.username, message))
+        log("[NEW MESSAGE] Received message from {} in {}: {}".format(self.username, self.room, message))
+        broadcast_room(self.room, Frame('{}> {}'.format(self.username, message)), keep=True)
+        record_event(store.CHAT, self.username, self.room, message)
 
     def change_username(self, new_username: str) -> None:
         if new_username == self.username:
-            send_server_message('Your username is already set as {}!'.format(new_username), self.client_socket)
+            self.send('Your username is already set as {}!'.format(new_username))
             log('[PROTOCOL ERROR] {} tried to change their username to their current username.'.format(self.username))
-        elif new_username in usernames:
-            send_server_message('There already exists a user called {}!'.format(new_username), self.client_socket)
-            log('[PROTOCOL ERROR] {} tried to change their username to an existing one.'.format(self.username))
         elif not len(new_username):
-            send_server_message('You can\'t change your username to nothing!', self.client_socket)
+            self.send('You can\'t change your username to nothing!')
             log('[PROTOCOL ERROR] {} tried to change their username to nothing.'.format(self.username))
         else:
-            usernames.remove(self.username)
-            usernames.add(new_username)
-            broadcast('The user {} has changed their username to {}.'.format(self.username, new_username))
+            old_username = self.username
+            try:
+                claimed = hub is None or hub.request('rename', old=old_username, new=new_username)['ok']
+            except bus.BusError as e:
+                self.hub_error_handle('/rename', e)
+                return
+            if not claimed or not clients.rename(self, new_username):
+                self.send('There already exists a user called {}!'.format(new_username))
+                log('[PROTOCOL ERROR] {} tried to change their username to an existing one.'.format(self.username))
+                return
+            if hub is None:     # Otherwise every worker (or node) is told of the change by the hub
+                users_online.rename(old_username, new_username)
+            broadcast_room(self.room, 'The user {} has changed their username to {}.'
+                           .format(old_username, new_username))
             log('[USERNAME CHANGE] The user from {}:{} has changed their username from {} to {}.'
-                .format(self.client_address[0], self.client_address[1], self.username, new_username))
-            self.username = new_username
+                .format(self.client_address[0], self.client_address[1], old_username, new_username))
 
-    def list_users(self) -> None:
-        num_users = len(usernames)
-        if num_users == 1:
-            message = "There is only 1 user online: \n{}.".format(list(usernames)[0])
+    # List a page (counting from 1) of the users online, or the users whose usernames begin with a prefix. Each is read
+    # off the sorted presence index, so it costs the same however many users are online.
+    def list_users(self, argument: str = '') -> None:
+        num_users = len(users_online)
+        if argument.isdigit() or not argument:
+            page, pages = int(argument or 1), users_online.pages()
+            if not 1 <= page <= pages:
+                self.send('There is no page {} of the users online; there {} {} page{}.'
+                          .format(page, 'is' if pages == 1 else 'are', pages, '' if pages == 1 else 's'))
+                log('[PROTOCOL ERROR] {} requested a page of users that does not exist.'.format(self.username))
+                return
+            usernames = users_online.page(page)
+            if num_users == 1:
+                message = "There is only 1 user online: \n{}.".format(usernames[0])
+            elif pages == 1:
+                message = "There are {} users currently online: \n{}".format(num_users, '\n'.join(usernames))
+            else:
+                message = "There are {} users currently online (page {} of {}): \n{}".format(
+                    num_users, page, pages, '\n'.join(usernames))
+                if page < pages:
+                    message += '\nType /users {} for the next page.'.format(page + 1)
         else:
-            message = "There are {} users currently online: ".format(str(num_users))
-            for username in usernames:
-                message += "\n{}".format(username)
-        send_server_message(message, self.client_socket)
+            usernames, matching = users_online.starting_with(argument)
+            if not matching:
+                self.send('None of the {} users online have a username beginning with {}.'.format(num_users, argument))
+                log('[USER LIST] {} searched for users, finding none.'.format(self.username))
+                return
+            message = "{} of the {} users online ha{} a username beginning with {}: \n{}".format(
+                matching, num_users, 's' if matching == 1 else 've', argument, '\n'.join(usernames))
+            if matching > len(usernames):
+                message += '\n... and {} more; type more of the username to narrow them down.'.format(
+                    matching - len(usernames))
+        self.send(message)
         log('[USER LIST] {} requested a list of users.'.format(self.username))
 
+    def watch_presence(self, setting: str) -> None:
+        if setting == 'on':
+            num_users = users_online.subscribe(self)
+            self.send('You will now be told as users join, leave, or change their usernames ({} online).'
+                      .format(num_users))
+            log('[PRESENCE] {} subscribed to presence updates.'.format(self.username))
+        elif users_online.unsubscribe(self):
+            self.send('You will no longer be told as users join, leave, or change their usernames.')
+            log('[PRESENCE] {} unsubscribed from presence updates.'.format(self.username))
+        else:
+            self.send('You are not subscribed to presence updates!')
+            log('[PROTOCOL ERROR] {} tried to unsubscribe from presence updates without subscribing.'
+                .format(self.username))
+
     def whisper(self, username: str, message: str) -> None:
+        to_client = clients.get(username)
         if username == self.username:
-            send_server_message('You can\'t whisper to yourself!', self.client_socket)
+            self.send('You can\'t whisper to yourself!')
             log('[PROTOCOL ERROR] {} tried to whisper to themself.'.format(self.username))
-        elif username not in usernames:
-            send_server_message('Could not locate the user {}! Type /users to see who is online.'.format(username),
-                                self.client_socket)
-            log('[PROTOCOL ERROR] {} tried to whisper to a non-existing user.'.format(self.username))
         elif len(message) == 0:
-            send_server_message('You can\'t whisper nothing! Please include a message.', self.client_socket)
+            self.send('You can\'t whisper nothing! Please include a message.')
             log('[PROTOCOL ERROR] {} tried to whisper without including a message.'.format(self.username))
         else:
-            to_client = [client for client in clients if client.username == username][0].client_socket
-            send_server_message('From you to {}> {}'.format(username, message), self.client_socket)
-            send_server_message('From {} to you> {}'.format(self.username, message), to_client)
+            # A user who is not connected to this worker may be connected to another; the hub passes the whisper on
+            if to_client is None:
+                try:
+                    found = hub is not None and hub.request('whisper', sender=self.username, to=username,
+                                                            message=message)['ok']
+                except bus.BusError as e:
+                    self.hub_error_handle('/whisper', e)
+                    return
+                if not found:
+                    self.send('Could not locate the user {}! Type /users to see who is online.'.format(username))
+                    log('[PROTOCOL ERROR] {} tried to whisper to a non-existing user.'.format(self.username))
+                    return
+            self.send('From you to {}> {}'.format(username, message))
+            if to_client is not None:
+                to_client.send('From {} to you> {}'.format(self.username, message))
             log('[WHISPER] {} whispered to {}: {}'.format(self.username, username, message))
+            record_event(store.WHISPER, self.username, username, message)
 
-    def help(self, command: str) -> None:
+    def help(self, command: str = '') -> None:
         if len(command):
-            if command in commands:
-                out = commands[command]
-                send_server_message('Format: {}.\n{}'.format(out[0], out[1]), self.client_socket)
+            if command in command_table:
+                out = command_table.get(command)
+                self.send('Format: {}.\n{}'.format(out.usage, out.description))
                 log('[HELP] {} requested help for the {} command.'.format(self.username, command))
             else:
-                send_server_message('/help command failed, {} is not a valid command!'.format(command),
-                                    self.client_socket)
+                self.send('/help command failed, {} is not a valid command!'.format(command))
                 log('[PROTOCOL ERROR] {} attempted to use the /help command on a non-existing command.'
                     .format(self.username))
         else:
-            send_server_message("List of commands: /rename, /users, /whisper, /help, /leave.\n"
-                                "Type /help [/command] for more info about that command.", self.client_socket)
+            self.send("List of commands: {}.\n"
+                      "Type /help [/command] for more info about that command.".format(', '.join(command_table)))
             log('[HELP] {} used the /help command.'.format(self.username))
 
+    def join_room(self, room: str) -> None:
+        if room == self.room:
+            self.send('You are already in {}!'.format(room))
+            log('[PROTOCOL ERROR] {} tried to join the room they are already in.'.format(self.username))
+        elif not len(room):
+            self.send('You can\'t join a room with no name!')
+            log('[PROTOCOL ERROR] {} tried to join a room with no name.'.format(self.username))
+        else:
+            previous = room_index.join(self, room)
+            if hub is not None:
+                hub.publish('move', username=self.username, room=room)
+            if previous not in room_index:
+                message_history.forget(previous)
+            broadcast_room(previous, '{} has left the room.'.format(self.username))
+            broadcast_room(room, '{} has joined the room {}.'.format(self.username, room))
+            self.replay_history(REPLAY_COUNT)
+            log('[ROOM] {} moved from {} to {}.'.format(self.username, previous, room))
+
+    def part_room(self) -> None:
+        if self.room == rooms.DEFAULT_ROOM:
+            self.send('You are already in the {}, which can\'t be left (use /leave to leave the server).'
+                      .format(rooms.DEFAULT_ROOM))
+            log('[PROTOCOL ERROR] {} tried to part from the {}.'.format(self.username, rooms.DEFAULT_ROOM))
+        else:
+            self.join_room(rooms.DEFAULT_ROOM)
+
+    def list_rooms(self) -> None:
+        try:
+            counts = hub.request('rooms')['rooms'] if hub is not None else room_index.counts()
+        except bus.BusError as e:
+            self.hub_error_handle('/rooms', e)
+            return
+        message = "Rooms (you are in {}):".format(self.room)
+        for room, members in counts:
+            message += "\n{} ({} user{})".format(room, members, '' if members == 1 else 's')
+        self.send(message)
+        log('[ROOM LIST] {} requested a list of rooms.'.format(self.username))
+
+    # Send the client the last count messages of their room; the stored frames are sent as they are, without encoding.
+    def replay_history(self, count: int = None) -> int:
+        frames = message_history.recent(self.room, count)
+        if frames:
+            self.send('--- The last {} message{} in {} ---'.format(len(frames), '' if len(frames) == 1 else 's',
+                                                                   self.room))
+            for frame in frames:
+                self.send(frame)
+        return len(frames)
+
+    def history(self, count: str = '') -> None:
+        if len(count) and (not count.isdigit() or int(count) == 0):
+            self.param_error_handle('/history')
+        elif not self.replay_history(int(count) if len(count) else None):
+            self.send('There are no messages to show from {}.'.format(self.room))
+            log('[HISTORY] {} requested the history of {}, which is empty.'.format(self.username, self.room))
+        else:
+            log('[HISTORY] {} requested the history of {}.'.format(self.username, self.room))
+
+    def search(self, username: str, minutes: str = '') -> None:
+        if len(minutes) and not minutes.isdigit():
+            self.param_error_handle('/search')
+            return
+        since = time.time() - 60 * int(minutes) if len(minutes) else None
+        try:
+            events = search_store(None if username == '*' else username, since, self)
+        except bus.BusError as e:
+            self.hub_error_handle('/search', e)
+            return
+        if events is None:
+            self.send('Searching is not available on this server.')
+            log('[SEARCH] {} tried to search, but the message store is disabled.'.format(self.username))
+            return
+        if not events:
+            self.send('No messages found.')
+        else:
+            lines = []
+            for event in events:
+                when = time.strftime('%d/%m/%Y %H:%M:%S', time.localtime(event.timestamp))
+                if event.kind == store.WHISPER:
+                    lines.append('[{}] {} whispered to {}> {}'.format(when, event.sender, event.target, event.text))
+                else:
+                    lines.append('[{}] {} in {}> {}'.format(when, event.sender, event.target, event.text))
+            self.send('--- {} message{} found ---\n{}'.format(len(events), '' if len(events) == 1 else 's',
+                                                               '\n'.join(lines)))
+        log('[SEARCH] {} searched for messages from {} ({} found).'.format(self.username, username, len(events)))
+
     def leave(self) -> None:
-        send_server_message('Goodbye, {}.'.format(self.username), self.client_socket)
-        send_server_message(DISCONNECT, self.client_socket)
+        self.send('Goodbye, {}.'.format(self.username))
+        self.send(Frame.control(protocol.LEAVE))
         log('[LEAVE] {} used the /leave command.'.format(self.username))
         remove_client(self)
 
-    # Function for distinguishing between the commands
+    # Function for distinguishing between the commands: the command is looked up in the command table, which also
+    # checks and splits up its arguments, and carried out with them.
     def query_message(self, message: str) -> None:
         if message[0] == '/':
-            words = message.split(' ')
+            started = command_table.start()
+            command, arguments = command_table.parse(message)
             try:
-                if words[0] == '/rename':
-                    if len(words) != 2:
-                        self.param_error_handle('/rename')
-                    else:
-                        self.change_username(words[1])
-                elif words[0] == '/users':
-                    if len(words) > 1:
-                        self.param_error_handle('/users')
-                    else:
-                        self.list_users()
-                elif words[0] == '/whisper':
-                    if len(words) < 3:
-                        self.param_error_handle('/whisper')
-                    else:
-                        self.whisper(words[1], ' '.join(words[2:]))
-                elif words[0] == '/help':
-                    if len(words) == 2:
-                        self.help(words[1])
-                    elif len(words) == 1:
-                        self.help('')
-                    else:
-                        self.param_error_handle('/help')
-                elif words[0] == '/leave':
-                    if len(words) > 1:
-                        self.param_error_handle('leave')
-                    else:
-                        self.leave()
-                else:
-                    send_server_message('{} is not a valid command.'.format(words[0]), self.client_socket)
+                if command is None:
+                    name = message.partition(' ')[0]
+                    self.send('{} is not a valid command.'.format(name))
                     log('[PROTOCOL ERROR] {} attempted the command {}, which doesn\'t exist.'
-                        .format(self.username, words[0]))
+                        .format(self.username, name))
+                elif arguments is None:
+                    self.param_error_handle(command.name)
+                else:
+                    command.handler(self, *arguments)
             except Exception as e:
-                self.error_handle(words[0], e)
+                handler_errors['command'].inc()
+                self.error_handle(message.partition(' ')[0], e)
+            command_table.timed(command, started)
         else:
             try:
                 self.send_all(message)
             except Exception as e:
-                send_server_message('Something unforeseen went wrong whilst processing your message!',
-                                    self.client_socket)
+                handler_errors['message'].inc()
+                self.send('Something unforeseen went wrong whilst processing your message!')
                 log('[ERROR] Error occurred ({}) upon {} sending the message {}.'
                     .format(str(e), self.username, message))
 
 
+# ----------------------------------------------------- Commands ----------------------------------------------------- #
+
+# The commands clients may use, in the order /help lists them. Plug-ins (--plugin) add theirs to the same table.
+command_table.add(commands.Command(
+    '/rename', Client.change_username, '/rename [New Username]', 'Function: Renames your username to [New Username].',
+    min_args=1, max_args=1, blocking=True))
+command_table.add(commands.Command(
+    '/users', Client.list_users, '/users [Page number or start of username (optional)]', 'Function: Outputs a page '
+    'of the list of all users currently online, in alphabetical order, or the users whose usernames begin with the '
+    'given letters.', max_args=1))
+command_table.add(commands.Command(
+    '/presence', Client.watch_presence, '/presence [on/off]', 'Function: Sends you the list of users online, then '
+    'tells you as users join, leave, or change their usernames, until you turn it off. Each update begins with {} and '
+    'has a line per change: + for a join, - for a departure, ~ for a new username.'.format(presence.HEADER),
+    min_args=1, max_args=1, choices=('on', 'off')))
+command_table.add(commands.Command(
+    '/whisper', Client.whisper, '/whisper [Username] [Message...]', 'Function: Sends a private message to '
+    '[Username]. Remember, usernames are case sensitive.', min_args=2, max_args=2, rest=True, blocking=True))
+command_table.add(commands.Command(
+    '/help', Client.help, '/help [/command (optional)]', 'Function: Returns information about a specified command; '
+    'if no command is specified then outputs a list of available commands. Commands are case sensitive.',
+    max_args=1))
+command_table.add(commands.Command(
+    '/leave', Client.leave, '/leave', 'Function: Removes you from the server.'))
+command_table.add(commands.Command(
+    '/join', Client.join_room, '/join [Room]', 'Function: Moves you into [Room], creating it if it doesn\'t exist. '
+    'Your messages are only seen by the users in the same room as you. Room names are case sensitive.',
+    min_args=1, max_args=1))
+command_table.add(commands.Command(
+    '/part', Client.part_room, '/part', 'Function: Moves you out of your current room and back into the {}.'
+    .format(rooms.DEFAULT_ROOM)))
+command_table.add(commands.Command(
+    '/rooms', Client.list_rooms, '/rooms', 'Function: Outputs a list of all rooms and how many users are in each.',
+    blocking=True))
+command_table.add(commands.Command(
+    '/history', Client.history, '/history [Number of messages (optional)]', 'Function: Shows you the most recent '
+    'messages sent in your current room, or only the last [Number of messages] of them.', max_args=1))
+command_table.add(commands.Command(
+    '/search', Client.search, '/search [Username or *] [Minutes (optional)]', 'Function: Shows you the most recent '
+    'messages sent by [Username] (or by anyone, for *) in your current room, and their whispers to or from you, going '
+    'back [Minutes] minutes or as far back as the server has kept them.', min_args=1, max_args=2, blocking=True))
+
+
+# The histogram of the time taken by a command (or by invalid ones), made the first time it is needed, e.g. by a
+# command added by a plug-in.
+def command_histogram(name: str) -> metrics.Histogram:
+    histogram = command_times.get(name)
+    if histogram is None:
+        histogram = command_times[name] = server_metrics.histogram('chat_command_seconds', 'Time taken to carry out '
+                                                                   'each command.', command=name)
+    return histogram
+
+
+# Timing hook of the command table.
+def time_command(name: str, seconds: float) -> None:
+    command_histogram(name).observe(seconds)
+
+
+command_table.add_timing_hook(time_command)
+for name in command_table:   # So that every built-in command's histogram is served
+    command_histogram(name)
+
+
 # ------------------------------------------------- Server Functions ------------------------------------------------- #
 
-# Log a message to server.log and print it to the console.
+# Log a message to server.log and print it to the console. The writing is done by the log sink's own thread, so this
+# costs little more than putting the message on a queue.
 def log(message: str) -> None:
-    print(message)
-    logging.info(message)
+    if log_sink is None:    # Not started from the command line (e.g. imported), so there is no log file
+        print(message, file=sys.stderr)
+    else:
+        log_sink.put(message)
 
 
-# Send a message from the server to a single specified client.
-def send_server_message(message: str, client_socket: socket.socket) -> None:
-    encoded_message = message.encode(FORMAT)
-    message_header = "{encoded_length:<{header_length}}"\
-        .format(encoded_length=len(encoded_message), header_length=HEADER_LENGTH).encode(FORMAT)
-    client_socket.send(message_header + encoded_message)
+# Send a message from the server straight to a socket that has no Client (yet), i.e. during the username handshake.
+def send_server_message(message: str or Frame, client_socket: socket.socket, version: int = protocol.V1) -> None:
+    if not isinstance(message, Frame):
+        message = Frame(message)
+    client_socket.send(message.encode(version))
 
 
-# Broadcast a message to all connected clients.
-def broadcast(message: str) -> None:
-    for client in clients:
-        send_server_message(message, client.client_socket)
+# Broadcast a message to all connected clients; the message is framed once and the frame shared between them. Unless
+# relay is False (i.e. the message came from another worker), it is also passed on to the other workers, if any.
+def broadcast(message: str or Frame, relay: bool = True) -> None:
+    started = time.perf_counter()
+    if not isinstance(message, Frame):
+        message = Frame(message)
+    recipients = list(clients)
+    for client in recipients:
+        client.send(message)
+    if relay and hub is not None:
+        hub.publish('deliver', room=None, message=message.message)
+    broadcast_times['server'].observe(time.perf_counter() - started)
+    broadcast_recipients.inc(len(recipients))
+
+
+# Send a message to the members of one room only, framing it once, and keep it in the room's history if keep is True.
+def broadcast_room(room: str, message: str or Frame, keep: bool = False, relay: bool = True) -> None:
+    started = time.perf_counter()
+    if not isinstance(message, Frame):
+        message = Frame(message)
+    recipients = room_index.members_of(room)
+    for client in recipients:
+        client.send(message)
+    # A worker only keeps the history of the rooms its own clients are in
+    if keep and (relay or room in room_index):
+        message_history.record(room, message)
+    if relay and hub is not None:
+        hub.publish('deliver', room=room, message=message.message, keep=keep)
+    broadcast_times['room'].observe(time.perf_counter() - started)
+    broadcast_recipients.inc(len(recipients))
+
+
+# Record a chat message or whisper in the message store. With several workers the hub keeps the store; in a cluster
+# every node keeps a store of its own, of the messages of the whole cluster.
+def record_event(kind: int, sender: str, target: str, text: str) -> None:
+    if message_store is not None:
+        message_store.append(kind, sender, target, text)
+    if hub is not None:
+        hub.publish('record', event=[kind, sender, target, text])
+
+
+# The most recent stored events sent by a user (or by anyone, if user is None) since a time, out of those the given
+# client may see; returns None if there is no message store.
+def search_store(user: str or None, since: float or None, client: Client) -> list or None:
+    if message_store is not None:
+        return message_store.query(user, since=since, limit=SEARCH_LIMIT,
+                                   seen_by=(client.username, client.room))
+    if hub is not None:
+        events = hub.request('search', user=user, since=since, limit=SEARCH_LIMIT,
+                             visible_to=[client.username, client.room])['events']
+        return None if events is None else [store.Event(*event) for event in events]
+    return None
+
+
+# Claim a username for a new client. With several workers the hub decides, as the name may be taken on another worker;
+# returns None if the hub did not answer.
+def claim_username(username: str) -> bool or None:
+    if hub is not None:
+        try:
+            return hub.request('claim', username=username, room=rooms.DEFAULT_ROOM)['ok']
+        except bus.BusError as e:
+            return claim_unanswered(username, e)
+    return username not in clients
+
+
+# Coroutine counterpart of claim_username. A hub in another process is awaited, as waiting for its answer would hold up
+# the event loop (and every other client with it).
+async def claim_username_async(username: str) -> bool or None:
+    if isinstance(hub, bus.Worker):
+        try:
+            return (await hub.request_async('claim', username=username, room=rooms.DEFAULT_ROOM))['ok']
+        except bus.BusError as e:
+            return claim_unanswered(username, e)
+    return claim_username(username)
+
+
+def claim_unanswered(username: str, error: bus.BusError) -> None:
+    handler_errors['bus'].inc()
+    log('[BUS ERROR] {} (A new connection asked for the username {}.)'.format(str(error), username))
+    # The hub may yet grant the claim, once it catches up; it handles the release after it, undoing it
+    hub.publish('release', username=username)
+
 
+# Whether a frame is a command that may wait on a hub in another process (see commands.Command.blocking), which the
+# asyncio engine therefore handles on an executor thread.
+def waits_on_hub(frame: Frame) -> bool:
+    if not isinstance(hub, bus.Worker) or not frame.message.startswith('/'):
+        return False
+    command = command_table.get(frame.message.partition(' ')[0])
+    return command is not None and command.blocking
 
-# Attempt to retrieve a message from a client.
-def receive_message(client_socket: socket.socket) -> str or None:
-    message_header = client_socket.recv(HEADER_LENGTH)
-    if len(message_header):
-        message_length = int(message_header.decode(FORMAT).strip())
-        message = client_socket.recv(message_length).decode(FORMAT)
-        return message
 
+# Create the outbound queue of a new client, with a writer suited to the engine the client is connected through.
+def open_outbound(client: Client) -> fanout.OutboundQueue:
+    if isinstance(client.client_socket, StreamSocket):
+        return fanout.AsyncOutbound(client.client_socket.writer, QUEUE_SIZE, OVERFLOW_POLICY,
+                                    lambda: drop_slow_client(client))
+    return fanout.ThreadedOutbound(client.client_socket, QUEUE_SIZE, OVERFLOW_POLICY,
+                                   lambda: drop_slow_client(client), held=True)     # Until client_handler is done
+
+
+# Disconnect a client that could not keep up with the messages sent to it.
+def drop_slow_client(client: Client) -> None:
+    log('[SLOW CLIENT] Disconnected {}, as their outbound queue overflowed.'.format(client.username))
+    remove_client(client)
+
+
+# Attempt to retrieve a message from a client. Frames are decoded from a buffer filled a chunk at a time, so a burst of
+# messages costs one recv; returns None once the client has closed the connection. Given a poller (see handover.Pauser),
+# data that is already waiting is read straight away, and only when there is none does the thread wait for it by
+# polling, parking instead if the server is paused.
+def receive_message(client_socket: socket.socket, decoder: protocol.FrameDecoder,
+                    poller=None) -> Frame or None:
+    frame = decoder.next_frame()
+    while frame is None:
+        received = None
+        if poller is not None:
+            received = recv_waiting(client_socket, decoder)
+            if received is None and not pauser.wait_readable(poller):
+                pauser.park(client_socket)
+                continue
+        if received is None:
+            received = decoder.recv_into(client_socket)
+        if not received:
+            return None
+        bytes_received.inc(received)
+        frame = decoder.next_frame()
+    frame_sizes.observe(len(frame))
+    return frame
+
+
+# Receive whatever a socket already has waiting without blocking; returns None if there is nothing. Only used on plain
+# TCP sockets, as a server using TLS can't be hot restarted (see can_restart) and so has no pauser.
+def recv_waiting(client_socket: socket.socket, decoder: protocol.FrameDecoder) -> int or None:
+    try:
+        return decoder.recv_into(client_socket, socket.MSG_DONTWAIT)
+    except BlockingIOError:
+        return None
 
-# Remove a client from the server (i.e., stop storing their data and close their socket.)
+
+# Retrieve the username a new client sends in answer to the username request, switching the decoder over to v2 framing
+# if the client accepted the offer of it.
+def receive_username(client_socket: socket.socket, decoder: protocol.FrameDecoder) -> str or None:
+    try:
+        frame = receive_message(client_socket, decoder)
+    except (OSError, ValueError):
+        return None
+    if frame is None:
+        return None
+    if decoder.v2_offered:
+        decoder.version = protocol.V2
+    return frame.message
+
+
+# Remove a client from the server (i.e., stop storing their data and close their socket.) Removing a client that has
+# already been removed does nothing.
 def remove_client(client: Client) -> None:
-    usernames.remove(client.username)
-    clients.remove(client)
-    client.client_socket.close()
-    broadcast('{} has left.'.format(client.username))
+    if not clients.remove(client):
+        return
+    started = time.perf_counter()
+    room = room_index.leave(client)
+    if room not in room_index:
+        message_history.forget(room)
+    if hub is not None:
+        hub.publish('release', username=client.username)
+    else:
+        users_online.leave(client.username)
+    users_online.unsubscribe(client)
+    reaper.forget(client)
+    client.outbound.close()
+    closed_queue_totals['sent_bytes'].inc(client.outbound.sent_bytes)
+    closed_queue_totals['dropped'].inc(client.outbound.dropped)
+    broadcast_room(room, '{} has left.'.format(client.username))
     log("[CONNECTION CLOSED] Closed connection from the user {} from {}:{}."
         .format(client.username, client.client_address[0], client.client_address[1]))
+    removal_time.observe(time.perf_counter() - started)
+
+
+# Drop a message that broke a rate limit. The client is told the first time in a row it is throttled, and kicked once it
+# has been throttled too often (running out of the global ingress budget is not held against it); returns False if the
+# client was kicked.
+def throttle(client: Client, limit: str) -> bool:
+    throttled_messages[limit].inc()
+    if limit != ratelimit.INGRESS and client.limiter.strike():
+        throttle_kicks.inc()
+        log('[FLOOD] {} kept sending messages too quickly.'.format(client.username))
+        kick_user(['/kick', client.username])
+        remove_client(client)
+        return False
+    if not client.limiter.throttled:
+        client.limiter.throttled = True
+        if limit == ratelimit.INGRESS:
+            client.send('[SERVER] The server is too busy to handle your messages right now, so they were not '
+                        'delivered; please try again shortly.')
+        else:
+            client.send('[SERVER] You are sending {} too quickly, so it was not delivered; please slow down.'
+                        .format('messages' if limit in (ratelimit.MESSAGE, ratelimit.CHAT) else limit + 's'))
+        log('[FLOOD] Throttled {} for breaking the {} rate limit.'.format(client.username, limit))
+    return True
+
+
+# Act upon a single frame received from a client; returns False once the client has left the server.
+def handle_message(client: Client, frame: Frame) -> bool:
+    started = time.perf_counter()
+    message = frame.message
+    connected = True
+    client.last_seen = time.monotonic()
+    if frame.kind == protocol.END:
+        remove_client(client)
+        connected = False
+    elif frame.kind == protocol.PONG:   # Only shows the client is alive, so it is not held against the rate limits
+        pass
+    else:
+        # PINGs and commands other than /whisper and /rename only count against the limit on all of a client's messages
+        if frame.kind == protocol.PING:
+            kind = ratelimit.MESSAGE
+        elif message.startswith('/'):
+            kind = ratelimit.COMMAND_KINDS.get(message.split(' ', 1)[0], ratelimit.MESSAGE)
+        else:
+            kind = ratelimit.CHAT
+        limit = client.limiter.check(kind)
+        if limit is not None:
+            connected = throttle(client, limit)
+        elif frame.kind == protocol.PING:
+            client.send(heartbeat.PONG_FRAME)
+        elif message.startswith('/'):   # This indicates the user inputted, or attempted to input, a command.
+            client.limiter.throttled = False
+            client.last_active = client.last_seen
+            client.query_message(message)
+            connected = client in clients    # Is False when a client has left.
+        elif message:
+            client.limiter.throttled = False
+            client.last_active = client.last_seen
+            client.send_all(message)
+    handling_time.observe(time.perf_counter() - started)
+    return connected
 
 
 # Function for handling each individual client after they connect; the while loop will continue until the client leaves.
 def client_handler(client: Client) -> None:
+    poller = pauser.poller(client.client_socket) if pauser is not None else None
     connected = True
     while connected:
+        if pauser is not None and pauser.paused:    # Pause between messages for a hot restart
+            pauser.park(client.client_socket)
         try:
-            message = receive_message(client.client_socket)
-            if message[0] == '/':   # This indicates the user inputted, or attempted to input, a command.
-                client.query_message(message)
-                if client not in clients:    # Is True when a client has left.
-                    connected = False
-            elif message == MAKE_EXIT:
-                try:
-                    remove_client(client)
-                except RuntimeError:
-                    # Client already removed
-                    pass
-                connected = False
-            elif message:
-                log("[NEW MESSAGE] Received message from {}: {}".format(client.username, message))
-                broadcast('{}> {}'.format(client.username, message))
-        except WindowsError:  # Excepts when unable to receive message: the client must have forcefully disconnected.
-            try:  # Attempt to remove the client from the database
-                remove_client(client)
-            except RuntimeError:  # Client already removed from database
-                pass
+            frame = receive_message(client.client_socket, client.decoder, poller)
+        except protocol.FramingError:   # Unable to receive: the connection is unreadable...
+            handler_errors['framing'].inc()
+            frame = None
+        except OSError:                 # ... or broken.
+            handler_errors['connection'].inc()
+            frame = None
+        if frame is None:   # The client must have forcefully disconnected.
+            remove_client(client)
             connected = False
+        else:
+            connected = handle_message(client, frame)
+    client.outbound.release()
     sys.exit(0)
 
 
+# Shut the server down. Every client is told to leave, and the server waits (without spinning: it is woken as the last
+# client is removed) until they have all gone, or the shutdown timeout runs out, when any left are disconnected.
 def shut_down() -> None:
-    broadcast('[SERVER WARNING] The server is now self destructing.')
-    client_lst = list(clients)
-    num_clients = len(client_lst)
-    for client in client_lst:
-        send_server_message(MAKE_EXIT, client.client_socket)
-        while len(list(clients)) == num_clients:
-            pass
-        num_clients -= 1
-    serverSocket.close()
+    reaper.stop()
+    engine_running = event_loop is None or not event_loop.is_closed()   # An interrupt closes the event loop
+    if engine_running:  # Otherwise the connections closed with the event loop
+        broadcast('[SERVER WARNING] The server is now self destructing.')
+        exit_frame = Frame.control(protocol.END)
+        for client in clients:
+            client.send(exit_frame)
+        if not clients.wait_empty(SHUTDOWN_TIMEOUT):
+            remaining = list(clients)
+            log('[SHUTDOWN] {} client{} did not leave within {:g} seconds, so {} been disconnected.'
+                .format(len(remaining), '' if len(remaining) == 1 else 's', SHUTDOWN_TIMEOUT,
+                        'has' if len(remaining) == 1 else 'have'))
+            for client in remaining:
+                remove_client(client)
+                try:
+                    client.client_socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
     log('[SERVER CLOSED] The server has been closed.\n')
+    if event_loop is not None and engine_running:
+        event_loop.call_soon_threadsafe(stop_serving.set)
+    if serverSocket is not None:
+        try:    # On Linux, closing the socket alone does not wake the accept loop up
+            serverSocket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        serverSocket.close()
 
 
-def kick_user(words: list) -> None:
+def ping_client(client: Client) -> None:
+    heartbeat_pings.inc()
+    client.send(heartbeat.PING_FRAME)
+
+
+# Called by the reaper for a client that has stopped answering heartbeats (or, with an idle timeout, sending messages).
+# Its socket is shut down as well as closed, as a thread may be blocked reading from or writing to a dead connection.
+def evict_client(client: Client, reason: str) -> None:
+    evictions[reason].inc()
+    if reason == heartbeat.IDLE:
+        log('[IDLE] Disconnected {}, who has not sent a message for {:g} seconds.'
+            .format(client.username, reaper.idle_timeout))
+        client.send('[SERVER] You have been disconnected for being idle.')
+        client.send(Frame.control(protocol.END))
+    else:
+        log('[DEAD CONNECTION] Disconnected {}, who has not answered heartbeats for {:g} seconds.'
+            .format(client.username, reaper.timeout))
+    remove_client(client)
     try:
-        c = [client for client in clients if client.username == words[1]][0]
-        log('[KICK] The user {} has been kicked from the server.'.format(c.username))
-        send_server_message(MAKE_EXIT, c.client_socket)
-    except IndexError:
+        client.client_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+# Build the rate limits and the reaper. They are built with the defaults on import, and again by __main__ from the
+# command line arguments before the server starts.
+def configure_limits(limits: dict = None, strikes: int = ratelimit.DEFAULT_STRIKES,
+                     interval: float = heartbeat.DEFAULT_INTERVAL, timeout: float = heartbeat.DEFAULT_TIMEOUT,
+                     idle_timeout: float = heartbeat.DEFAULT_IDLE_TIMEOUT) -> None:
+    global rate_limits, reaper
+    rate_limits = ratelimit.RateLimits(limits, strikes)
+    reaper = heartbeat.Reaper(evict_client, ping_client, interval, timeout, idle_timeout)
+
+
+configure_limits()
+
+
+def kick_user(words: list) -> None:
+    c = clients.get(words[1]) if len(words) > 1 else None
+    if c is None:
         log('[ERROR] Kick failed as the user was not found.')
+    else:
+        log('[KICK] The user {} has been kicked from the server.'.format(c.username))
+        c.send(Frame.control(protocol.END))
+
+
+# Metrics read off the server's state when they are collected, rather than updated as the server runs.
+def register_state_metrics() -> None:
+    def queue_total(counter: str):
+        return lambda: closed_queue_totals[counter].value + sum(getattr(client.outbound, counter) for client in clients)
+
+    server_metrics.callback('chat_connected_users', 'Users currently connected.', lambda: len(clients))
+    server_metrics.callback('chat_rooms', 'Rooms that currently exist.', lambda: len(room_index.counts()))
+    server_metrics.callback('chat_presence_subscribers', 'Clients subscribed to presence updates.',
+                            lambda: len(users_online.subscribers))
+    server_metrics.callback('chat_sent_bytes_total', 'Bytes written to clients.', queue_total('sent_bytes'),
+                            metrics.COUNTER)
+    server_metrics.callback('chat_dropped_frames_total', 'Frames dropped from full outbound queues.',
+                            queue_total('dropped'), metrics.COUNTER)
+    server_metrics.callback('chat_outbound_queue_frames', 'Frames waiting in all outbound queues.',
+                            lambda: sum(client.outbound.depth for client in clients))
+    server_metrics.callback('chat_outbound_queue_max_frames', 'Frames waiting in the fullest outbound queue.',
+                            lambda: max((client.outbound.depth for client in clients), default=0))
+    server_metrics.callback('chat_reaper_timers', 'Clients waiting in the reaper\'s timer wheel.',
+                            lambda: len(reaper.wheel))
+
+
+def log_stats() -> None:
+    log('[STATS]\n{}'.format('\n'.join(server_metrics.summary())))
+
+
+def log_queue_stats() -> None:
+    stats = fanout.queue_stats([client.outbound for client in clients])
+    log('[QUEUES] {queues} outbound queues holding {depth} frames (deepest {max_depth}, high water {high_water}); '
+        '{dropped} frames dropped, {sent_bytes} bytes sent.'.format(**stats))
 
 
 # Function to allow the server to send custom messages to the clients, kick clients, or shut the server down.
 def server_write() -> None:
     running = True
     while running:
-        message = input('')
-        if not message:
-            continue
-        elif message[0] == '/':
-            words = message.split(' ')
-            if words[0] == '/end':   # move to shut_down_server
-                shut_down()
-                running = False
-            elif words[0] == '/kick':
-                kick_user(words)
-            else:
-                log('[ERROR] Server attempted to use an invalid command.')
-        else:
-            broadcast('[THE SERVER SPEAKS] {}'.format(message))
-            log('[SERVER BROADCAST] The server broadcasted the message: {}'.format(message))
+        try:
+            message = input('')
+        except (EOFError, OSError):     # There is no console, e.g. the server was started by a hot restart
+            return
+        if message:
+            running = server_command(message)
     sys.exit(0)
 
 
+# Carry out one line typed into the server console; returns False once the server has been shut down. Workers are sent
+# the lines typed into the console of their hub, and as every worker gets them, they don't relay the broadcasts.
+def server_command(message: str, relay: bool = True) -> bool:
+    if message[0] == '/':
+        words = message.split(' ')
+        if words[0] == '/end':   # move to shut_down_server
+            shut_down()
+            return False
+        elif words[0] == '/kick':
+            kick_user(words)
+        elif words[0] == '/queues':
+            log_queue_stats()
+        elif words[0] == '/stats':
+            log_stats()
+        elif words[0] == '/restart':
+            hot_restart()
+        else:
+            log('[ERROR] Server attempted to use an invalid command.')
+    else:
+        broadcast('[THE SERVER SPEAKS] {}'.format(message), relay)
+        log('[SERVER BROADCAST] The server broadcasted the message: {}'.format(message))
+    return True
+
+
+# Register a client who has answered the username request, given whether claim_username claimed the username (None if
+# it couldn't be asked); returns None if the username was rejected.
+def admit_client(client_socket: socket.socket, client_address: tuple, username: str or None, claimed: bool or None,
+                 decoder: protocol.FrameDecoder) -> Client or None:
+    if not username:   # Ensures the username is sent
+        client_socket.close()
+    elif claimed is None:
+        log("[ATTEMPTED CONNECTION] New connection attempted from {}:{} with the username '{}'. "
+            "Rejected because the hub did not answer.".format(client_address[0], client_address[1], username))
+        client_socket.close()
+    elif not claimed:
+        send_server_message(Frame.control(protocol.USERNAME_IN_USE), client_socket, decoder.version)
+        log("[ATTEMPTED CONNECTION] New connection attempted from {}:{} with the username '{}'. "
+            "Rejected because the username is in use.".format(client_address[0], client_address[1], username))
+        client_socket.close()
+    else:
+        client = Client(client_socket, username, client_address, decoder)
+        if not clients.add(client):     # The username was taken in the meantime (e.g. by a /rename)
+            client.send(Frame.control(protocol.USERNAME_IN_USE))
+            client.outbound.close()
+            client.outbound.release()
+            return None
+
+        log("[NEW CONNECTION] New connection accepted from {}:{} with the username '{}'."
+            .format(client_address[0], client_address[1], username))
+        room_index.join(client, rooms.DEFAULT_ROOM)
+        if hub is None:
+            users_online.join(username)
+        reaper.watch(client)
+        client.send("You have successfully connected to the server, welcome!\n"
+                    "Type /help for a list of commands.\n")
+        client.replay_history(REPLAY_COUNT)
+        broadcast_room(rooms.DEFAULT_ROOM, '{} has joined!'.format(username))
+        return client
+
+
+# The accept loop of the threads engine. Every handshake is left to the new connection's own thread, so a slow (or
+# silent) connection never holds up the others.
 def collect_clients() -> None:
+    poller = pauser.poller(serverSocket) if pauser is not None else None
+    if poller is not None:  # Connections waiting are accepted straight away; it only polls once there are none
+        serverSocket.setblocking(False)
     running = True
     while running:
+        if pauser is not None and pauser.paused:    # Pause between connections for a hot restart
+            pauser.park(serverSocket)
         try:
             client_socket, client_address = serverSocket.accept()
-        except WindowsError:
+        except BlockingIOError:
+            if not pauser.wait_readable(poller):
+                pauser.park(serverSocket)
+            continue
+        except OSError:
             running = False
             continue
 
-        send_server_message(USER_NAME_GET, client_socket)
-        username = receive_message(client_socket)
+        try:
+            client_thread = threading.Thread(target=connection_thread, args=(client_socket, client_address))
+            client_thread.start()
+        except Exception as e:
+            log('[ERROR] The server crashed! (Error: {}).'.format(str(e)))
+            client_socket.close()
+
 
-        if username in usernames:
-            send_server_message(USER_NAME_USED, client_socket)
-            log("[ATTEMPTED CONNECTION] New connection attempted from {}:{} with the username '{}'. "
-                "Rejected because the username is in use.".format(client_address[0], client_address[1], username))
+# Thread run for every accepted connection under the threads engine: performs the TLS handshake (if the server uses
+# TLS) and the username handshake, within the handshake timeout, then handles the client's messages.
+def connection_thread(client_socket: socket.socket, client_address: tuple) -> None:
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)    # Small frames are sent without delay
+    client_socket.settimeout(HANDSHAKE_TIMEOUT)
+    if tls_context is not None:
+        started = time.perf_counter()
+        try:
+            client_socket = tls_context.wrap_socket(client_socket, server_side=True)
+        except OSError as e:    # Including ssl.SSLError and timeouts
+            tls_failures.inc()
+            log('[TLS] The TLS handshake with {}:{} failed. (Error: {}.)'.format(client_address[0], client_address[1],
+                                                                                  str(e)))
             client_socket.close()
-        elif username:     # Ensures the username is sent
-            usernames.add(username)
-            client = Client(client_socket, username, client_address)
-            clients.add(client)
+            return
+        tls_handshake_time.observe(time.perf_counter() - started)
+        tls_handshakes[client_socket.session_reused].inc()
+    decoder = protocol.FrameDecoder(max_frame_size=MAX_FRAME_SIZE)
+    try:
+        client_socket.send(USER_NAME_REQUEST)
+    except OSError:
+        client_socket.close()
+        return
+    username = receive_username(client_socket, decoder)
+    client_socket.settimeout(None)
+    claimed = claim_username(username) if username else False
+    client = admit_client(client_socket, client_address, username, claimed, decoder)
+    if client:
+        client_handler(client)
 
-            log("[NEW CONNECTION] New connection accepted from {}:{} with the username '{}'."
-                .format(client_address[0], client_address[1], username))
-            send_server_message("You have successfully connected to the server, welcome!\n"
-                                "Type /help for a list of commands.\n", client_socket)
-            broadcast('{} has joined!'.format(username))
 
-            try:
-                client_thread = threading.Thread(target=client_handler, args=(client,))
-                client_thread.start()
-            except Exception as e:
-                log('[ERROR] The server crashed! (Error: {}).'.format(str(e)))
+# The TLS settings of the server. Clients are given session tickets, with which they can resume their session when they
+# reconnect, skipping the costly part of the handshake.
+def create_tls_context(certificate: str, key: str = None) -> ssl.SSLContext:
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certificate, key)
+    context.num_tickets = TLS_TICKETS
+    return context
+
+
+def create_server_socket() -> socket.socket:
+    try:
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Overcomes "address already in use" error
+        if WORKER is not None:  # Every worker listens on the port, and the kernel spreads the connections between them
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    except socket.error as err:
+        print('Error occurred whilst attempting to create the server socket. (Error: {})'.format(str(err)))
+        sys.exit(1)
+    return server_socket
 
 
 def start_server() -> None:
+    global serverSocket, pauser
     try:
-        serverSocket.bind(ADDRESS)
-        serverSocket.listen()
-        log('[LISTENING] The server is listening on {}:{} and is ready to receive.'.format(HOST_NAME, PORT))
-        server_thread = threading.Thread(target=server_write)
-        server_thread.start()
-        collect_clients()
+        log('[ENGINE] Using the {} engine.'.format(ENGINE))
+        reaper.start()
+        if WORKER is None:      # A worker is sent the commands typed into its hub's console instead
+            # A daemon, so that a console waiting for input doesn't keep the server running once it has shut down
+            server_thread = threading.Thread(target=server_write, daemon=True)
+            server_thread.start()
+        # Held until the server is serving, so that a hot restart asked for sooner (e.g. by a SIGUSR2 sent to the
+        # process group, which takes in a server still taking over from the one before) is turned down, not begun
+        restart_lock.acquire()
+        if can_restart():   # kill -USR2 hot restarts the server, as /restart does
+            signal.signal(signal.SIGUSR2, lambda signum, frame: threading.Thread(target=hot_restart).start())
+        if ENGINE == 'asyncio':
+            asyncio.run(serve_async())
+        else:
+            if can_restart():
+                pauser = handover.Pauser()
+            if handover_channel is not None:
+                serverSocket = take_over()
+            else:
+                serverSocket = create_server_socket()
+                serverSocket.bind(ADDRESS)
+                serverSocket.listen()
+            log('[LISTENING] The server is listening on {}:{}{} and is ready to receive.'
+                .format(HOST_NAME, PORT, ' (TLS)' if tls_context else ''))
+            restart_lock.release()
+            collect_clients()
+            if shutdown_requested:
+                shut_down()
     except KeyboardInterrupt:
         log('[KeyboardInterrupt] Keyboard Interrupt detected: shutting down server.\n')
         shut_down()
@@ -355,11 +1060,659 @@ def start_server() -> None:
     sys.exit(0)
 
 
+# ------------------------------------------------- Asyncio Engine --------------------------------------------------- #
+
+# Gives an asyncio stream the part of the socket interface used by Client and the server functions, so that the same
+# protocol code runs under both engines. Calls from other threads (e.g. the server_write console) are handed over to
+# the event loop, as asyncio transports are not thread-safe.
+class StreamSocket:
+    def __init__(self, writer: asyncio.StreamWriter, reader: asyncio.StreamReader = None) -> None:
+        self.writer = writer
+        self.reader = reader
+        self.loop = asyncio.get_running_loop()
+
+    def _in_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def send(self, data: bytes) -> int:
+        if self._in_loop():
+            self.writer.write(data)
+        else:
+            self.loop.call_soon_threadsafe(self.writer.write, data)
+        return len(data)
+
+    def close(self) -> None:
+        if self._in_loop():
+            self.writer.close()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.close)
+
+    # Drop the connection at once, without waiting for queued data to be written.
+    def shutdown(self, how: int) -> None:
+        if self._in_loop():
+            self.writer.transport.abort()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+
+# The stream reader of a client of the asyncio engine, which keeps count of the bytes it has been given but not yet
+# read, so that a hot restart can take them (see pause_async) rather than leave them behind.
+class ClientReader(asyncio.StreamReader):
+    def __init__(self) -> None:
+        super().__init__()
+        self.buffered = 0
+
+    def feed_data(self, data: bytes) -> None:
+        super().feed_data(data)
+        self.buffered += len(data)
+
+    async def read(self, n: int = -1) -> bytes:
+        data = await super().read(n)
+        if n >= 0:  # read(-1) reads through read(n)
+            self.buffered -= len(data)
+        return data
+
+    # What has been received but not read, without waiting for more.
+    async def read_buffered(self) -> bytes:
+        return await self.read(self.buffered) if self.buffered else b''
+
+
+# Listen with the asyncio engine, each connection read through a ClientReader and handled by connection_handler.
+async def listen_async(**kwargs) -> asyncio.Server:
+    return await asyncio.get_running_loop().create_server(
+        lambda: asyncio.StreamReaderProtocol(ClientReader(), connection_handler), **kwargs)
+
+
+# Open a stream over an accepted connection (after the TLS handshake, given ssl=), read through a ClientReader.
+async def open_stream(sock: socket.socket, **kwargs) -> tuple:
+    loop = asyncio.get_running_loop()
+    reader = ClientReader()
+    transport, stream_protocol = await loop.connect_accepted_socket(lambda: asyncio.StreamReaderProtocol(reader), sock,
+                                                                    **kwargs)
+    return reader, asyncio.StreamWriter(transport, stream_protocol, reader, loop)
+
+
+# Coroutine counterpart of receive_message. While the server is paused for a hot restart, it waits before taking each
+# frame out of the decoder, so the frames not yet handled are left in the decoder to be handed over.
+async def receive_message_async(reader: asyncio.StreamReader, decoder: protocol.FrameDecoder) -> Frame or None:
+    await unpaused.wait()
+    frame = decoder.next_frame()
+    while frame is None:
+        try:
+            data = await reader.read(decoder.chunk_size)
+        except ConnectionError:
+            handler_errors['connection'].inc()
+            return None
+        if not data:
+            return None
+        bytes_received.inc(len(data))
+        decoder.feed(data)
+        await unpaused.wait()
+        frame = decoder.next_frame()
+    frame_sizes.observe(len(frame))
+    return frame
+
+
+# Coroutine counterpart of receive_username.
+async def receive_username_async(reader: asyncio.StreamReader, decoder: protocol.FrameDecoder) -> str or None:
+    try:
+        frame = await receive_message_async(reader, decoder)
+    except ValueError:
+        return None
+    if frame is None:
+        return None
+    if decoder.v2_offered:
+        decoder.version = protocol.V2
+    return frame.message
+
+
+# Coroutine run for every accepted connection: performs the username handshake, then handles the client's messages.
+async def connection_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    client_socket = StreamSocket(writer, reader)
+    client_address = writer.get_extra_info('peername')
+    ssl_object = writer.get_extra_info('ssl_object')
+    if ssl_object is not None:
+        tls_handshakes[ssl_object.session_reused].inc()
+    client_socket.send(USER_NAME_REQUEST)
+    decoder = protocol.FrameDecoder(max_frame_size=MAX_FRAME_SIZE)
+    try:
+        username = await asyncio.wait_for(receive_username_async(reader, decoder), HANDSHAKE_TIMEOUT)
+    except asyncio.TimeoutError:
+        username = None
+    claimed = await claim_username_async(username) if username else False
+    client = admit_client(client_socket, client_address, username, claimed, decoder)
+    if client is not None:
+        await serve_client(client, reader)
+
+
+# Handle an admitted client's messages until it leaves. Commands that wait on the hub are handled on an executor thread,
+# so the event loop carries on serving the other clients meanwhile; the client's next message waits for them, as ever.
+async def serve_client(client: Client, reader: asyncio.StreamReader) -> None:
+    loop = asyncio.get_running_loop()
+    connected = True
+    while connected:
+        await fanout.ingress_gate.wait()
+        try:
+            frame = await receive_message_async(reader, client.decoder)
+        except protocol.FramingError:
+            handler_errors['framing'].inc()
+            frame = None
+        if frame is None:     # The client must have forcefully disconnected.
+            remove_client(client)
+            connected = False
+        elif waits_on_hub(frame):
+            connected = await loop.run_in_executor(None, handle_message, client, frame)
+        else:
+            connected = handle_message(client, frame)
+
+
+# Runs the accept loop of the asyncio engine until shut_down is called.
+async def serve_async() -> None:
+    global event_loop, stop_serving, unpaused, async_server
+    event_loop = asyncio.get_running_loop()
+    stop_serving = asyncio.Event()
+    unpaused = asyncio.Event()
+    unpaused.set()
+    listener = accept_task = None
+    if handover_channel is not None:
+        async_server = await take_over_async()
+    elif tls_context is not None:
+        listener = create_server_socket()
+        listener.bind(ADDRESS)
+        listener.listen(1024)
+        listener.setblocking(False)
+        accept_task = asyncio.create_task(accept_tls(listener))
+    else:
+        async_server = await listen_async(host=HOST_NAME, port=PORT, reuse_address=True,
+                                          reuse_port=WORKER is not None, backlog=1024)
+    log('[LISTENING] The server is listening on {}:{}{} and is ready to receive.'
+        .format(HOST_NAME, PORT, ' (TLS)' if tls_context else ''))
+    restart_lock.release()
+    await stop_serving.wait()
+    if accept_task is not None:
+        accept_task.cancel()
+        listener.close()
+    else:
+        async_server.close()
+
+
+# The accept loop of the asyncio engine when the server uses TLS. Each connection's TLS handshake is run by a task of
+# its own, alongside everything else, so it never holds up the accept loop.
+async def accept_tls(listener: socket.socket) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            client_socket, client_address = await loop.sock_accept(listener)
+        except OSError as e:    # e.g. out of file descriptors, which connections closing will free
+            log('[ERROR] Could not accept a connection. (Error: {}.)'.format(str(e)))
+            await asyncio.sleep(1)
+            continue
+        asyncio.create_task(tls_connection(client_socket, client_address))
+
+
+# Complete the TLS handshake with a new connection within the handshake timeout (timing it, or counting its failure, as
+# connection_thread does), then hand the connection to connection_handler.
+async def tls_connection(client_socket: socket.socket, client_address: tuple) -> None:
+    started = time.perf_counter()
+    try:
+        reader, writer = await open_stream(client_socket, ssl=tls_context, ssl_handshake_timeout=HANDSHAKE_TIMEOUT)
+    except (OSError, asyncio.TimeoutError) as e:    # Including ssl.SSLError
+        tls_failures.inc()
+        log('[TLS] The TLS handshake with {}:{} failed. (Error: {}.)'.format(client_address[0], client_address[1],
+                                                                              str(e)))
+        client_socket.close()
+        return
+    tls_handshake_time.observe(time.perf_counter() - started)
+    await connection_handler(reader, writer)
+
+
+# --------------------------------------------------- Hot Restart ---------------------------------------------------- #
+
+# Whether the server can hand itself over to a new process. TLS connections can't be (their session keys live in this
+# process's TLS library), and a worker or cluster node restarting alone would look to the others like a crash.
+def can_restart() -> bool:
+    return tls_context is None and hub is None and WORKER is None
+
+
+# Replace this server with a new process running the same command (and so any new code), without disconnecting anyone.
+# Every client is paused between messages, then the listening socket, the clients' sockets and what the server knows
+# about each client are passed to the new server over a Unix socket; once it reports that it is serving them, this
+# process exits without closing a thing. If it fails to, this server resumes where it paused.
+def hot_restart() -> None:
+    if not can_restart():
+        log('[RESTART] The server can\'t be hot restarted while it uses TLS, workers or a cluster.')
+        return
+    if not restart_lock.acquire(blocking=False):
+        log('[RESTART] A hot restart is already under way.')
+        return
+    try:
+        started = time.perf_counter()
+        log('[RESTART] Pausing {} client{} for a hot restart...'.format(len(clients), '' if len(clients) == 1 else 's'))
+        reaper.paused = True
+        users_online.flush()
+        if ENGINE == 'asyncio':
+            listener, paused = asyncio.run_coroutine_threadsafe(pause_async(), event_loop).result()
+        else:
+            listener, paused = pause_threads()
+        if hand_over(listener, paused):
+            log('[RESTART] Handed over {} client{} to the new server in {:.1f} ms; this server is exiting.'
+                .format(len(paused), '' if len(paused) == 1 else 's', (time.perf_counter() - started) * 1000))
+            log_sink.close()
+            os._exit(0)     # Without closing the sockets (or telling the clients to leave), which now serve the new one
+        log('[RESTART] The new server failed to take over, so this server is carrying on.')
+        resume_after_restart(listener)
+    finally:
+        reaper.paused = False
+        restart_lock.release()
+
+
+# Pause the threads engine: the accept loop and each client's thread park, and each client's writer finishes the write
+# it is in the middle of. Returns the listening socket's file descriptor and the clients that paused in time.
+def pause_threads() -> tuple:
+    deadline = time.monotonic() + handover.PAUSE_TIMEOUT
+    targets = list(clients)
+    pauser.pause()
+    parked = pauser.wait_parked({serverSocket} | {client.client_socket for client in targets}, handover.PAUSE_TIMEOUT)
+    return serverSocket.fileno(), [client for client in targets if client.client_socket in parked and
+                                   client.outbound.pause(max(0.0, deadline - time.monotonic()))]
+
+
+# Pause the asyncio engine (run on its event loop): stop accepting, stop reading from every client, and flush what has
+# been written to each one. What each client's stream has received but not yet read is moved to its decoder, to be
+# handed over (or handled, if the server carries on) with the rest of what hasn't been handled. Returns (a duplicate
+# of) the listening socket's file descriptor, as closing the asyncio server closes its own, and the clients that paused
+# in time.
+async def pause_async() -> tuple:
+    unpaused.clear()
+    listener = os.dup(async_server.sockets[0].fileno())
+    async_server.close()
+    targets = list(clients)
+    for client in targets:
+        client.client_socket.writer.transport.pause_reading()
+    results = await asyncio.gather(*(asyncio.wait_for(client.outbound.pause(), handover.PAUSE_TIMEOUT)
+                                     for client in targets), return_exceptions=True)
+    for client in targets:  # By now, every handler has taken what it was woken for, and waits to be unpaused
+        client.decoder.feed(await client.client_socket.reader.read_buffered())
+    return listener, [client for client, result in zip(targets, results) if result is None]
+
+
+async def resume_async(listener: int) -> None:
+    global async_server
+    for client in clients:
+        client.outbound.resume()
+        client.client_socket.writer.transport.resume_reading()
+    async_server = await listen_async(sock=socket.socket(fileno=listener), backlog=1024)
+    unpaused.set()
+
+
+# Carry on serving after a failed hot restart.
+def resume_after_restart(listener: int) -> None:
+    global message_store, metrics_server
+    if message_store is not None:
+        message_store = store.MessageStore(message_store.directory, message_store.segment_bytes, message_store.fsync)
+    if metrics_server is not None:
+        metrics_server = metrics.serve(server_metrics, *metrics_server.server_address[:2])
+    if ENGINE == 'asyncio':
+        asyncio.run_coroutine_threadsafe(resume_async(listener), event_loop).result()
+    else:
+        for client in clients:
+            client.outbound.resume()
+        pauser.resume()
+
+
+# What the new server needs to carry on serving a paused client: the data received from it but not yet handled, the
+# frames queued for it but not yet written (both base64-encoded), and its settings.
+def client_state(client: Client) -> dict:
+    return {'username': client.username, 'address': list(client.client_address), 'room': client.room,
+            'version': client.version, 'compression': client.compression_threshold > 0,
+            'unread': base64.b64encode(client.decoder.unread()).decode(),
+            'unsent': [base64.b64encode(data).decode() for data in client.outbound.unsent()],
+            'subscribed': client in users_online.subscribers, 'idle': time.monotonic() - client.last_active}
+
+
+# The command line arguments less the --handover a hot restart adds (wherever it is), which the next restart replaces.
+def without_handover(argv: list) -> list:
+    kept = []
+    remaining = iter(argv)
+    for argument in remaining:
+        if argument == '--handover':
+            next(remaining, None)   # Its value
+        elif not argument.startswith('--handover='):
+            kept.append(argument)
+    return kept
+
+
+# Start the new server and hand the paused server over to it; returns True once it has taken over. The message store
+# and the metrics port are let go of first, for the new server to open.
+def hand_over(listener: int, paused: list) -> bool:
+    fds = [listener]
+    state = {'clients': [], 'history': {}}
+    for client in paused:
+        entry = client_state(client)
+        entry['fd'] = len(fds)
+        fds.append(client.client_socket.writer.get_extra_info('socket').fileno() if ENGINE == 'asyncio'
+                   else client.client_socket.fileno())
+        state['clients'].append(entry)
+    for room, _ in room_index.counts():
+        state['history'][room] = [frame.message for frame in message_history.recent(room)]
+    if message_store is not None:
+        message_store.close()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+
+    old_end, new_end = handover.channel()
+    with old_end, new_end:
+        try:
+            successor = subprocess.Popen(restart_command + ['--handover', str(new_end.fileno())],
+                                         pass_fds=[new_end.fileno()])
+        except OSError as err:
+            log('[RESTART] The new server couldn\'t be started. (Error: {}.)'.format(str(err)))
+            return False
+        new_end.close()
+        try:
+            handover.send(old_end, fds, state)
+        except OSError:
+            pass
+        if handover.wait_ready(old_end):
+            return True
+        successor.kill()
+        return False
+
+
+# Register a client handed over by the previous server, as it was there.
+def adopt_client(client_socket: socket.socket, entry: dict) -> Client:
+    decoder = protocol.FrameDecoder(entry['version'], MAX_FRAME_SIZE)
+    decoder.compression_offered = entry['compression']
+    decoder.feed(base64.b64decode(entry['unread']))
+    client = Client(client_socket, entry['username'], tuple(entry['address']), decoder)
+    client.last_active -= entry['idle']
+    for data in entry['unsent']:
+        client.outbound.put(base64.b64decode(data))
+    clients.add(client)
+    room_index.join(client, entry['room'])
+    users_online.join(client.username)
+    if entry['subscribed']:
+        users_online.subscribe(client, send_list=False)     # It was sent the list by the previous server
+    reaper.watch(client)
+    return client
+
+
+def restore_history(state: dict) -> None:
+    for room, messages in state['history'].items():
+        for message in messages:
+            message_history.record(room, Frame(message))
+
+
+# Take over from the server that started this one with a hot restart, under the threads engine; returns the listening
+# socket.
+def take_over() -> socket.socket:
+    fds, state = handover.receive(handover_channel)
+    restore_history(state)
+    adopted = []
+    for entry in state['clients']:     # Every client is adopted before any is served, so none misses a message
+        client_socket = socket.socket(fileno=fds[entry['fd']])
+        client_socket.setblocking(True)
+        adopted.append(adopt_client(client_socket, entry))
+    for client in adopted:
+        threading.Thread(target=client_handler, args=(client,)).start()
+    log('[RESTART] Took over {} client{} from the previous server.'
+        .format(len(state['clients']), '' if len(state['clients']) == 1 else 's'))
+    handover.ready(handover_channel)
+    handover_channel.close()
+    listener = socket.socket(fileno=fds[0])
+    listener.setblocking(True)
+    return listener
+
+
+# Coroutine counterpart of take_over; returns the asyncio server accepting on the listening socket.
+async def take_over_async() -> asyncio.Server:
+    fds, state = handover.receive(handover_channel)
+    restore_history(state)
+    adopted = []
+    for entry in state['clients']:     # Every client is adopted before any is served, so none misses a message
+        reader, writer = await open_stream(socket.socket(fileno=fds[entry['fd']]))
+        adopted.append((adopt_client(StreamSocket(writer, reader), entry), reader))
+    for client, reader in adopted:
+        asyncio.create_task(serve_client(client, reader))
+    server = await listen_async(sock=socket.socket(fileno=fds[0]), backlog=1024)
+    log('[RESTART] Took over {} client{} from the previous server.'
+        .format(len(state['clients']), '' if len(state['clients']) == 1 else 's'))
+    handover.ready(handover_channel)
+    handover_channel.close()
+    return server
+
+
+# ------------------------------------------------- Worker Processes ------------------------------------------------- #
+
+# Run the server as several worker processes, each a whole server (with the chosen engine) listening on the same port,
+# so that they can use every CPU core. This process becomes their hub: it keeps the directory of every connected user
+# and relays messages between the workers over a Unix socket (see bus.py), so that broadcasts, whispers, /users and
+# the uniqueness of usernames work across workers. Lines typed into its console are passed on to the workers.
+def run_workers(count: int) -> None:
+    path = os.path.join(tempfile.gettempdir(), 'chat-bus-{}-{}.sock'.format(PORT, os.getpid()))
+    bus_hub = bus.Hub(path, log, message_store)
+    workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__)] + sys.argv[1:] +
+                                ['--worker', str(number), '--bus', path], stdin=subprocess.DEVNULL)
+               for number in range(1, count + 1)]
+    log('[WORKERS] Started {} worker processes, listening on {}:{}.'.format(count, HOST_NAME, PORT))
+
+    def console() -> None:
+        while True:
+            try:
+                message = input('')
+            except EOFError:    # No console
+                return
+            if message:
+                bus_hub.console(message)
+            if message == '/end':
+                return
+
+    threading.Thread(target=console, daemon=True).start()
+    try:
+        for worker in workers:
+            worker.wait()
+    except KeyboardInterrupt:   # The workers are interrupted too, and shut themselves down
+        log('[KeyboardInterrupt] Keyboard Interrupt detected: shutting down the workers.\n')
+        for worker in workers:
+            worker.wait()
+    bus_hub.close()
+    log('[SERVER CLOSED] Every worker has stopped.\n')
+
+
+# Act upon a message the hub sent to this worker (or another node of the cluster sent to this one): a broadcast or
+# whisper from another worker, a console command, users joining, leaving or renaming anywhere, or the eviction of a user
+# whose name was taken on another node.
+def handle_bus_message(message: dict) -> None:
+    if message['op'] == 'deliver':
+        if message['room'] is None:
+            broadcast(message['message'], relay=False)
+        else:
+            broadcast_room(message['room'], message['message'], message['keep'], relay=False)
+    elif message['op'] == 'whisper':
+        to_client = clients.get(message['to'])
+        if to_client is not None:
+            to_client.send('From {} to you> {}'.format(message['sender'], message['message']))
+    elif message['op'] == 'console':
+        if message['line'].split(' ')[0] == '/end':
+            request_shut_down()
+        else:
+            server_command(message['line'], relay=False)
+    elif message['op'] == 'presence':
+        users_online.apply(message['changes'])
+    elif message['op'] == 'evict':
+        client = clients.get(message['username'])
+        if client is not None:
+            client.send('[SERVER] The username {} was taken on another server at the same moment; please reconnect '
+                        'with another.'.format(client.username))
+            kick_user(['/kick', client.username])
+
+
+# A worker can't work without its hub, nor a cluster node without the other nodes, so it shuts down if it loses them.
+def hub_closed() -> None:
+    log('[BUS] Lost the connection to the {}; shutting down.'
+        .format('other nodes' if isinstance(hub, cluster.ClusterNode) else 'hub'))
+    request_shut_down()
+
+
+# Have the server shut down by its main thread, for a thread that mustn't wait for the clients to leave itself: the bus
+# reader, whose replies the clients' last requests to the hub are waiting on. The threads engine's accept loop is woken
+# to do it; the asyncio engine's event loop hands it to an executor thread, as it must serve the clients as they leave.
+def request_shut_down() -> None:
+    global shutdown_requested
+    shutdown_requested = True
+    if event_loop is not None:
+        if not event_loop.is_closed():
+            event_loop.call_soon_threadsafe(event_loop.run_in_executor, None, shut_down)
+    elif serverSocket is not None:
+        try:
+            serverSocket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
 # ----------------------------------------------- Commencement ------------------------------------------------------- #
 
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Starts the chat room server.')
+    parser.add_argument('port', type=int, help='The port to listen on.')
+    parser.add_argument('--engine', choices=ENGINES, default='threads',
+                        help='threads: one thread per client (default); asyncio: every client on a single event loop.')
+    parser.add_argument('--queue-size', type=int, default=fanout.DEFAULT_QUEUE_SIZE,
+                        help='Frames that may wait in each client\'s outbound queue.')
+    parser.add_argument('--overflow', choices=fanout.POLICIES, default=fanout.DISCONNECT,
+                        help='What to do when a client\'s outbound queue is full: drop its oldest frame, disconnect '
+                             'the client (default), or make senders wait for it.')
+    parser.add_argument('--max-frame-size', type=int, default=protocol.DEFAULT_MAX_FRAME_SIZE,
+                        help='Longest frame, in bytes, accepted from clients using v2 framing.')
+    parser.add_argument('--compression-threshold', type=int, default=protocol.DEFAULT_COMPRESSION_THRESHOLD,
+                        help='Compress messages of at least this many bytes for clients that accept compression '
+                             '(0 turns compression off).')
+    parser.add_argument('--tls-cert',
+                        help='Accept only TLS connections, using the certificate (chain) in this PEM file.')
+    parser.add_argument('--tls-key', help='PEM file holding the private key of the certificate, if it is not in the '
+                                          'certificate file.')
+    parser.add_argument('--history', type=int, default=history.DEFAULT_MAX_MESSAGES,
+                        help='Recent messages kept for each room (0 keeps none).')
+    parser.add_argument('--history-bytes', type=int, default=history.DEFAULT_MAX_BYTES,
+                        help='Most bytes of recent messages kept for each room.')
+    parser.add_argument('--replay', type=int, default=REPLAY_COUNT,
+                        help='Recent messages of a room shown to users as they join it.')
+    parser.add_argument('--store', metavar='DIRECTORY',
+                        help='Durably store chat and whispers in this directory, e.g. messages (enables /search).')
+    parser.add_argument('--store-fsync', action='store_true',
+                        help='Sync the message store to disk after every group of writes.')
+    parser.add_argument('--segment-bytes', type=int, default=store.DEFAULT_SEGMENT_BYTES,
+                        help='Size at which the message store starts a new segment file.')
+    parser.add_argument('--rate-limit', metavar='KIND=RATE[/BURST]', action='append', default=[],
+                        help='Limit how many messages per second (with bursts of up to BURST) each client may send: '
+                             'message (any message or command), chat, whisper or rename; or set the budget shared by '
+                             'every client with ingress. A RATE of 0 removes the limit. May be given more than once. '
+                             'Defaults: {}.'.format(', '.join('{}={:g}/{}'.format(kind, *limit) for kind, limit
+                                                               in ratelimit.DEFAULT_LIMITS.items())))
+    parser.add_argument('--flood-strikes', type=int, default=ratelimit.DEFAULT_STRIKES,
+                        help='Throttled messages a client may send in quick succession before it is kicked (0 never '
+                             'kicks).')
+    parser.add_argument('--heartbeat-interval', type=float, default=heartbeat.DEFAULT_INTERVAL,
+                        help='Seconds a client using v2 framing may be silent before it is sent a PING.')
+    parser.add_argument('--heartbeat-timeout', type=float, default=heartbeat.DEFAULT_TIMEOUT,
+                        help='Seconds a client using v2 framing may be silent, not even answering a PING, before it '
+                             'is disconnected (0 turns heartbeats off).')
+    parser.add_argument('--idle-timeout', type=float, default=heartbeat.DEFAULT_IDLE_TIMEOUT,
+                        help='Seconds any client may go without sending a message before it is disconnected (default: '
+                             'never).')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='Serve metrics over HTTP (at /metrics, on the host the server listens on) on this port.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Run the server as this many worker processes sharing the port (default: 1, i.e. run '
+                             'it in this process).')
+    parser.add_argument('--cluster', metavar='HOST:PORT',
+                        help='Join the cluster of servers linked by the relay at HOST:PORT (see cluster.py).')
+    parser.add_argument('--node', help='Name of this server in its cluster (default: HOST:PORT it listens on).')
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)   # Set by run_workers for each worker
+    parser.add_argument('--bus', help=argparse.SUPPRESS)
+    parser.add_argument('--handover', type=int, help=argparse.SUPPRESS)     # Set by hot_restart for the new server
+    parser.add_argument('--shutdown-timeout', type=float, default=SHUTDOWN_TIMEOUT,
+                        help='Seconds clients have to leave when the server shuts down, before they are disconnected.')
+    parser.add_argument('--plugin', metavar='MODULE', action='append', default=[],
+                        help='Load the commands of a plug-in: a module (on the import path) with a '
+                             'register_commands(table) function. May be given more than once.')
+    parser.add_argument('--log-file', default='server.log', help='File the server logs to (default: server.log).')
+    parser.add_argument('--log-format', choices=logsink.FORMATS, default=logsink.TEXT,
+                        help='text: human-readable lines (default); json: one JSON object per line.')
+    parser.add_argument('--log-max-bytes', type=int, default=0,
+                        help='Rotate the log file once it reaches this size (default: never rotate).')
+    parser.add_argument('--log-backups', type=int, default=5, help='Rotated log files to keep.')
+    parser.add_argument('--quiet', action='store_true', help='Don\'t echo log messages to the console.')
+    arguments = parser.parse_args()
+    try:
+        arguments.rate_limit = dict(ratelimit.parse_limit(limit) for limit in arguments.rate_limit)
+    except ValueError as err:
+        parser.error('argument --rate-limit: {}'.format(err))
+    if arguments.cluster and arguments.workers > 1:
+        parser.error('a server in a cluster runs as a single process; --cluster and --workers can\'t be combined')
+    return arguments
+
+
 if __name__ == "__main__":
+    arguments = parse_arguments()
+    PORT = arguments.port
+    ADDRESS = (HOST_NAME, PORT)
+    ENGINE = arguments.engine
+    QUEUE_SIZE = arguments.queue_size
+    OVERFLOW_POLICY = arguments.overflow
+    MAX_FRAME_SIZE = arguments.max_frame_size
+    COMPRESSION_THRESHOLD = arguments.compression_threshold
+    if not COMPRESSION_THRESHOLD:
+        USER_NAME_REQUEST = protocol.encode_v1(USER_NAME_GET.encode(FORMAT), offer_v2=True)
+    REPLAY_COUNT = arguments.replay
+    SHUTDOWN_TIMEOUT = arguments.shutdown_timeout
+    message_history = history.MessageHistory(arguments.history, arguments.history_bytes)
+    if arguments.tls_cert:
+        tls_context = create_tls_context(arguments.tls_cert, arguments.tls_key)
+    configure_limits(arguments.rate_limit, arguments.flood_strikes, arguments.heartbeat_interval,
+                     arguments.heartbeat_timeout, arguments.idle_timeout)
+    WORKER = arguments.worker
+    is_hub = WORKER is None and arguments.workers > 1
+    log_file = arguments.log_file
+    if WORKER is not None:  # Each worker logs to a file of its own, e.g. server.worker1.log
+        base, extension = os.path.splitext(log_file)
+        log_file = '{}.worker{}{}'.format(base, WORKER, extension)
+    log_sink = logsink.LogSink(log_file, arguments.log_format, not arguments.quiet,
+                               arguments.log_max_bytes, arguments.log_backups)
+    atexit.register(log_sink.close)
+    if arguments.store and WORKER is None:   # The hub stores the messages of every worker
+        message_store = store.MessageStore(arguments.store, arguments.segment_bytes, arguments.store_fsync)
+        atexit.register(message_store.close)
+    register_state_metrics()
+    restart_command = [sys.executable, os.path.abspath(__file__)] + without_handover(sys.argv[1:])
+    if arguments.handover is not None:  # This server was started by a hot restart
+        handover_channel = socket.socket(fileno=arguments.handover)
+    if arguments.metrics_port and not is_hub:   # Each worker serves its own metrics, on consecutive ports
+        metrics_port = arguments.metrics_port + (WORKER - 1 if WORKER is not None else 0)
+        metrics_server = metrics.serve(server_metrics, HOST_NAME, metrics_port)
+        log('[METRICS] Serving metrics on http://{}:{}/metrics.'.format(HOST_NAME, metrics_port))
     try:
         log("[STARTING] The server is starting...")
-        start_server()
+        for plugin in arguments.plugin:
+            commands.load_plugin(command_table, plugin)
+            log('[PLUGIN] Loaded the commands of {}.'.format(plugin))
+        if is_hub:
+            run_workers(arguments.workers)
+        else:
+            if WORKER is not None:
+                hub = bus.Worker(arguments.bus, WORKER, handle_bus_message, hub_closed)
+            elif arguments.cluster:
+                relay_host, _, relay_port = arguments.cluster.rpartition(':')
+                node = arguments.node or '{}:{}'.format(HOST_NAME, PORT)
+                hub = cluster.ClusterNode(node, cluster.RelayPubSub(relay_host or HOST_NAME, int(relay_port)),
+                                          handle_bus_message, message_store, log, hub_closed)
+                log('[CLUSTER] Joined the cluster at {} as node {}.'.format(arguments.cluster, node))
+            start_server()
     except Exception as err:
         log('[ERROR] Server couldn\'t start! (Error {}.)'.format(str(err)))
+        sys.exit(1)
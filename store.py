@@ -0,0 +1,357 @@
+import bisect
+import collections
+import heapq
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+
+# ---------------------------------------------- INITIALISATION ------------------------------------------------------ #
+
+FORMAT = 'utf-8'
+
+CHAT = 0        # A message sent to a room; the target is the room
+WHISPER = 1     # A whisper; the target is the recipient
+
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024       # A new segment is started once the current one reaches this size
+BATCH_SIZE = 1024           # Most events committed with one write
+STOP = object()             # Queued by close() to stop the writer
+
+# Each record is this header (time, kind and the encoded lengths of the sender, target and text) followed by the three
+# strings. The timestamp index of a segment is one (time, offset) entry per record, in the order they were written.
+RECORD = struct.Struct('>dBHHI')
+INDEX_ENTRY = struct.Struct('>dI')
+
+SEGMENT_SUFFIX = '.seg'     # The records
+TIMES_SUFFIX = '.tix'       # The timestamp index
+USERS_SUFFIX = '.uix'       # The user index, as "username offset" lines
+TARGETS_SUFFIX = '.rix'     # The target index, as "kind target offset" lines (see MessageStore._targets)
+
+Event = collections.namedtuple('Event', ('timestamp', 'kind', 'sender', 'target', 'text'))
+
+
+# Whether an event may be seen by a user: messages in the room they are in, and whispers to or from them.
+def visible_to(username: str, room: str):
+    def visible(event: Event) -> bool:
+        if event.kind == WHISPER:
+            return username in (event.sender, event.target)
+        return event.target == room
+    return visible
+
+
+# ------------------------------------------------- Message Store ---------------------------------------------------- #
+
+# A durable, append-only record of chat and whisper events, kept in numbered segment files in one directory. Each
+# segment has three sidecar indexes, one by timestamp, one by sender and one by target (the room of a message, and both
+# parties to a whisper), so queries only ever read the records that could be among the ones they return.
+# append() only timestamps the event and queues it, so storing a message never holds up its broadcast; a single writer
+# thread commits whatever has queued up with one write per file (and, optionally, one fsync). Records are read back
+# through memory maps of the segments.
+class MessageStore:
+    def __init__(self, directory: str, segment_bytes: int = DEFAULT_SEGMENT_BYTES, fsync: bool = False) -> None:
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.segments = []      # Numbers of the segments, oldest first
+        self.first_times = []   # Time of the first record of each segment (None while a segment is empty)
+        self.by_user = {}       # Username -> list of (time, segment, offset), oldest first
+        self.by_target = {}     # (kind, room or party to a whisper) -> list of (time, segment, offset), oldest first
+        self.maps = {}          # Segment -> (mmap of its records, mmap of its timestamp index)
+        self.queue = queue.SimpleQueue()
+        self.last_time = 0.0    # Time of the last record written
+
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(SEGMENT_SUFFIX):
+                self._load(int(name[:-len(SEGMENT_SUFFIX)]))
+        if not self.segments:
+            self._load(1)
+        self._open(self.segments[-1])
+        self.writer_thread = threading.Thread(target=self._write, name='store-writer', daemon=True)
+        self.writer_thread.start()
+
+    def _path(self, segment: int, suffix: str) -> str:
+        return os.path.join(self.directory, '{:08d}{}'.format(segment, suffix))
+
+    # The keys of the target index an event is listed under: its room, or both parties to a whisper.
+    @staticmethod
+    def _targets(kind: int, sender: str, target: str) -> set:
+        return {(WHISPER, sender), (WHISPER, target)} if kind == WHISPER else {(kind, target)}
+
+    # Add an existing (or new) segment, reading its user and target indexes and the first entry of its timestamp index.
+    # Records written after the last index entry (if the server stopped between the writes) are cut off, so a segment
+    # never holds a record its indexes do not know about.
+    def _load(self, segment: int) -> None:
+        rebuild_targets = not os.path.exists(self._path(segment, TARGETS_SUFFIX))  # Lost: rebuilt from the records
+        for suffix in (SEGMENT_SUFFIX, TIMES_SUFFIX, USERS_SUFFIX, TARGETS_SUFFIX):
+            open(self._path(segment, suffix), 'ab').close()
+        times_size = os.path.getsize(self._path(segment, TIMES_SUFFIX))
+        times_size -= times_size % INDEX_ENTRY.size
+        segment_size = os.path.getsize(self._path(segment, SEGMENT_SUFFIX))
+        first_time = None
+        end = 0
+        # Find the last record written whole; any after it (torn by a crash part way through a write) are cut off
+        with open(self._path(segment, TIMES_SUFFIX), 'rb') as times, \
+                open(self._path(segment, SEGMENT_SUFFIX), 'rb') as records:
+            while times_size and not end:
+                times.seek(times_size - INDEX_ENTRY.size)
+                _, last_offset = INDEX_ENTRY.unpack(times.read(INDEX_ENTRY.size))
+                records.seek(last_offset)
+                header = records.read(RECORD.size)
+                if len(header) == RECORD.size:
+                    _, _, sender_length, target_length, text_length = RECORD.unpack(header)
+                    end = last_offset + RECORD.size + sender_length + target_length + text_length
+                    if end > segment_size:
+                        end = 0
+                if not end:
+                    times_size -= INDEX_ENTRY.size
+            if times_size:
+                times.seek(0)
+                first_time, _ = INDEX_ENTRY.unpack(times.read(INDEX_ENTRY.size))
+        os.truncate(self._path(segment, TIMES_SUFFIX), times_size)
+        os.truncate(self._path(segment, SEGMENT_SUFFIX), end)
+
+        timestamps = {}
+        if times_size:
+            with open(self._path(segment, TIMES_SUFFIX), 'rb') as times:
+                for timestamp, offset in INDEX_ENTRY.iter_unpack(times.read()):
+                    timestamps[offset] = timestamp
+        with open(self._path(segment, USERS_SUFFIX), 'r', encoding=FORMAT) as users:
+            for line in users:
+                username, _, offset = line.rstrip('\n').rpartition(' ')
+                if offset.isdigit() and int(offset) in timestamps:
+                    self.by_user.setdefault(username, []).append((timestamps[int(offset)], segment, int(offset)))
+        if rebuild_targets and timestamps:
+            self._rebuild_targets(segment, timestamps)
+        with open(self._path(segment, TARGETS_SUFFIX), 'r', encoding=FORMAT) as targets:
+            for line in targets:
+                target, _, offset = line[1:].rstrip('\n').rpartition(' ')
+                if line[:1].isdigit() and offset.isdigit() and int(offset) in timestamps:
+                    self.by_target.setdefault((int(line[0]), target), []).append((timestamps[int(offset)], segment,
+                                                                                  int(offset)))
+        self.segments.append(segment)
+        self.first_times.append(first_time)
+
+    # Write the target index of a segment from its records.
+    def _rebuild_targets(self, segment: int, timestamps: dict) -> None:
+        lines = []
+        with open(self._path(segment, SEGMENT_SUFFIX), 'rb') as records:
+            with mmap.mmap(records.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for offset in timestamps:
+                    event = self._read(mapped, offset)
+                    for kind, target in self._targets(event.kind, event.sender, event.target):
+                        lines.append('{}{} {}\n'.format(kind, target, offset))
+        with open(self._path(segment, TARGETS_SUFFIX), 'w', encoding=FORMAT) as targets:
+            targets.writelines(lines)
+
+    def _open(self, segment: int) -> None:
+        self.records_file = open(self._path(segment, SEGMENT_SUFFIX), 'ab')
+        self.times_file = open(self._path(segment, TIMES_SUFFIX), 'ab')
+        self.users_file = open(self._path(segment, USERS_SUFFIX), 'ab')
+        self.targets_file = open(self._path(segment, TARGETS_SUFFIX), 'ab')
+        self.size = self.records_file.tell()
+
+    def _close_files(self) -> None:
+        for file in (self.records_file, self.times_file, self.users_file, self.targets_file):
+            file.close()
+
+    def append(self, kind: int, sender: str, target: str, text: str) -> None:
+        self.queue.put((time.time(), kind, sender, target, text))
+
+    # Commit everything already queued, then stop the writer.
+    def close(self) -> None:
+        if self.writer_thread.is_alive():
+            self.queue.put(STOP)
+            self.writer_thread.join()
+        with self.lock:
+            for records, times in self.maps.values():
+                records.close()
+                times.close()
+            self.maps.clear()
+
+    # ------------------------------------------------ Writing ------------------------------------------------------- #
+
+    def _write(self) -> None:
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if STOP in batch:
+                batch = [event for event in batch if event is not STOP]
+                running = False
+            while batch:
+                batch = self._commit(batch)
+        self._close_files()
+
+    # Write as many of the events as fit in the current segment, starting a new segment if it fills up; returns the
+    # events left over for the next segment.
+    def _commit(self, batch: list) -> list:
+        segment = self.segments[-1]
+        records, times, users, targets, indexed = [], [], [], [], []
+        offset = self.size
+        for number, (timestamp, kind, sender, target, text) in enumerate(batch):
+            if offset >= self.segment_bytes and offset:
+                break
+            # Events are queued by many threads, so their times can be very slightly out of order; the indexes
+            # are searched by bisection, so times are never allowed to go backwards
+            timestamp = self.last_time = max(timestamp, self.last_time)
+            encoded = (sender.encode(FORMAT), target.encode(FORMAT), text.encode(FORMAT))
+            records.append(RECORD.pack(timestamp, kind, *map(len, encoded)))
+            records.extend(encoded)
+            times.append(INDEX_ENTRY.pack(timestamp, offset))
+            users.append('{} {}\n'.format(sender, offset).encode(FORMAT))
+            keys = self._targets(kind, sender, target)
+            targets.extend('{}{} {}\n'.format(key_kind, key, offset).encode(FORMAT) for key_kind, key in keys)
+            indexed.append((sender, keys, timestamp, offset))
+            offset += RECORD.size + sum(map(len, encoded))
+        else:
+            number = len(batch)
+
+        if records:
+            # The records go first, so an index never points past the end of its segment
+            self.records_file.write(b''.join(records))
+            self.records_file.flush()
+            self.times_file.write(b''.join(times))
+            self.users_file.write(b''.join(users))
+            self.targets_file.write(b''.join(targets))
+            self.times_file.flush()
+            self.users_file.flush()
+            self.targets_file.flush()
+            if self.fsync:
+                for file in (self.records_file, self.times_file, self.users_file, self.targets_file):
+                    os.fsync(file.fileno())
+            self.size = offset
+            with self.lock:
+                if self.first_times[-1] is None:
+                    self.first_times[-1] = indexed[0][2]
+                for sender, keys, timestamp, record_offset in indexed:
+                    entry = (timestamp, segment, record_offset)
+                    self.by_user.setdefault(sender, []).append(entry)
+                    for key in keys:
+                        self.by_target.setdefault(key, []).append(entry)
+
+        if number < len(batch):
+            self._close_files()
+            with self.lock:
+                self._load(segment + 1)
+            self._open(segment + 1)
+        return batch[number:]
+
+    # ------------------------------------------------ Reading ------------------------------------------------------- #
+
+    # Memory maps of a segment and its timestamp index, remapped whenever the segment has grown since it was mapped.
+    # Must be called with the lock held. Returns None for a segment with nothing in it yet.
+    def _map(self, segment: int) -> tuple or None:
+        times_size = os.path.getsize(self._path(segment, TIMES_SUFFIX))
+        times_size -= times_size % INDEX_ENTRY.size
+        maps = self.maps.get(segment)
+        if maps is not None and len(maps[1]) == times_size:
+            return maps
+        if not times_size:
+            return None
+        if maps is not None:
+            maps[0].close()
+            maps[1].close()
+        with open(self._path(segment, SEGMENT_SUFFIX), 'rb') as records, \
+                open(self._path(segment, TIMES_SUFFIX), 'rb') as times:
+            maps = (mmap.mmap(records.fileno(), 0, access=mmap.ACCESS_READ),
+                    mmap.mmap(times.fileno(), times_size, access=mmap.ACCESS_READ))
+        self.maps[segment] = maps
+        return maps
+
+    @staticmethod
+    def _read(records: mmap.mmap, offset: int) -> Event:
+        timestamp, kind, sender_length, target_length, text_length = RECORD.unpack_from(records, offset)
+        start = offset + RECORD.size
+        sender = records[start:start + sender_length].decode(FORMAT)
+        start += sender_length
+        target = records[start:start + target_length].decode(FORMAT)
+        start += target_length
+        return Event(timestamp, kind, sender, target, records[start:start + text_length].decode(FORMAT))
+
+    # The index of the first entry in a timestamp index with a time after the given time.
+    @staticmethod
+    def _bisect_times(times: mmap.mmap, timestamp: float) -> int:
+        low, high = 0, len(times) // INDEX_ENTRY.size
+        while low < high:
+            middle = (low + high) // 2
+            if INDEX_ENTRY.unpack_from(times, middle * INDEX_ENTRY.size)[0] <= timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # The (time, segment, offset) of the records written between since and until, newest first, found through the
+    # timestamp indexes.
+    def _entries_between(self, since: float, until: float):
+        last = bisect.bisect_right([t if t is not None else float('inf') for t in self.first_times], until)
+        for position in range(last - 1, -1, -1):
+            segment = self.segments[position]
+            maps = self._map(segment)
+            if maps is None:
+                continue
+            times = maps[1]
+            for entry in range(self._bisect_times(times, until) - 1, -1, -1):
+                timestamp, offset = INDEX_ENTRY.unpack_from(times, entry * INDEX_ENTRY.size)
+                if timestamp < since:
+                    return
+                yield timestamp, segment, offset
+
+    # The entries of a user or target index list between since and until, newest first.
+    @staticmethod
+    def _entries_in(entries: list, since: float, until: float):
+        for position in range(bisect.bisect_right(entries, (until, float('inf'))) - 1, -1, -1):
+            if entries[position][0] < since:
+                return
+            yield entries[position]
+
+    # The number of entries of an index list between since and until, found by bisection.
+    @staticmethod
+    def _count_in(entries: list, since: float, until: float) -> int:
+        return bisect.bisect_right(entries, (until, float('inf'))) - bisect.bisect_left(entries, (since,))
+
+    # The entries that could be events seen by a user (see visible_to), newest first: those of their room and their
+    # whispers, from the target index, or, if it is shorter over the period, the sender's list from the user index.
+    def _visible_entries(self, user: str or None, username: str, room: str, since: float, until: float):
+        lists = [self.by_target.get((CHAT, room), []), self.by_target.get((WHISPER, username), [])]
+        if user is not None:
+            sent = self.by_user.get(user, [])
+            if self._count_in(sent, since, until) < sum(self._count_in(entries, since, until) for entries in lists):
+                return self._entries_in(sent, since, until)
+        return heapq.merge(*(self._entries_in(entries, since, until) for entries in lists), reverse=True)
+
+    # The most recent events (at most limit of them, oldest first) sent by user (or by anyone, if user is None) between
+    # since and until, and, if seen_by is given as (username, room), only those that user may see in that room. The
+    # indexes narrow the records read down to the sender's or the room's and the user's whispers, whichever are fewer.
+    def query(self, user: str = None, since: float = None, until: float = None, limit: int = None,
+              seen_by: tuple = None) -> list:
+        since = float('-inf') if since is None else since
+        until = float('inf') if until is None else until
+        visible = visible_to(*seen_by) if seen_by is not None else None
+        events = []
+        with self.lock:
+            if seen_by is not None:
+                entries = self._visible_entries(user, *seen_by, since, until)
+            elif user is not None:
+                entries = self._entries_in(self.by_user.get(user, []), since, until)
+            else:
+                entries = self._entries_between(since, until)
+            mapped = {}
+            for _, segment, offset in entries:
+                if segment not in mapped:
+                    mapped[segment] = self._map(segment)
+                event = self._read(mapped[segment][0], offset)
+                if (user is None or event.sender == user) and (visible is None or visible(event)):
+                    events.append(event)
+                    if limit is not None and len(events) >= limit:
+                        break
+        events.reverse()
+        return events
@@ -0,0 +1,132 @@
+import importlib
+import sys
+import threading
+import types
+import unittest
+from unittest import mock
+
+import chatclient   # noqa: F401 (imported before chatview, so that it is kept once the stand-in for tkinter goes)
+
+
+# ---------------------------------------------------- Helpers ------------------------------------------------------- #
+
+# The parts of tkinter the chat view uses, so that its render path runs without a display (or Tk installed).
+fake_tk = types.ModuleType('tkinter')
+fake_tk.END = 'end'
+fake_tk.NORMAL = 'normal'
+fake_tk.DISABLED = 'disabled'
+fake_tk.Tk = fake_tk.Text = object
+
+with mock.patch.dict(sys.modules, {'tkinter': fake_tk}):
+    sys.modules.pop('chatview', None)
+    chatview = importlib.import_module('chatview')
+
+
+# A Tk root whose timers are run by the test, as the Tk main loop would run them.
+class FakeRoot:
+    def __init__(self) -> None:
+        self.timers = []
+
+    def after(self, delay: int, callback) -> None:
+        self.timers.append((delay, callback))
+
+    # Run the timers set so far; returns the delays of those they set in turn.
+    def run_timers(self) -> list:
+        timers, self.timers = self.timers, []
+        for _, callback in timers:
+            callback()
+        return [delay for delay, _ in self.timers]
+
+
+# A tk.Text holding its text as a string, which counts every call that changes or scrolls it.
+class FakeText:
+    def __init__(self) -> None:
+        self.content = ''
+        self.state = fake_tk.NORMAL
+        self.view = (0.0, 1.0)  # The fractions of the text in view, as yview() gives them
+        self.inserts = 0
+        self.scrolls = 0
+
+    def yview(self) -> tuple:
+        return self.view
+
+    def config(self, state: str) -> None:
+        self.state = state
+
+    def insert(self, index: str, text: str) -> None:
+        assert self.state == fake_tk.NORMAL and index == fake_tk.END
+        self.content += text
+        self.inserts += 1
+
+    # Only deletions of whole lines from the top, as ChatView trims them, are supported.
+    def delete(self, start: str, end: str) -> None:
+        assert self.state == fake_tk.NORMAL and start == '1.0'
+        self.content = ''.join(self.content.splitlines(True)[int(end.split('.')[0]) - 1:])
+
+    def index(self, index: str) -> str:
+        assert index == 'end-1c'
+        return '{}.0'.format(self.content.count('\n') + 1)
+
+    def see(self, index: str) -> None:
+        self.scrolls += 1
+
+    def lines(self) -> list:
+        return self.content.splitlines()
+
+
+# ----------------------------------------------------- Tests -------------------------------------------------------- #
+
+class ChatViewTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.root = FakeRoot()
+        self.text = FakeText()
+
+    def view(self, **options) -> 'chatview.ChatView':
+        return chatview.ChatView(self.root, self.text, **options)
+
+    def test_posted_from_thread_rendered_in_one_insert(self) -> None:
+        view = self.view()
+        poster = threading.Thread(target=lambda: [view.post('m{}'.format(number)) for number in range(100)])
+        poster.start()
+        poster.join()
+        self.assertEqual(self.text.inserts, 0)      # Nothing is rendered until the timer runs
+        self.assertEqual(self.root.run_timers(), [chatview.RENDER_INTERVAL])
+        self.assertEqual(self.text.lines(), ['m{}'.format(number) for number in range(100)])
+        self.assertEqual((self.text.inserts, self.text.scrolls, view.rendered), (1, 1, 100))
+        self.assertEqual(self.text.state, fake_tk.DISABLED)
+        self.root.run_timers()      # Nothing new to render
+        self.assertEqual(self.text.inserts, 1)
+
+    def test_backlog_rendered_over_several_renders(self) -> None:
+        view = self.view(batch=10)
+        for number in range(25):
+            view.post('m{}'.format(number))
+        self.assertEqual(self.root.run_timers(), [1])   # More is waiting, so the next render is straight away
+        self.assertEqual(self.root.run_timers(), [1])
+        self.assertEqual(self.root.run_timers(), [chatview.RENDER_INTERVAL])
+        self.assertEqual((self.text.inserts, view.rendered), (3, 25))
+        self.assertEqual(self.text.lines(), ['m{}'.format(number) for number in range(25)])
+
+    def test_scrollback_trims_oldest_lines(self) -> None:
+        view = self.view(scrollback=50)
+        for number in range(120):
+            view.post('m{}'.format(number))
+        self.root.run_timers()
+        self.assertEqual(self.text.lines(), ['m{}'.format(number) for number in range(70, 120)])
+        view.post('m120')
+        self.root.run_timers()
+        self.assertEqual(view.lines(), 50)
+        self.assertEqual(self.text.lines()[0], 'm71')
+
+    def test_scrolled_up_view_stays_put(self) -> None:
+        view = self.view()
+        view.post('first')
+        self.root.run_timers()
+        self.text.view = (0.2, 0.6)     # The user has scrolled up to read earlier messages
+        view.post('second')
+        self.root.run_timers()
+        self.assertEqual((self.text.inserts, self.text.scrolls), (2, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
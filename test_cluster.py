@@ -0,0 +1,230 @@
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import chatclient
+import cluster
+import presence
+
+
+# ---------------------------------------------------- Helpers ------------------------------------------------------- #
+
+TIMEOUT = 5.0   # Seconds a test waits for the nodes to settle
+HOST_NAME = '127.0.0.1'
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+# A cluster node on a local broker, with the messages it passes to its server collected.
+class Node:
+    def __init__(self, name: str, broker: cluster.LocalBroker) -> None:
+        self.lock = threading.Lock()
+        self.messages = []
+        self.cluster = cluster.ClusterNode(name, broker.connect(), self._on_message, log=lambda message: None)
+
+    def _on_message(self, message: dict) -> None:
+        with self.lock:
+            self.messages.append(message)
+
+    def received(self, op: str) -> list:
+        with self.lock:
+            return [message for message in self.messages if message['op'] == op]
+
+    # The users that joined, less those that left, as told through presence messages (renames included).
+    def online(self) -> set:
+        users = set()
+        for message in self.received('presence'):
+            for change in message['changes']:
+                if change[0] == presence.JOINED:
+                    users.add(change[1])
+                elif change[0] == presence.LEFT:
+                    users.discard(change[1])
+                elif change[0] == presence.RENAMED:
+                    users.discard(change[1])
+                    users.add(change[2])
+        return users
+
+    def directory(self) -> dict:
+        with self.cluster.lock:
+            return {username: tuple(entry) for username, entry in self.cluster.directory.items()}
+
+
+# Wait until a condition holds, failing the test if it doesn't in time.
+def settle(test: unittest.TestCase, condition) -> None:
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        if time.monotonic() > deadline:
+            test.fail('The cluster did not settle.')
+        time.sleep(0.01)
+
+
+# A port that was free a moment ago.
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((HOST_NAME, 0))
+        return sock.getsockname()[1]
+
+
+# Start a script of the repository in a scratch directory, and wait until it listens on the port.
+def start_process(test: unittest.TestCase, script: str, port: int, *arguments: str) -> subprocess.Popen:
+    scratch = tempfile.mkdtemp(prefix='chat-test-')
+    test.addCleanup(shutil.rmtree, scratch, True)
+    process = subprocess.Popen([sys.executable, os.path.join(DIRECTORY, script), str(port)] + list(arguments),
+                               cwd=scratch, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    test.addCleanup(process.wait)
+    test.addCleanup(process.kill)
+    settle(test, lambda: process.poll() is None and listening(port))
+    return process
+
+
+def listening(port: int) -> bool:
+    try:
+        socket.create_connection((HOST_NAME, port), timeout=0.2).close()
+        return True
+    except OSError:
+        return False
+
+
+# Receive frames until one holds the text, failing the test if none does in time.
+def expect(test: unittest.TestCase, connection: chatclient.Connection, text: str) -> str:
+    connection.sock.settimeout(TIMEOUT)
+    for frame in connection:
+        if text in frame.message:
+            return frame.message
+    test.fail('{} was never sent {!r}.'.format(connection.username, text))
+
+
+# ----------------------------------------------------- Tests -------------------------------------------------------- #
+
+class ClusterNodeTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.broker = cluster.LocalBroker()
+        self.nodes = [Node(name, self.broker) for name in ('a', 'b', 'c')]
+
+    def tearDown(self) -> None:
+        for node in self.nodes:
+            node.cluster.close()
+
+    def claim(self, node: Node, username: str, room: str = 'lobby') -> bool:
+        return node.cluster.request('claim', username=username, room=room)['ok']
+
+    def test_global_directory(self) -> None:
+        for number, node in enumerate(self.nodes):
+            for user in range(3):
+                self.assertTrue(self.claim(node, 'user{}{}'.format(number, user)))
+        expected = {'user{}{}'.format(number, user): (node.cluster.node, 'lobby')
+                    for number, node in enumerate(self.nodes) for user in range(3)}
+        settle(self, lambda: all(node.directory() == expected for node in self.nodes))
+        settle(self, lambda: all(node.online() == set(expected) for node in self.nodes))
+        self.assertFalse(self.claim(self.nodes[2], 'user00'))   # Taken on another node
+
+        a, b, c = self.nodes
+        self.assertTrue(a.cluster.request('rename', old='user00', new='alice')['ok'])
+        a.cluster.publish('move', username='alice', room='den')
+        b.cluster.publish('release', username='user10')
+        settle(self, lambda: all(node.directory().get('alice') == ('a', 'den') and 'user00' not in node.directory()
+                                 and 'user10' not in node.directory() for node in self.nodes))
+        settle(self, lambda: all('alice' in node.online() and 'user10' not in node.online() for node in self.nodes))
+        self.assertEqual(dict(c.cluster.request('rooms')['rooms']), {'lobby': 7, 'den': 1})
+
+    def test_late_node_learns_roster(self) -> None:
+        self.claim(self.nodes[0], 'early')
+        settle(self, lambda: 'early' in self.nodes[2].directory())
+        late = Node('d', self.broker)
+        self.nodes.append(late)
+        settle(self, lambda: late.directory().get('early') == ('a', 'lobby'))
+        self.claim(late, 'newcomer')
+        settle(self, lambda: all(node.directory().get('newcomer') == ('d', 'lobby') for node in self.nodes))
+
+    def test_exactly_once_delivery(self) -> None:
+        a, b, c = self.nodes
+        for number in range(100):
+            a.cluster.publish('deliver', room='lobby', message='m{}'.format(number), keep=True)
+        settle(self, lambda: len(b.received('deliver')) == 100 and len(c.received('deliver')) == 100)
+        # A backend may deliver a message again (as the relay may after reconnecting); it is only acted on once
+        for message in b.received('deliver')[:10]:
+            a.cluster.pubsub.publish(dict(message))
+        self.claim(a, 'marker')     # Published after the repeats, so they have been dealt with once it arrives
+        settle(self, lambda: 'marker' in b.directory() and 'marker' in c.directory())
+        for node in (b, c):
+            self.assertEqual([message['message'] for message in node.received('deliver')],
+                             ['m{}'.format(number) for number in range(100)])
+        self.assertEqual(a.received('deliver'), [])     # Never delivered back to its sender
+
+    def test_whisper_routed_to_recipient_node(self) -> None:
+        a, b, c = self.nodes
+        self.claim(c, 'carol')
+        settle(self, lambda: 'carol' in a.directory())
+        self.assertTrue(a.cluster.request('whisper', sender='alice', to='carol', message='psst')['ok'])
+        self.assertFalse(a.cluster.request('whisper', sender='alice', to='nobody', message='psst')['ok'])
+        settle(self, lambda: len(c.received('whisper')) == 1)
+        self.claim(a, 'marker')
+        settle(self, lambda: 'marker' in b.directory())
+        self.assertEqual(b.received('whisper'), [])
+        self.assertEqual(c.received('whisper')[0]['message'], 'psst')
+
+    def test_simultaneous_claim_evicts_later_node(self) -> None:
+        a, b, c = self.nodes
+        settle(self, lambda: len(self.broker.members) == 3)
+        # Neither node hears of the other's claim before making its own; b hears of them in either order
+        for first, second, username in ((c, a, 'clash'), (a, c, 'clash2')):
+            self.broker.hold()
+            self.assertTrue(self.claim(first, username))
+            self.assertTrue(self.claim(second, username))
+            self.broker.release()
+            settle(self, lambda: all(node.directory().get(username) == ('a', 'lobby') for node in self.nodes))
+        settle(self, lambda: len(c.received('evict')) == 2)
+        self.assertEqual(c.received('evict'), [{'op': 'evict', 'username': 'clash'},
+                                               {'op': 'evict', 'username': 'clash2'}])
+        self.assertEqual(a.received('evict'), [])
+        self.assertEqual(b.received('evict'), [])
+        settle(self, lambda: 'clash' in b.online() and 'clash2' in b.online())
+
+    def test_closed_node_is_gone(self) -> None:
+        a, b, c = self.nodes
+        self.claim(c, 'carol')
+        self.claim(a, 'alice')
+        settle(self, lambda: all('carol' in node.online() for node in (a, b)))
+        c.cluster.close()
+        self.nodes.remove(c)
+        settle(self, lambda: all('carol' not in node.directory() and 'carol' not in node.online()
+                                 for node in (a, b)))
+        self.assertIn('alice', b.directory())
+
+
+# Two real server nodes joined by a real relay, each on a port of its own.
+class RelayClusterTest(unittest.TestCase):
+    def setUp(self) -> None:
+        relay_port = free_port()
+        start_process(self, 'cluster.py', relay_port)
+        self.ports = []
+        for _ in range(2):
+            port = free_port()
+            start_process(self, 'server.py', port, '--cluster', '{}:{}'.format(HOST_NAME, relay_port), '--quiet')
+            self.ports.append(port)
+
+    def connect(self, username: str, port: int) -> chatclient.Connection:
+        connection = chatclient.Connection(username).connect(HOST_NAME, port)
+        self.addCleanup(connection.close)
+        expect(self, connection, 'welcome')
+        return connection
+
+    def test_delivery_across_nodes(self) -> None:
+        alice = self.connect('alice', self.ports[0])
+        bob = self.connect('bob', self.ports[1])
+        alice.send('hello from the first node')
+        self.assertEqual(expect(self, bob, 'hello from'), 'alice> hello from the first node')
+        bob.send('/whisper alice psst')
+        self.assertEqual(expect(self, alice, 'psst'), 'From bob to you> psst')
+        with self.assertRaises(chatclient.UsernameInUse):    # Taken on the other node
+            chatclient.Connection('alice').connect(HOST_NAME, self.ports[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+import random
+import socket
+import threading
+import unittest
+
+import protocol
+from protocol import Frame
+
+
+# ---------------------------------------------------- Helpers ------------------------------------------------------- #
+
+# Split data into chunks at random points (including inside headers), as a stream may arrive from the network.
+def fragment(data: bytes, rng: random.Random, max_chunk: int = 7) -> list:
+    chunks = []
+    position = 0
+    while position < len(data):
+        size = rng.randint(1, max_chunk)
+        chunks.append(data[position:position + size])
+        position += size
+    return chunks
+
+
+# Feed the chunks to a decoder one at a time, collecting every frame completed along the way.
+def decode_chunks(decoder: protocol.FrameDecoder, chunks: list) -> list:
+    frames = []
+    for chunk in chunks:
+        decoder.feed(chunk)
+        frames.extend(decoder.frames())
+    return frames
+
+
+MESSAGES = ['Hello!', 'x' * 3000, '', 'héllo wörld ✓', 'LEAVE', '/whisper bob hi', 'y' * 9999]
+
+
+# ----------------------------------------------------- Tests -------------------------------------------------------- #
+
+class FrameDecoderTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.rng = random.Random(1234)
+
+    def test_v1_fragmented(self) -> None:
+        stream = b''.join(Frame(message).encode(protocol.V1) for message in MESSAGES)
+        for _ in range(50):
+            frames = decode_chunks(protocol.FrameDecoder(chunk_size=16), fragment(stream, self.rng))
+            self.assertEqual([frame.message for frame in frames], MESSAGES)
+        self.assertEqual(frames[4].kind, protocol.LEAVE)     # A keyword is a control frame in v1
+
+    def test_v2_fragmented(self) -> None:
+        stream = b''.join(Frame(message).encode(protocol.V2) for message in MESSAGES)
+        for _ in range(50):
+            frames = decode_chunks(protocol.FrameDecoder(protocol.V2, chunk_size=16), fragment(stream, self.rng))
+            self.assertEqual([frame.message for frame in frames], MESSAGES)
+        self.assertEqual(frames[4].kind, protocol.MESSAGE)   # ... but just chat in v2
+
+    def test_coalesced(self) -> None:
+        for version in (protocol.V1, protocol.V2):
+            decoder = protocol.FrameDecoder(version)
+            decoder.feed(b''.join(Frame(message).encode(version) for message in MESSAGES))
+            self.assertEqual([frame.message for frame in decoder.frames()], MESSAGES)
+            self.assertEqual(decoder.buffered, 0)
+
+    def test_coalesced_with_partial_tail(self) -> None:
+        stream = b''.join(Frame(message).encode(protocol.V2) for message in MESSAGES)
+        decoder = protocol.FrameDecoder(protocol.V2)
+        decoder.feed(stream[:-3])
+        self.assertEqual([frame.message for frame in decoder.frames()], MESSAGES[:-1])
+        decoder.feed(stream[-3:])
+        self.assertEqual(decoder.next_frame().message, MESSAGES[-1])
+        self.assertIsNone(decoder.next_frame())
+
+    def test_control_frames_v2(self) -> None:
+        stream = b''.join(Frame.control(kind).encode(protocol.V2) for kind in (protocol.PING, protocol.PONG,
+                                                                                protocol.END))
+        frames = decode_chunks(protocol.FrameDecoder(protocol.V2), fragment(stream, self.rng, 2))
+        self.assertEqual([frame.kind for frame in frames], [protocol.PING, protocol.PONG, protocol.END])
+
+    def test_compressed_v2(self) -> None:
+        messages = ['z' * 5000, 'short', 'abc' * 1000]
+        encoded = [Frame(message).encode(protocol.V2, protocol.DEFAULT_COMPRESSION_THRESHOLD) for message in messages]
+        self.assertTrue(encoded[0][4] & protocol.COMPRESSED)
+        self.assertFalse(encoded[1][4] & protocol.COMPRESSED)
+        self.assertLess(len(encoded[0]), 5000)
+        for _ in range(20):
+            frames = decode_chunks(protocol.FrameDecoder(protocol.V2), fragment(b''.join(encoded), self.rng, 50))
+            self.assertEqual([frame.message for frame in frames], messages)
+            self.assertEqual([frame.kind for frame in frames], [protocol.MESSAGE] * 3)
+
+    def test_compressed_over_limit(self) -> None:
+        data = Frame('z' * 5000).encode(protocol.V2, protocol.DEFAULT_COMPRESSION_THRESHOLD)
+        decoder = protocol.FrameDecoder(protocol.V2, max_frame_size=1000)
+        decoder.feed(data)
+        with self.assertRaises(protocol.FramingError):
+            decoder.next_frame()
+
+    def test_switch_to_v2(self) -> None:
+        request = protocol.encode_v1(b'GET_USERNAME', offer_v2=True, offer_compression=True)
+        after = Frame('welcome').encode(protocol.V2) + Frame('z' * 2000).encode(protocol.V2, 512)
+        decoder = protocol.FrameDecoder()
+        decoder.feed(request + after)   # The v2 frames arrive in the same chunk as the v1 handshake
+        frame = decoder.next_frame()
+        self.assertEqual(frame.kind, protocol.GET_USERNAME)
+        self.assertTrue(decoder.v2_offered)
+        self.assertTrue(decoder.compression_offered)
+        decoder.version = protocol.V2
+        self.assertEqual([frame.message for frame in decoder.frames()], ['welcome', 'z' * 2000])
+
+    def test_no_offer_without_room(self) -> None:
+        decoder = protocol.FrameDecoder()
+        decoder.feed(protocol.encode_v1(b'u' * 1200, offer_v2=True, offer_compression=True))
+        self.assertEqual(decoder.next_frame().message, 'u' * 1200)
+        self.assertFalse(decoder.v2_offered)
+
+    def test_oversize_v2(self) -> None:
+        decoder = protocol.FrameDecoder(protocol.V2, max_frame_size=1024)
+        decoder.feed(protocol.V2_HEADER.pack(1025, protocol.MESSAGE))
+        with self.assertRaises(protocol.FramingError):
+            decoder.next_frame()
+
+    def test_malformed_v1(self) -> None:
+        decoder = protocol.FrameDecoder()
+        decoder.feed(b'ab12hello')
+        with self.assertRaises(protocol.FramingError):
+            decoder.next_frame()
+
+    def test_invalid_utf8(self) -> None:
+        decoder = protocol.FrameDecoder(protocol.V2)
+        decoder.feed(protocol.V2_HEADER.pack(2, protocol.MESSAGE) + b'\xff\xfe')
+        with self.assertRaises(protocol.FramingError):
+            decoder.next_frame()
+
+    def test_large_frame_grows_and_shrinks_buffer(self) -> None:
+        decoder = protocol.FrameDecoder(protocol.V2, chunk_size=64)
+        message = 'q' * 10000
+        frames = decode_chunks(decoder, fragment(Frame(message).encode(protocol.V2), self.rng, 300))
+        self.assertEqual([frame.message for frame in frames], [message])
+        self.assertEqual(len(decoder.buffer), 64)
+
+    def test_recv_into(self) -> None:
+        ours, theirs = socket.socketpair()
+        stream = b''.join(Frame(message).encode(protocol.V2) for message in MESSAGES)
+
+        def write() -> None:    # In small pieces, so frames straddle the reads
+            for chunk in fragment(stream, self.rng, 500):
+                theirs.sendall(chunk)
+            theirs.close()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            decoder = protocol.FrameDecoder(protocol.V2, chunk_size=1024)
+            frames = []
+            while decoder.recv_into(ours):
+                frames.extend(decoder.frames())
+            self.assertEqual([frame.message for frame in frames], MESSAGES)
+            self.assertEqual(decoder.buffered, 0)
+        finally:
+            writer.join()
+            ours.close()
+
+
+if __name__ == '__main__':
+    unittest.main()